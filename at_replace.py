@@ -37,9 +37,15 @@ def replace_tags(line, replacements, specific_words = None):
             res += sub
     return res, count
 
-def generate_random(document):
-    ''' Generates random lorem ipsum rules for each @-enclosed item '''
+def generate_random(document, keys = None):
+    ''' Generates random lorem ipsum rules for each @-enclosed item, or for
+    each of keys (e.g. the text keys of a template's manifest) without
+    scanning the document '''
     replacements = {}
+    if keys is not None:
+        for txt in keys:
+            replacements[txt] = " ".join(random.sample(lorem_ipsum, len(txt)))
+        return replacements
     def gen(line):
         subs = re.split(r'(@[^@]*@)', line)
         for sub in subs:
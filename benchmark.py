@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+"""
+Benchmark the docx hot paths on synthetic templates of controlled size.
+
+For each scenario a template is generated with a given number of
+paragraphs, placeholders per paragraph, runs each placeholder is split
+across, tables (filled from make_dummy_table()) and images. Opening the
+template, each replacement phase, replace_all(), getdocumenttext(),
+advReplace() and save() are then timed separately, every repeat in a fresh
+process so that the peak memory of each scenario can be reported too. The
+template is generated once per scenario, in a process of its own, so the
+peak memory is that of rendering it rather than of making it.
+The startup scenario instead times a fresh interpreter importing the
+module and rendering a small template once, the way a short command line
+run like replaceexample.py does. The build scenario times making a body of
+headings, paragraphs and tables from scratch, once by appending the
+elements made by heading(), paragraph() and table() and once with
+buildbody().
+
+Results are written as JSON: for every scenario and phase, the times of all
+repeats, their median and the throughput at the median.
+
+With --check, the results are compared against a baseline file written by
+an earlier run instead, a table of the differences is printed, and the exit
+status is non-zero if any phase got significantly slower (or any scenario's
+peak memory significantly larger). A phase only counts as slower when its
+median time grew by more than the tolerance (20% by default) and every new
+run was slower than every baseline run, so a single noisy run doesn't fail
+the check. Timings are
+only comparable on the same machine, so regenerate the baseline (with -o)
+when moving the check elsewhere.
+
+Usage:
+  benchmark.py [-s SCENARIO,...] [-r REPEAT] [-o results.json]
+  benchmark.py --check benchmark-baseline.json [-t TOLERANCE] [-r REPEAT]
+
+Part of Python's docx module - http://github.com/mikemaccana/python-docx
+See LICENSE for licensing information.
+"""
+
+import json
+import os
+import platform
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from multiprocessing import Pool
+from optparse import OptionParser
+from StringIO import StringIO
+
+from docx import (DocX, advReplace, buildbody, clean, getdocumenttext, heading,
+                  make_dummy_table, makeelement, paragraph, table)
+from docxreplace import DocXReplace
+
+# paragraphs: number of paragraphs of body text
+# keys: placeholders per paragraph
+# runs: runs each placeholder is split across
+# tables, rows, cols: tables to fill, and the rows and columns filled in each
+# images: images to replace
+SCENARIOS = {
+    'small':  {'paragraphs': 200, 'keys': 2, 'runs': 1,
+               'tables': 2, 'rows': 20, 'cols': 5, 'images': 2},
+    'medium': {'paragraphs': 2000, 'keys': 3, 'runs': 1,
+               'tables': 10, 'rows': 100, 'cols': 6, 'images': 10},
+    'split':  {'paragraphs': 2000, 'keys': 3, 'runs': 3,
+               'tables': 0, 'rows': 0, 'cols': 0, 'images': 0},
+    'tables': {'paragraphs': 100, 'keys': 1, 'runs': 1,
+               'tables': 40, 'rows': 250, 'cols': 8, 'images': 0},
+    'large':  {'paragraphs': 20000, 'keys': 4, 'runs': 1,
+               'tables': 20, 'rows': 200, 'cols': 8, 'images': 40},
+    'startup': {'paragraphs': 20, 'keys': 2, 'runs': 1,
+                'tables': 1, 'rows': 5, 'cols': 3, 'images': 1, 'startup': True},
+    'build':  {'paragraphs': 10000, 'keys': 0, 'runs': 1,
+               'tables': 10, 'rows': 20, 'cols': 5, 'images': 0, 'build': True},
+}
+
+DEFAULT_SCENARIOS = ['small', 'medium', 'split', 'tables', 'startup', 'build']
+
+# Run in a new interpreter by run_startup(): argv is the template, the JSON
+# payload and the output file
+STARTUP = """
+import resource, sys, time
+start = time.time()
+from docxreplace import DocXReplace
+imported = time.time()
+DocXReplace(sys.argv[1], json_file=sys.argv[2]).render(sys.argv[3])
+rendered = time.time()
+print imported - start, rendered - imported, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+"""
+
+FILLER = 'Lorem ipsum dolor sit amet, consectetur adipisicing elit'
+
+
+def png(width, height):
+    '''Return the bytes of a blank grayscale PNG image'''
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+    rows = ('\0' + '\xff' * width) * height
+    return ('\x89PNG\r\n\x1a\n' +
+            chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)) +
+            chunk('IDAT', zlib.compress(rows)) + chunk('IEND', ''))
+
+
+def image_paragraph(picname, rel_id):
+    '''Make a paragraph holding just enough of a picture for replace_images()'''
+    cnvpr = makeelement('cNvPr', nsprefix='pic', attributes={'id': '0', 'name': picname})
+    nvpicpr = makeelement('nvPicPr', nsprefix='pic')
+    nvpicpr.append(cnvpr)
+    blipfill = makeelement('blipFill', nsprefix='pic')
+    blipfill.append(makeelement('blip', nsprefix='a', attrnsprefix='r',
+                                attributes={'embed': rel_id}))
+    pic = makeelement('pic', nsprefix='pic')
+    pic.append(nvpicpr)
+    pic.append(blipfill)
+    graphicdata = makeelement('graphicData', nsprefix='a')
+    graphicdata.append(pic)
+    graphic = makeelement('graphic', nsprefix='a')
+    graphic.append(graphicdata)
+    inline = makeelement('inline', nsprefix='wp')
+    inline.append(graphic)
+    drawing = makeelement('drawing')
+    drawing.append(inline)
+    run = makeelement('r')
+    run.append(drawing)
+    para = makeelement('p')
+    para.append(run)
+    return para
+
+
+def tag_table(tag, cols):
+    '''Make a table with a heading row and a row holding a @@tag@@'''
+    contents = [['Heading %d' % i for i in range(cols)],
+                ['@@%s@@' % tag] + [''] * (cols - 1)]
+    return table(contents)
+
+
+def make_template(directory, params):
+    '''Write a synthetic template and the files it needs into directory.
+    Returns the template path and the replacements payload for it.'''
+    dx = DocX()
+    dx.verbose = False
+    body = dx.body[0]
+    rels = dx.get_relationships()
+    text_reps, table_reps, image_reps = {}, {}, {}
+    key = 0
+    for i in range(params['paragraphs']):
+        pieces = [FILLER]
+        for k in range(params['keys']):
+            name = 'key%d' % key
+            text_reps[name] = 'value %d' % key
+            key += 1
+            placeholder = '@%s@' % name
+            step = max(1, len(placeholder) // params['runs'])
+            cuts = range(0, len(placeholder), step)[:params['runs']] + [len(placeholder)]
+            pieces.extend(placeholder[a:b] for a, b in zip(cuts, cuts[1:]))
+            pieces.append(' ' + FILLER)
+        body.append(paragraph(pieces))
+        if params['tables'] and i % max(1, params['paragraphs'] // params['tables']) == 0 \
+                and len(table_reps) < params['tables']:
+            tag = 'table%d' % len(table_reps)
+            body.append(tag_table(tag, params['cols']))
+            table_reps[tag] = [{'font_size': 8, 'font_face': 'Arial', 'borders': ['top']},
+                               make_dummy_table(params['rows'], params['cols'])]
+    replacement = os.path.join(directory, 'replacement.png')
+    open(replacement, 'wb').write(png(64, 48))
+    for i in range(params['images']):
+        picname = 'image%d.png' % i
+        rel_id = 'rId%d' % (100 + i)
+        rels.append(makeelement('Relationship', nsprefix=None,
+                                attributes={'Id': rel_id, 'Target': 'media/' + picname,
+                                            'Type': 'http://schemas.openxmlformats.org/'
+                                                    'officeDocument/2006/relationships/image'}))
+        dx.images['word/media/' + picname] = png(640, 480)
+        body.append(image_paragraph(picname, rel_id))
+        image_reps[picname] = replacement
+    template = os.path.join(directory, 'template.docx')
+    dx.save(template)
+    return template, {'text': text_reps, 'tables': table_reps, 'images': image_reps}
+
+
+def timed(timings, phase, function, *args):
+    start = time.time()
+    result = function(*args)
+    timings[phase] = time.time() - start
+    return result
+
+
+def run_startup(directory, template, payload_file):
+    '''Time a new interpreter importing docxreplace and rendering template.
+    Returns (timings, peak memory in kilobytes).'''
+    start = time.time()
+    child = subprocess.Popen([sys.executable, '-c', STARTUP, template, payload_file,
+                              os.path.join(directory, 'output.docx')],
+                             cwd=os.path.dirname(os.path.abspath(__file__)),
+                             stdout=subprocess.PIPE)
+    out = child.communicate()[0]
+    total = time.time() - start
+    if child.returncode:
+        raise Exception('Startup run failed with status %d' % child.returncode)
+    imported, rendered, peak = out.split()
+    return {'cold_start': total, 'import': float(imported),
+            'first_render': float(rendered)}, int(peak)
+
+
+def body_items(params):
+    '''Return the items of a generated data dictionary for buildbody(): a
+    heading every 20 paragraphs and the tables spread between them'''
+    items = []
+    every = params['paragraphs'] // (params['tables'] + 1)
+    rows = [['cell %d.%d' % (i, j) for j in range(params['cols'])]
+            for i in range(params['rows'])]
+    for i in range(params['paragraphs']):
+        if i % 20 == 0:
+            items.append(('Heading2', 'Section %d' % (i // 20), None))
+        items.append(('BodyText', '%d %s' % (i, FILLER)))
+        if params['tables'] and i % every == every - 1 and i // every < params['tables']:
+            items.append({'contents': rows})
+    return items
+
+
+def build_helpers(items):
+    body = makeelement('body')
+    for item in items:
+        if isinstance(item, dict):
+            body.append(table(**item))
+        elif item[0].startswith('Heading'):
+            body.append(heading(item[1], int(item[0][-1])))
+        else:
+            body.append(paragraph(item[1], style=item[0]))
+    return body
+
+
+def build_bulk(items):
+    body = makeelement('body')
+    buildbody(body, items)
+    return body
+
+
+def run_build(params):
+    '''Time building the same body with the element helpers and with
+    buildbody(). Returns (timings, units).'''
+    items = body_items(params)
+    timings = {}
+    timed(timings, 'build_helpers', build_helpers, items)
+    timed(timings, 'build_bulk', build_bulk, items)
+    units = {'build_helpers': (len(items), 'items'), 'build_bulk': (len(items), 'items')}
+    return timings, units
+
+
+def prepare_scenario(name, directory):
+    '''Generate the template for a scenario in directory, and its payload
+    as a JSON file there, and return both file names. Meant to run in a
+    process of its own; the payload is only loaded by the processes that
+    are measured, since they would inherit the memory it takes up here.'''
+    template, payload = make_template(directory, SCENARIOS[name])
+    payload_file = os.path.join(directory, 'payload.json')
+    with open(payload_file, 'w') as f:
+        json.dump(payload, f)
+    return template, payload_file
+
+
+def run_scenario(name, template = None, payload_file = None):
+    '''Time every phase of a scenario on its template and payload file,
+    made by prepare_scenario(). Meant to run in a fresh process; returns
+    (timings, units, peak memory).'''
+    params = SCENARIOS[name]
+    if params.get('build'):
+        timings, units = run_build(params)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':
+            peak *= 1024
+        return timings, units, peak
+    directory = tempfile.mkdtemp()
+    try:
+        if params.get('startup'):
+            timings, peak = run_startup(directory, template, payload_file)
+            if sys.platform != 'darwin':
+                peak *= 1024
+            units = {'cold_start': (1, 'runs'), 'import': (1, 'runs'),
+                     'first_render': (os.path.getsize(template), 'bytes')}
+            return timings, units, peak
+        with open(payload_file) as f:
+            payload = json.load(f)
+        timings = {}
+
+        def opened():
+            dx = DocXReplace(template, dic=payload)
+            dx.verbose = False
+            return dx
+        dx = timed(timings, 'open', opened)
+        timed(timings, 'replace_text', dx.replace_text)
+        timed(timings, 'replace_tables', dx.replace_tables)
+        timed(timings, 'replace_images', dx.replace_images)
+        paratextlist = timed(timings, 'getdocumenttext', getdocumenttext, dx.get_document())
+        output = StringIO()
+        timed(timings, 'save', dx.save, output)
+
+        dx = opened()
+        timed(timings, 'replace_all', dx.replace_all)
+        dx = opened()
+        timed(timings, 'clean', clean, dx.get_document(), True)
+        timed(timings, 'advReplace', advReplace, dx.get_document(), '@key0@', 'value')
+
+        size = os.path.getsize(template)
+        units = {'open': (size, 'bytes'),
+                 'replace_text': (params['paragraphs'] * params['keys'], 'keys'),
+                 'replace_tables': (params['tables'] * params['rows'], 'rows'),
+                 'replace_images': (params['images'], 'images'),
+                 'replace_all': (size, 'bytes'),
+                 'getdocumenttext': (len(paratextlist), 'paragraphs'),
+                 'clean': (params['paragraphs'], 'paragraphs'),
+                 'advReplace': (params['paragraphs'], 'paragraphs'),
+                 'save': (len(output.getvalue()), 'bytes')}
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':
+            peak *= 1024  # kilobytes everywhere but OS X
+        return timings, units, peak
+    finally:
+        shutil.rmtree(directory)
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def compare(baseline, results, tolerance = 0.2, min_change = 0.001):
+    '''Compare benchmark results against a baseline. A phase is a regression
+    when the ratio of its new to its baseline median time is above
+    1 + tolerance, the medians differ by more than min_change seconds, and
+    even its fastest new run is slower than the slowest baseline run; it is
+    faster under the mirror image of those conditions. Peak memory is a
+    regression when it grew by more than tolerance.
+    Returns a list of (scenario, phase, baseline, new, change, status) rows.'''
+    rows = []
+    for name in sorted(baseline['scenarios']):
+        if name not in results['scenarios']:
+            continue
+        old, new = baseline['scenarios'][name], results['scenarios'][name]
+        for phase in sorted(old['phases']):
+            if phase not in new['phases']:
+                continue
+            before, after = old['phases'][phase], new['phases'][phase]
+            change = after['median'] - before['median']
+            limit = 1 + tolerance
+            if (change > min_change and after['median'] > before['median'] * limit
+                    and min(after['times']) > max(before['times'])):
+                status = 'REGRESSION'
+            elif (-change > min_change and after['median'] * limit < before['median']
+                    and max(after['times']) < min(before['times'])):
+                status = 'faster'
+            else:
+                status = 'ok'
+            rows.append((name, phase, before['median'], after['median'],
+                         change / before['median'] if before['median'] else 0.0, status))
+        before, after = old['peak_memory'], new['peak_memory']
+        change = after - before
+        if change > tolerance * before:
+            status = 'REGRESSION'
+        elif -change > tolerance * before:
+            status = 'smaller'
+        else:
+            status = 'ok'
+        rows.append((name, 'peak_memory', before, after,
+                     float(change) / before if before else 0.0, status))
+    return rows
+
+
+def print_comparison(rows, out = sys.stdout):
+    out.write('%-10s %-16s %12s %12s %8s  %s\n' %
+              ('scenario', 'phase', 'baseline', 'new', 'change', 'status'))
+    for name, phase, before, after, change, status in rows:
+        if phase == 'peak_memory':
+            before, after = '%.1fMB' % (before / 1048576.0), '%.1fMB' % (after / 1048576.0)
+        else:
+            before, after = '%.2fms' % (before * 1000), '%.2fms' % (after * 1000)
+        out.write('%-10s %-16s %12s %12s %+7.1f%%  %s\n' %
+                  (name, phase, before, after, change * 100, status))
+
+
+def run_benchmarks(names, repeat = 5):
+    '''Run each scenario repeat times, each time in a new process, and
+    return the results in the format written by main()'''
+    scenarios = {}
+    for name in names:
+        runs = []
+        args = (name,)
+        directory = None
+        if not SCENARIOS[name].get('build'):
+            directory = tempfile.mkdtemp()
+            pool = Pool(1)
+            args += pool.apply(prepare_scenario, (name, directory))
+            pool.terminate()
+        try:
+            for i in range(repeat):
+                pool = Pool(1)
+                runs.append(pool.apply(run_scenario, args))
+                pool.terminate()
+        finally:
+            if directory is not None:
+                shutil.rmtree(directory)
+        phases = {}
+        for phase in runs[0][0]:
+            times = [timings[phase] for timings, units, peak in runs]
+            count, unit = runs[0][1][phase]
+            mid = median(times)
+            phases[phase] = {'times': times, 'median': mid, 'units': count,
+                             'unit': unit, 'throughput': count / mid if mid else None}
+        scenarios[name] = {'params': SCENARIOS[name], 'phases': phases,
+                           'peak_memory': max(peak for timings, units, peak in runs)}
+    return {'python': platform.python_version(), 'platform': platform.platform(),
+            'repeat': repeat, 'scenarios': scenarios}
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-s', '--scenarios', default=None,
+                      help='comma separated scenarios to run, from: %s (default: %s, '
+                           'or those in the baseline)' %
+                           (', '.join(sorted(SCENARIOS)), ','.join(DEFAULT_SCENARIOS)))
+    parser.add_option('-r', '--repeat', type='int', default=5,
+                      help='times to run each scenario (default 5)')
+    parser.add_option('-o', '--output', default=None,
+                      help='write the JSON results here instead of stdout')
+    parser.add_option('-c', '--check', default=None, metavar='BASELINE',
+                      help='compare against this baseline and fail on regressions')
+    parser.add_option('-t', '--tolerance', type='float', default=0.2,
+                      help='fractional slowdown allowed by --check (default 0.2)')
+    options, args = parser.parse_args()
+    baseline = None
+    if options.check:
+        with open(options.check) as f:
+            baseline = json.load(f)
+    if options.scenarios:
+        names = options.scenarios.split(',')
+    elif baseline is not None:
+        names = sorted(baseline['scenarios'])
+    else:
+        names = DEFAULT_SCENARIOS
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error('Unknown scenario %s' % name)
+    results = run_benchmarks(names, options.repeat)
+    if options.output or baseline is None:
+        out = open(options.output, 'w') if options.output else sys.stdout
+        try:
+            json.dump(results, out, indent=2, sort_keys=True)
+            out.write('\n')
+        finally:
+            if out is not sys.stdout:
+                out.close()
+    if baseline is not None:
+        rows = compare(baseline, results, options.tolerance)
+        print_comparison(rows)
+        if [row for row in rows if row[-1] == 'REGRESSION']:
+            sys.exit(1)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+Compile docx templates into manifests of what they need to be filled.
+
+The manifest is a small JSON file written next to the template (foo.docx
+gets foo.manifest.json), so that workers and payload validators can tell
+what a template takes without parsing it. It lists:
+
+  text    each @key@, with the places it occurs as [part, offset] pairs
+  tables  each @@tag@@ table, with its number of columns, part and offset
+  images  each picture that can be replaced, by name, with the rId, part
+          and offset of each place it occurs
+  repeats each @#name@ ... @/name@ repeat block, with the keys its records
+          fill and the offset of its start marker; keys inside a block
+          aren't listed under text
+  parts   the parts holding any @key@, in the order they are filled
+
+An offset counts the elements of a part in document order, the order in
+which DocXReplace visits them. The manifest also records the template's
+modification time and size; load_manifest() in docxreplace ignores it once
+the template changes, so a stale manifest is never trusted.
+
+Usage:
+  compile_template.py template.docx ...
+
+Part of Python's docx module - http://github.com/mikemaccana/python-docx
+See LICENSE for licensing information.
+"""
+
+import json
+import os
+import re
+import sys
+from optparse import OptionParser
+
+from docx import DocX
+from docxreplace import findrepeats, keyre, manifestpath
+
+tablere = re.compile(r'@@([^@]+)@@')
+
+
+def tagname(elem):
+    return elem.tag.split('}')[-1]
+
+
+def scan_template(dx):
+    '''Return the manifest of an opened template, without its stamp'''
+    text = {}
+    tables = {}
+    images = {}
+    repeats = {}
+    parts = []
+    inblock = set()
+    starts = {}
+    for name, start, elements, end in findrepeats(dx.body[0]):
+        keys = set()
+        for elem in elements:
+            for sub in elem.iter():
+                if sub.text and '@' in sub.text and not tablere.search(sub.text):
+                    keys.update(keyre.findall(sub.text))
+        repeats[name] = {'keys': sorted(keys), 'part': 'word/document.xml'}
+        starts[start] = name
+        for elem in [start] + elements + [end]:
+            inblock.update(elem.iter())
+    for name in dx.get_content_parts():
+        for offset, elem in enumerate(dx.get_tree(name).iter()):
+            if elem in inblock:
+                continue
+            if elem.text and '@' in elem.text and not tablere.search(elem.text):
+                for key in keyre.findall(elem.text):
+                    text.setdefault(key, []).append([name, offset])
+                    if name not in parts:
+                        parts.append(name)
+    # tables, images and repeats are only filled in the main document
+    for offset, elem in enumerate(dx.get_document().iter()):
+        if elem in starts:
+            repeats[starts[elem]]['offset'] = offset
+        tag = tagname(elem)
+        if tag == 'tbl':
+            for row in elem:
+                if tagname(row) != 'tr':
+                    continue
+                col = dx.find_subelem_list(row, ['tc', 'p', 'r', 't'])
+                tags = tablere.findall(col.text or '') if col is not None else []
+                if tags:
+                    tables[tags[0]] = {'columns': dx.get_num_columns(elem),
+                                       'part': 'word/document.xml', 'offset': offset}
+                    break
+        elif tag == 'graphic':
+            picname = dx.get_pic_name(elem)
+            rid = dx.get_id(elem)
+            if picname and rid is not None:
+                images.setdefault(picname, []).append(
+                    {'rId': rid, 'part': 'word/document.xml', 'offset': offset})
+    return {'text': text, 'tables': tables, 'images': images, 'repeats': repeats,
+            'parts': parts}
+
+
+def compile_template(template):
+    '''Write the manifest of template next to it and return it'''
+    st = os.stat(template)
+    manifest = scan_template(DocX(template))
+    manifest['template'] = os.path.basename(template)
+    manifest['stamp'] = [st.st_mtime, st.st_size]
+    output = manifestpath(template)
+    f = open(output + '.tmp', 'w')
+    try:
+        json.dump(manifest, f, indent=1, sort_keys=True, separators=(',', ': '))
+    finally:
+        f.close()
+    os.rename(output + '.tmp', output)
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog template.docx ...')
+    options, args = parser.parse_args()
+    if not args:
+        parser.error('Please supply some templates')
+    for template in args:
+        manifest = compile_template(template)
+        sys.stderr.write('%s: %d keys, %d tables, %d images\n'
+                         % (manifestpath(template), len(manifest['text']),
+                            len(manifest['tables']), len(manifest['images'])))
@@ -9,23 +9,36 @@ See LICENSE for licensing information.
 """
 
 import logging
+from contextlib import contextmanager
+from copy import deepcopy
 from lxml import etree
-try:
-    from PIL import Image
-except ImportError:
-    import Image
 import zipfile
-import shutil
+import mmap
 import re
+import struct
 import time
 import os
+import zlib
 from os.path import join
-import subprocess
-import random
-import json
 import sys
+import weakref
+
+try:
+    from logging import NullHandler
+except ImportError:  # Python 2.6
+    class NullHandler(logging.Handler):
+        def emit(self, record):
+            pass
 
 log = logging.getLogger(__name__)
+# Quiet unless the application configures logging; this also stops Python 2
+# complaining that no handlers could be found
+log.addHandler(NullHandler())
+
+# Stream handlers added by DocX.set_log_file(), by logger name, each with
+# the level the logger had before; and the documents that asked for them
+loghandlers = {}
+logowners = weakref.WeakSet()
 
 # Record template directory's location which is just 'template' for a docx
 # developer or 'site-packages/docx-template' if you have installed docx
@@ -65,6 +78,9 @@ nsprefixes = {
     'dcmitype': 'http://purl.org/dc/dcmitype/',
     'dcterms':  'http://purl.org/dc/terms/'}
 
+# Earliest timestamp a zip entry can hold (1980-01-01 00:00:00 UTC)
+ZIP_EPOCH = 315532800
+
 def make_dummy_table(nrows, ncols, multiplier = 1):
     dummy_table = []
     for i in range(nrows * ncols):
@@ -75,33 +91,217 @@ def make_dummy_table(nrows, ncols, multiplier = 1):
             dummy_table[-1].append(x)
     return dummy_table
 
+class RenderStats(object):
+    '''Wall and CPU time spent in each phase of loading, filling and saving
+    a document, plus counters of the work done.
+
+    If a metrics callback is given, it is called as callback(name, value)
+    with '<phase>.wall' and '<phase>.cpu' (in seconds) once for each phase
+    of a render, and with each counter when report() is called, which
+    DocX.save() does once the document is written. Each sample covers a
+    whole phase: the time taken by each part (parse/<part>) is only summed
+    in timings.'''
+    def __init__(self, callback = None):
+        self.callback = callback
+        self.timings = {}   # phase -> [wall seconds, cpu seconds]
+        self.counters = {}
+        self.deferred = None    # phase -> [wall, cpu] or None, in summed()
+
+    @contextmanager
+    def timer(self, phase, report = True):
+        '''Time the enclosed block, adding it to any earlier time for phase.
+        The time is passed to the callback unless report is false, or, inside
+        summed(), once the summed block ends.'''
+        wall, cpu = time.time(), cputime()
+        try:
+            yield
+        finally:
+            wall, cpu = time.time() - wall, cputime() - cpu
+            timing = self.timings.setdefault(phase, [0.0, 0.0])
+            timing[0] += wall
+            timing[1] += cpu
+            if not report or self.callback is None:
+                pass
+            elif self.deferred is not None and phase in self.deferred:
+                total = self.deferred[phase] or [0.0, 0.0]
+                self.deferred[phase] = [total[0] + wall, total[1] + cpu]
+            else:
+                self.callback(phase + '.wall', wall)
+                self.callback(phase + '.cpu', cpu)
+
+    @contextmanager
+    def summed(self, *phases):
+        '''Pass the time spent in each of phases within the enclosed block
+        to the callback once, when the block ends, rather than every time
+        one of them is timed, e.g. once for each part'''
+        outer, self.deferred = self.deferred, dict((phase, None) for phase in phases)
+        try:
+            yield
+        finally:
+            deferred, self.deferred = self.deferred, outer
+            for phase in phases:
+                if deferred[phase] is not None:
+                    self.callback(phase + '.wall', deferred[phase][0])
+                    self.callback(phase + '.cpu', deferred[phase][1])
+
+    def count(self, name, n = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        '''Pass the counters to the metrics callback'''
+        if self.callback is not None:
+            for name in sorted(self.counters):
+                self.callback(name, self.counters[name])
+
+    def as_dict(self):
+        return {'timings': dict((phase, tuple(timing)) for phase, timing in self.timings.items()),
+                'counters': dict(self.counters)}
+
+    def merge(self, stats):
+        '''Add the timings and counters of another RenderStats, given as
+        returned by its as_dict(), to these ones'''
+        for phase, (wall, cpu) in stats['timings'].items():
+            timing = self.timings.setdefault(phase, [0.0, 0.0])
+            timing[0] += wall
+            timing[1] += cpu
+        for name, n in stats['counters'].items():
+            self.count(name, n)
+
+
+def cputime():
+    '''Return the user and system CPU time used by this process'''
+    times = os.times()
+    return times[0] + times[1]
+
+
+def typecounts():
+    '''Return the number of live objects the garbage collector tracks, by type'''
+    import gc
+    counts = {}
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+@contextmanager
+def profiled(prefix, limit = 30):
+    '''Profile the enclosed block with cProfile, writing the raw profile
+    to prefix + '.prof' and a report of the slowest functions and the top
+    allocations to prefix + '.txt'. Allocations come from tracemalloc where
+    it exists; otherwise the growth in live objects by type and in peak
+    memory is reported instead.'''
+    import cProfile
+    import pstats
+    from StringIO import StringIO
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+    try:
+        import resource
+        maxrss = lambda: resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        maxrss = lambda: 0
+    if tracemalloc is not None:
+        tracemalloc.start()
+    else:
+        counts, rss = typecounts(), maxrss()
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        report = StringIO()
+        profile.dump_stats(prefix + '.prof')
+        stats = pstats.Stats(profile, stream=report)
+        stats.sort_stats('cumulative').print_stats(limit)
+        if tracemalloc is not None:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            report.write('Top allocation sites:\n')
+            for stat in snapshot.statistics('lineno')[:limit]:
+                report.write('%s\n' % stat)
+        else:
+            after = typecounts()
+            growth = sorted(((after[name] - counts.get(name, 0), name) for name in after),
+                            reverse=True)
+            report.write('Peak memory grew by %d kB\n' % (maxrss() - rss))
+            report.write('Largest growth in live objects, by type:\n')
+            for n, name in growth[:limit]:
+                if n <= 0:
+                    break
+                report.write('%10d  %s\n' % (n, name))
+        f = open(prefix + '.txt', 'w')
+        f.write(report.getvalue())
+        f.close()
+        log.info('Wrote profile to %s.prof and %s.txt', prefix, prefix)
+
+
 class DocX(object):
-    def __init__(self, filename = None):
-        self.verbose = True
-        self.log_file = sys.stderr
+    def __init__(self, filename = None, metrics = None, verbose = False,
+                 mapped = False):
+        ''' Opens the package filename (a path or a file object), or makes a
+        new document if it is None. With mapped set, a package on disk is
+        read through a memory mapping shared by every document opened from
+        it; see mappedfile(). '''
+        self._verbose = False
+        self.verbose = verbose
+        self.stats = RenderStats(metrics)
 
         self.relationships = relationshiplist()
         self.trees = {}
+        self.raw = {}       # XML parts not parsed yet, as bytes
         self.images = {}
         self.other = {}
         if filename:
             self.filename = filename
-            print "Opening file '%s'" % self.filename
+            log.info("Opening file '%s'", self.filename)
+            debug = log.isEnabledFor(logging.DEBUG)
             try:
-                doc = zipfile.ZipFile(self.filename) 
-                for name in doc.namelist():
-                    if name.endswith("xml") or name.endswith("rels"):
-                        self.log("\tAdding xml file %s to DocX object" % name)
-                        self.trees[name] = etree.fromstring(doc.read(name))
-                    elif name.endswith("jpeg") or name.endswith("png") or name.endswith("jpg"):
-                        # open the image and read its contents into memory
-                        self.log("\tAdding image: %s" % (name))
-                        self.images[name] = doc.read(name)
+                with self.stats.timer('load'):
+                    # Media in a package on disk is left there until it is
+                    # saved; from a file object it has to be read now
+                    path = stamp = None
+                    if not isinstance(self.filename, basestring):
+                        doc = zipfile.ZipFile(self.filename)
+                    elif mapped:
+                        source = mappedfile(self.filename)
+                        path, stamp = source.name, source.stamp
+                        doc = zipfile.ZipFile(source)
                     else:
-                        self.log("\tFound a file %s that we're not doing anything with" % name)
-                        self.other[name] = doc.read(name)
+                        path = os.path.abspath(self.filename)
+                        st = os.stat(path)
+                        stamp = (st.st_mtime, st.st_size)
+                        doc = zipfile.ZipFile(path)
+                    for name in doc.namelist():
+                        if name.endswith("xml") or name.endswith("rels"):
+                            if debug:
+                                log.debug("\tAdding xml file %s to DocX object", name)
+                            data = doc.read(name)
+                            if eagerparts.match(name):
+                                with self.stats.timer('parse/' + name, report = False):
+                                    self.trees[name] = etree.fromstring(data)
+                            else:
+                                self.raw[name] = data
+                        elif name.endswith("jpeg") or name.endswith("png") or name.endswith("jpg"):
+                            if debug:
+                                log.debug("\tAdding image: %s", name)
+                            if path is None:
+                                self.images[name] = doc.read(name)
+                            else:
+                                self.images[name] = ZipPart(path, doc.getinfo(name), stamp, mapped)
+                        else:
+                            if debug:
+                                log.debug("\tFound a file %s that we're not doing anything with", name)
+                            if path is None:
+                                self.other[name] = doc.read(name)
+                            else:
+                                self.other[name] = ZipPart(path, doc.getinfo(name), stamp, mapped)
+                    doc.close()
             except Exception as e:
-                print e
+                log.error("Couldn't open %s: %s", self.filename, e)
                 raise
         else:
             self.trees['word/document.xml'] = newdocument()
@@ -128,71 +328,225 @@ class DocX(object):
     def get_document(self):
         return self.trees['word/document.xml']
 
+    def copy(self, cls = None):
+        ''' Returns a copy of this document that can be changed without
+        affecting it, as an instance of cls (by default this object's class).
+        Parsed parts are deep copied; raw parts, images and other files are
+        strings that are never changed in place, so they are shared. '''
+        cls = cls or type(self)
+        dup = cls.__new__(cls)
+        dup.__dict__.update(self.__dict__)
+        dup.stats = RenderStats(self.stats.callback)
+        dup.relationships = [list(rel) for rel in self.relationships]
+        dup.trees = dict((name, tree if tree is None else deepcopy(tree))
+                         for name, tree in self.trees.items())
+        dup.raw = dict(self.raw)
+        dup.images = dict(self.images)
+        dup.other = dict(self.other)
+        dup.body = dup.get_document().xpath("/w:document/w:body", namespaces = nsprefixes)
+        dup.core_props = dict(self.core_props)
+        return dup
+
+    def get_tree(self, name):
+        ''' Returns the parsed tree of the XML part name, parsing it first if
+        it has only been read as bytes so far '''
+        if name not in self.trees:
+            data = self.raw.pop(name)
+            with self.stats.timer('parse/' + name, report = False):
+                self.trees[name] = etree.fromstring(data)
+        return self.trees[name]
+
+    def get_content_parts(self):
+        ''' Returns the names of the parts that hold document text: the main
+        document, then any headers, footers, footnotes and endnotes '''
+        names = [name for name in self.trees.keys() + self.raw.keys()
+                 if contentparts.match(name)]
+        return ['word/document.xml'] + sorted(names)
+
     def get_core_props(self):
         return self.core_props
 
+    def get_stats(self):
+        return self.stats
+
     def get_relationships(self):
         return self.trees['word/_rels/document.xml.rels']
 
     def set_image_relation(self, rel_id, image_path):
-        rels = self.trees['word/_rels/document.xml.rels']
-        # read image into memory
-        try:
-            img = open(image_path).read()
-        except Exception as e:
-            self.log("Error opening image %s: %s" % (image_path, e))
+        # the image is only read when the document is saved
+        if not os.path.isfile(image_path) or not os.access(image_path, os.R_OK):
+            log.error("Error opening image %s: can't read it", image_path)
             return
+        self.set_image_data(rel_id, image_path, FilePart(os.path.abspath(image_path)))
+
+    def set_image_data(self, rel_id, image_path, img):
+        ''' Points the image relationship rel_id at the image img (its bytes,
+        or a ZipPart or FilePart), stored under the file name of image_path '''
+        rels = self.trees['word/_rels/document.xml.rels']
         # fix the image path (e.g. "foo/bar/baz.jpg" -> "media/baz.jpg")
         image_path = "media/" + image_path.split('/')[-1]
         self.images["word/" + image_path] = img
         for rel in rels:
             if 'Id' in rel.attrib and rel.attrib['Id'] == rel_id:
-                self.log("%s was pointed at %s" % (rel_id, rel.attrib['Target']))
+                log.debug("%s was pointed at %s", rel_id, rel.attrib['Target'])
                 rel.attrib['Target'] = image_path
-                self.log('Now %s is pointing at %s' % (rel_id, image_path))
+                log.debug('Now %s is pointing at %s', rel_id, image_path)
                 return
         raise Exception('Relationship ID %s was not found!' % rel_id)
 
-    def save(self, output = None):
-        '''Save a modified document'''
-        assert os.path.isdir(template_dir)
+    def clean(self, coalesce = False):
+        ''' Cleans the document in place, also merging adjacent runs with the
+        same formatting if coalesce is set. See clean(). '''
+        clean(self.get_document(), coalesce)
+
+    def save(self, output = None, deterministic = False, timestamp = None):
+        '''Save a modified document
+
+        Parts are always written in the same order, with [Content_Types].xml
+        first. With deterministic set, zip entry dates and generated core
+        properties use a fixed timestamp instead of the current time, so
+        saving the same document twice gives byte-identical output. The
+        timestamp (seconds since the epoch) can also be given explicitly; in
+        deterministic mode it defaults to $SOURCE_DATE_EPOCH, or to the
+        earliest date a zip file can hold.
+
+        A file name is written to beside it first and renamed over it, so
+        the document can be saved over the package it was opened from.'''
         if output is None:
             output = self.filename
+        if deterministic and timestamp is None:
+            timestamp = int(os.environ.get('SOURCE_DATE_EPOCH', ZIP_EPOCH))
+        if not isinstance(output, basestring):
+            self.writepackage(output, timestamp)
+            self.stats.count('bytes_written', output.tell())
+        else:
+            # media still in the package is copied from it as it is saved,
+            # so the package can't be overwritten until it's all written
+            temp = output + '.tmp'
+            try:
+                self.writepackage(temp, timestamp)
+                os.rename(temp, output)
+            except:
+                if os.path.exists(temp):
+                    os.remove(temp)
+                raise
+            self.stats.count('bytes_written', os.path.getsize(output))
+            self.reopen(output)
+        log.info('Saved to: %r', output)
+        self.stats.report()
+
+    def writepackage(self, output, timestamp = None):
+        '''Write the package to output, a file name or file object'''
         docxfile = zipfile.ZipFile(output, mode='w', compression=zipfile.ZIP_DEFLATED)
 
         # set up the core properties if not already
         if self.trees['docProps/core.xml'] is None:
-            self.trees['docProps/core.xml'] = coreproperties(**self.get_core_props())
+            self.trees['docProps/core.xml'] = coreproperties(timestamp=timestamp,
+                                                             **self.get_core_props())
 
         # For some reason this version tag doesn't get appended automatically, so for the 
         # time being we're doing it manually...
         version_tag = "<?xml version=\"1.0\" encoding=\"UTF-8\" standalone=\"yes\"?>\r\n"
 
-        # Serialize our trees into out zip file
-        for filename in self.trees:
-            log.info('Saving XML file: %s' % filename)
-            treestring = version_tag + etree.tostring(self.trees[filename], pretty_print = True)
-            self.log('Saving %s' % (filename))
-            docxfile.writestr(filename, treestring)
-        for filename in self.images:
-            self.log("Saving image: %s" % filename)
-            docxfile.writestr(filename, self.images[filename])
-        for filename in self.other:
-            self.log("Saving other file: %s" % filename)
-            docxfile.writestr(filename, self.other[filename])
-        if self.verbose:
-            self.log("finished adding files. Archive now contains:")
-        if self.verbose:
-            docxfile.printdir()
-        self.log('Saved to: %r' % output)
-        docxfile.close()
-
-    def set_log_file(f):
-        self.log_file = f
-
-    def log(self, msg):
-        if self.verbose:
-            self.log_file.write(msg + "\n")
+        # Serialize our trees, images and other files into our zip file;
+        # each phase is reported once for the whole package
+        with self.stats.summed('serialize', 'compress'):
+            debug = log.isEnabledFor(logging.DEBUG)
+            for filename in partorder(self.trees.keys() + self.raw.keys() +
+                                      self.images.keys() + self.other.keys()):
+                if filename in self.trees:
+                    if debug:
+                        log.debug('Saving XML file: %s', filename)
+                    with self.stats.timer('serialize'):
+                        data = version_tag + etree.tostring(self.trees[filename], pretty_print = True)
+                elif filename in self.raw:
+                    # never parsed, so unchanged
+                    if debug:
+                        log.debug('Saving unparsed XML file: %s', filename)
+                    data = self.raw[filename]
+                elif filename in self.images:
+                    if debug:
+                        log.debug("Saving image: %s", filename)
+                    data = self.images[filename]
+                else:
+                    if debug:
+                        log.debug("Saving other file: %s", filename)
+                    data = self.other[filename]
+                with self.stats.timer('compress'):
+                    if isinstance(data, basestring):
+                        docxfile.writestr(makezipinfo(filename, timestamp), data)
+                    else:
+                        # a ZipPart or FilePart, streamed in
+                        data.write(docxfile, makezipinfo(filename, timestamp))
+            if debug:
+                log.debug("finished adding files. Archive now contains:\n%s",
+                          '\n'.join('%s\t%d' % (info.filename, info.file_size)
+                                    for info in docxfile.infolist()))
+            with self.stats.timer('compress'):
+                docxfile.close()
+
+    def reopen(self, path):
+        '''Point the media still read from the package at path, which has
+        just been replaced, at the same parts in the new package'''
+        path = os.path.abspath(path)
+        parts = [(name, part, files) for files in (self.images, self.other)
+                 for name, part in files.items()
+                 if isinstance(part, ZipPart) and part.path == path]
+        if not parts:
+            return
+        st = os.stat(path)
+        doc = zipfile.ZipFile(path)
+        try:
+            for name, part, files in parts:
+                files[name] = ZipPart(path, doc.getinfo(name), (st.st_mtime, st.st_size),
+                                      part.mapped)
+        finally:
+            doc.close()
+
+    def get_verbose(self):
+        return self._verbose
+
+    def set_verbose(self, verbose):
+        ''' Verbose documents log what they do to stderr '''
+        if verbose:
+            self.set_log_file(sys.stderr)
+        elif self._verbose:
+            self.set_log_file(None)
+        self._verbose = bool(verbose)
+
+    verbose = property(get_verbose, set_verbose)
+
+    def set_log_file(self, f, level = logging.INFO):
+        ''' Writes the log messages of this module, and of the module this
+        object's class comes from, at level and above to the file f. A file
+        of None stops writing them, once no other document wants them
+        written either, and puts the loggers back as they were. Logging is
+        global, so the messages of every document go to the latest file
+        given; applications that configure logging themselves don't need
+        this. '''
+        if f is None:
+            logowners.discard(self)
+            if logowners:
+                return
+        else:
+            logowners.add(self)
+        for name in set([__name__, type(self).__module__]):
+            logger = logging.getLogger(name)
+            if name in loghandlers:
+                handler, previous = loghandlers.pop(name)
+                logger.removeHandler(handler)
+                logger.setLevel(previous)
+            if f is not None:
+                handler = logging.StreamHandler(f)
+                handler.setFormatter(logging.Formatter('%(message)s'))
+                loghandlers[name] = (handler, logger.level)
+                logger.addHandler(handler)
+                logger.setLevel(level)
+
+    def log(self, msg, *args):
+        ''' Logs msg % args at INFO level; args are only formatted if the
+        message is actually written '''
+        log.info(msg, *args)
 
     def find_subelem(self, elem, name):
         ''' Given an etree graphic element, finds first subelement with given name '''
@@ -232,7 +586,7 @@ class DocX(object):
             try: 
                 return elem.attrib[pref]
             except KeyError:
-                print "Id tag found but no embed attribute"
+                log.debug("Id tag found but no embed attribute")
                 return None
         else:
             return None
@@ -243,7 +597,7 @@ class DocX(object):
             try:
                 return e.attrib['name']
             except KeyError:
-                print "Pic tag found but no name attribute"
+                log.debug("Pic tag found but no name attribute")
                 return None
         else:
             return None
@@ -270,8 +624,214 @@ path_to_description = ["graphicData", "wsp", "txbx", "txbxContent", "p", "r", "t
 path_to_id = ["graphicData", "pic", "blipFill", "blip"]
 path_to_picname = ["graphicData", "pic", "nvPicPr", "cNvPr"]
 
-def opendocx(file):
-    '''Open a docx file, return a document XML tree'''
+# XML parts that are parsed as soon as a document is opened. The rest are kept
+# as raw bytes until something asks for their tree with DocX.get_tree().
+eagerparts = re.compile(r'^(\[Content_Types\]\.xml|docProps/(core|app)\.xml|'
+                        r'word/document\.xml|.*\.rels)$')
+
+# Parts that can hold text to replace, besides the main document
+contentparts = re.compile(r'^word/(header\d*|footer\d*|footnotes|endnotes)\.xml$')
+
+
+def partorder(partnames):
+    '''Return package part names in the order they are written to a zip file.
+    [Content_Types].xml and the package relationships go first, as the Open
+    Packaging Conventions recommend, and everything else follows sorted by
+    name.'''
+    first = ['[Content_Types].xml', '_rels/.rels']
+    rest = sorted(name for name in partnames if name not in first)
+    return [name for name in first if name in partnames] + rest
+
+
+def makezipinfo(filename, timestamp=None):
+    '''Make the ZipInfo for a deflated package part. If timestamp is None the
+    entry is dated with the current local time, like ZipFile.writestr().'''
+    if timestamp is None:
+        date_time = time.localtime(time.time())[:6]
+    else:
+        date_time = time.gmtime(max(timestamp, ZIP_EPOCH))[:6]
+    zinfo = zipfile.ZipInfo(filename, date_time)
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.create_system = 3
+    zinfo.external_attr = 0600 << 16L
+    return zinfo
+
+
+# Bytes read at a time when copying media into a package
+CHUNK_SIZE = 1 << 16
+
+
+def readchunks(f, size):
+    '''Yield the next size bytes of the file f, a chunk at a time'''
+    while size > 0:
+        chunk = f.read(min(size, CHUNK_SIZE))
+        if not chunk:
+            raise IOError('%s ended early' % getattr(f, 'name', 'file'))
+        size -= len(chunk)
+        yield chunk
+
+
+def writeentry(docxfile, zinfo, chunks):
+    '''Write an entry to the ZipFile docxfile whose CRC, sizes and compression
+    are already set in zinfo, taking its (compressed) data from chunks'''
+    zinfo.flag_bits = 0
+    zinfo.header_offset = docxfile.fp.tell()
+    docxfile._writecheck(zinfo)
+    docxfile._didModify = True
+    docxfile.fp.write(zinfo.FileHeader())
+    for chunk in chunks:
+        docxfile.fp.write(chunk)
+    docxfile.filelist.append(zinfo)
+    docxfile.NameToInfo[zinfo.filename] = zinfo
+
+
+# Memory mapped packages, by absolute path: (mtime, size) and the mapping
+mappings = {}
+
+
+class MappedFile(object):
+    '''A read only file object over a memory mapped file, with a position of
+    its own, so that any number of them can share one mapping'''
+    def __init__(self, mapping, name, stamp):
+        self.mapping = mapping
+        self.name = name
+        self.stamp = stamp
+        self.pos = 0
+
+    def read(self, size = -1):
+        end = len(self.mapping)
+        if size is not None and size >= 0:
+            end = min(self.pos + size, end)
+        data = self.mapping[self.pos:end]
+        self.pos = max(self.pos, end)
+        return data
+
+    def seek(self, offset, whence = 0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += len(self.mapping)
+        self.pos = offset
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        pass  # the mapping is shared, and unmapped once nothing uses it
+
+
+def mappedfile(path):
+    '''Return a MappedFile reading the file path. The file is mapped into
+    memory the first time, and again only once it has changed, so opening
+    it again costs just a stat() and the mapped pages are shared with every
+    other process reading it. A mapped file must be replaced by renaming a
+    new file over it, never rewritten in place.'''
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    cached = mappings.get(path)
+    if cached is None or cached[0] != (st.st_mtime, st.st_size):
+        f = open(path, 'rb')
+        try:
+            st = os.fstat(f.fileno())
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        cached = mappings[path] = ((st.st_mtime, st.st_size), mapping)
+    return MappedFile(cached[1], path, cached[0])
+
+
+class ZipPart(object):
+    '''A part of a package on disk that is only read when it is needed.
+    Saving copies its compressed bytes straight into the new package. The
+    package must not change until the document using it is saved. With
+    mapped set, the package is read through mappedfile().'''
+    def __init__(self, path, info, stamp, mapped = False):
+        self.path = path
+        self.info = info
+        self.stamp = stamp  # (mtime, size) of the package when opened
+        self.mapped = mapped
+
+    def open(self):
+        if self.mapped:
+            f = mappedfile(self.path)
+            stamp = f.stamp
+        else:
+            f = open(self.path, 'rb')
+            st = os.fstat(f.fileno())
+            stamp = (st.st_mtime, st.st_size)
+        if stamp != self.stamp:
+            f.close()
+            raise Exception('%s has changed since it was opened' % self.path)
+        return f
+
+    def read(self):
+        '''Return the uncompressed bytes of the part'''
+        f = self.open()
+        try:
+            return zipfile.ZipFile(f).read(self.info.filename)
+        finally:
+            f.close()
+
+    def write(self, docxfile, zinfo):
+        '''Copy the part into the ZipFile docxfile, as zinfo'''
+        info = self.info
+        if info.flag_bits & 0x1:
+            raise Exception('%s in %s is encrypted' % (info.filename, self.path))
+        f = self.open()
+        try:
+            f.seek(info.header_offset)
+            header = f.read(30)
+            if header[:4] != 'PK\003\004':
+                raise zipfile.BadZipfile('Bad local header for %s in %s' %
+                                         (info.filename, self.path))
+            namelength, extralength = struct.unpack('<HH', header[26:30])
+            f.seek(info.header_offset + 30 + namelength + extralength)
+            zinfo.compress_type = info.compress_type
+            zinfo.CRC = info.CRC
+            zinfo.compress_size = info.compress_size
+            zinfo.file_size = info.file_size
+            writeentry(docxfile, zinfo, readchunks(f, info.compress_size))
+        finally:
+            f.close()
+
+
+class FilePart(object):
+    '''A file to store as a part of a package, only read while saving'''
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        f = open(self.path, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def write(self, docxfile, zinfo):
+        '''Store the file in the ZipFile docxfile, as zinfo. It is stored
+        without compression, since images are compressed already; reading
+        it twice, for the CRC and then the data, means it never has to be
+        held in memory.'''
+        f = open(self.path, 'rb')
+        try:
+            size = os.fstat(f.fileno()).st_size
+            crc = 0
+            for chunk in readchunks(f, size):
+                crc = zlib.crc32(chunk, crc)
+            zinfo.compress_type = zipfile.ZIP_STORED
+            zinfo.CRC = crc & 0xffffffff
+            zinfo.compress_size = zinfo.file_size = size
+            f.seek(0)
+            writeentry(docxfile, zinfo, readchunks(f, size))
+        finally:
+            f.close()
+
+
+def opendocx(file, mapped = False):
+    '''Open a docx file, return a document XML tree. With mapped set, the
+    file is read through a shared memory mapping; see mappedfile().'''
+    if mapped:
+        file = mappedfile(file)
     mydoc = zipfile.ZipFile(file)
     xmlcontent = mydoc.read('word/document.xml')
     document = etree.fromstring(xmlcontent)
@@ -462,7 +1022,7 @@ def contenttypes():
                                   'ment.wordprocessingml.styles+xml',
         '/word/webSettings.xml':  'application/vnd.openxmlformats-officedocu'
                                   'ment.wordprocessingml.webSettings+xml'}
-    for part in parts:
+    for part in sorted(parts):
         types.append(makeelement('Override', nsprefix=None,
                                  attributes={'PartName': part,
                                              'ContentType': parts[part]}))
@@ -473,7 +1033,7 @@ def contenttypes():
                  'png':  'image/png',
                  'rels': 'application/vnd.openxmlformats-package.relationships+xml',
                  'xml':  'application/xml'}
-    for extension in filetypes:
+    for extension in sorted(filetypes):
         types.append(makeelement('Default', nsprefix=None,
                                  attributes={'Extension': extension,
                                              'ContentType': filetypes[extension]}))
@@ -674,12 +1234,89 @@ def make_row(contentrow, colw = None, cwunit = "dxa", celstyle = None,
         i += 1
     return row
 
+texttag = '{%s}t' % nsprefixes['w']
+
+def make_rows(contentrows, **kwargs):
+    '''Yield make_row(contentrow, **kwargs) for each of contentrows. A row
+    whose cells are all strings is copied from the last such row made,
+    with its text changed, which is much faster than making it again.'''
+    prototype = None
+    width = None
+    for contentrow in contentrows:
+        plain = all(isinstance(content, basestring) for content in contentrow)
+        if plain and prototype is not None and len(contentrow) == width:
+            row = deepcopy(prototype)
+            for t, content in zip(row.iter(texttag), contentrow):
+                t.text = content or None
+            yield row
+            continue
+        row = make_row(contentrow, **kwargs)
+        if plain:
+            prototype, width = row, len(contentrow)
+        yield row
+
+# Empty paragraphs copied by buildbody(), by (style, alignment)
+paraprototypes = {}
+
+def buildbody(body, items):
+    '''Append many paragraphs and tables to body at once, much faster than
+    appending paragraph() and heading() elements one by one.
+
+    Each item is one of:
+      (style, text) or (style, text, jc)  a paragraph with a single run;
+                                          jc defaults to 'left', and None
+                                          leaves it out, as heading() does
+      a dict                              a table, made by passing the dict
+                                          as keyword arguments to table()
+                                          (e.g. {'contents': rows})
+      an element                          appended as it is
+
+    The paragraphs are the same as paragraph(text, style, jc=jc) makes,
+    but rather than building each from scratch, a prototype is made once
+    per style and alignment and copied. Returns the number of items.'''
+    count = 0
+    append = body.append
+    for item in items:
+        count += 1
+        if isinstance(item, tuple):
+            style, text = item[:2]
+            jc = item[2] if len(item) > 2 else 'left'
+            prototype = paraprototypes.get((style, jc))
+            if prototype is None:
+                prototype = makeelement('p')
+                pPr = makeelement('pPr')
+                pPr.append(makeelement('pStyle', attributes={'val': style}))
+                if jc is not None:
+                    pPr.append(makeelement('jc', attributes={'val': jc}))
+                prototype.append(pPr)
+                run = makeelement('r')
+                run.append(makeelement('rPr'))
+                run.append(makeelement('t'))
+                prototype.append(run)
+                paraprototypes[(style, jc)] = prototype
+            para = deepcopy(prototype)
+            if text:
+                para[1][1].text = text
+            append(para)
+        elif isinstance(item, dict):
+            append(table(**item))
+        else:
+            append(item)
+    return count
+
 def picture(relationshiplist, picname, picdescription, pixelwidth=None, pixelheight=None, nochangeaspect=True, nochangearrowheads=True):
     '''Take a relationshiplist, picture file name, and return a paragraph containing the image
     and an updated relationshiplist'''
     # http://openxmldeveloper.org/articles/462.aspx
     # Create an image. Size may be specified, otherwise it will based on the
     # pixel size of image. Return a paragraph containing the picture'''
+    # PIL and shutil are only needed here, so they are imported here to keep
+    # importing docx fast
+    import shutil
+    try:
+        from PIL import Image
+    except ImportError:
+        import Image
     # Copy the file into the media dir
     media_dir = join(template_dir, 'word', 'media')
     if not os.path.isdir(media_dir):
@@ -803,26 +1440,98 @@ def replace(document, search, replace):
     return newdocument
 
 
-def clean(document):
+def clean(document, coalesce=False):
     """ Perform misc cleaning operations on documents.
+        Empty text and run elements are removed. With coalesce set, adjacent
+        runs that have identical run properties and only hold text are also
+        merged into one, along with the proofing marks Word leaves between
+        them, so text that was split across runs (like a @placeholder@)
+        ends up in a single text element. This shrinks templates a lot, so
+        it is worth doing once when a template is prepared.
         Returns cleaned document.
     """
 
     newdocument = document
-
-    # Clean empty text and r tags
-    for t in ('t', 'r'):
-        rmlist = []
-        for element in newdocument.iter():
-            if element.tag == '{%s}%s' % (nsprefixes['w'], t):
-                if not element.text and not len(element):
-                    rmlist.append(element)
-        for element in rmlist:
+    rtag = '{%s}r' % nsprefixes['w']
+    ttag = '{%s}t' % nsprefixes['w']
+    prooftag = '{%s}proofErr' % nsprefixes['w']
+
+    # Work backwards, so text elements are cleaned before their runs, and
+    # runs emptied that way go in the same pass
+    for element in reversed(list(newdocument.iter(rtag, ttag))):
+        if not element.text and not len(element):
             element.getparent().remove(element)
+    if not coalesce:
+        return newdocument
+
+    # The runs merged together are siblings, so they are also next to each
+    # other in document order; each run's properties are serialized once
+    runs = list(newdocument.iter(rtag))
+    keys = [runkey(run) for run in runs]
+    count = len(runs)
+    i = 0
+    while i < count:
+        key = keys[i]
+        j = i + 1
+        marks = []
+        if key is not None:
+            nextrun = runs[i].getnext()
+            between = []
+            while nextrun is not None:
+                if nextrun.tag == prooftag:
+                    between.append(nextrun)
+                elif j < count and nextrun is runs[j] and keys[j] == key:
+                    marks.extend(between)
+                    between = []
+                    j += 1
+                else:
+                    break
+                nextrun = nextrun.getnext()
+        if j > i + 1:
+            for mark in marks:
+                mark.getparent().remove(mark)
+            mergeruns(runs[i:j])
+        i = j
 
     return newdocument
 
 
+runproptag = '{%s}rPr' % nsprefixes['w']
+
+def runkey(run):
+    '''Return what a run that only holds run properties and text has to
+    match in another run for the two to be merged, or None for any other
+    run'''
+    rPr = None
+    for child in run:
+        if child.tag == runproptag:
+            rPr = child
+        elif child.tag != texttag:
+            return None
+    if rPr is None or not len(rPr) and not rPr.attrib:
+        return ''  # the same as no properties at all
+    return etree.tostring(rPr)
+
+
+def mergeruns(runs):
+    '''Move the text of the rest of runs to the end of the first, and
+    remove them'''
+    run = runs[0]
+    texts = [t for each in runs for t in each.iterchildren(texttag)]
+    if texts:
+        first = texts[0]
+        first.text = u''.join(t.text or u'' for t in texts)
+        first.set('{http://www.w3.org/XML/1998/namespace}space', 'preserve')
+        if first.getparent() is not run:
+            run.append(first)
+        for t in texts[1:]:
+            if t.getparent() is run:
+                run.remove(t)
+    parent = run.getparent()
+    for each in runs[1:]:
+        parent.remove(each)
+
+
 def findTypeParent(element, tag):
     """ Finds fist parent of element of the given type
 
@@ -959,7 +1668,7 @@ def advReplace(document, search, replace, bs=3):
 
     """
     # Enables debug output
-    DEBUG = False
+    DEBUG = log.isEnabledFor(logging.DEBUG)
 
     newdocument = document
 
@@ -1018,7 +1727,7 @@ def advReplace(document, search, replace, bs=3):
                                     elif isinstance(replace(list, tuple)):
                                         log.debug("Will replace with LIST OF ELEMENTS")
                                     else:
-                                        log.debug("Will replace with:", re.sub(search, replace, txtsearch))
+                                        log.debug("Will replace with: %s", re.sub(search, replace, txtsearch))
 
                                 curlen = 0
                                 replaced = False
@@ -1052,35 +1761,95 @@ def advReplace(document, search, replace, bs=3):
     return newdocument
 
 
+def getparagraphtext(para):
+    '''Return the raw text of a paragraph element. A single sentence might
+    be spread over multiple text elements, so all text (t) and tab elements
+    under the paragraph are joined in document order.'''
+    pieces = []
+    for element in para.iter('{'+nsprefixes['w']+'}t', '{'+nsprefixes['w']+'}tab'):
+        if element.tag == '{'+nsprefixes['w']+'}t':
+            if element.text:
+                pieces.append(element.text)
+        else:
+            pieces.append(u'\t')
+    return u''.join(pieces)
+
+
 def getdocumenttext(document):
     '''Return the raw text of a document, as a list of paragraphs.'''
     paratextlist = []
-    # Compile a list of all paragraph (p) elements
-    paralist = []
-    for element in document.iter():
-        # Find p (paragraph) elements
-        if element.tag == '{'+nsprefixes['w']+'}p':
-            paralist.append(element)
-    # Since a single sentence might be spread over multiple text elements, iterate through each
-    # paragraph, appending all text (t) children to that paragraphs text.
-    for para in paralist:
-        paratext = u''
-        # Loop through each paragraph
-        for element in para.iter():
-            # Find t (text) elements
-            if element.tag == '{'+nsprefixes['w']+'}t':
-                if element.text:
-                    paratext = paratext+element.text
-            elif element.tag == '{'+nsprefixes['w']+'}tab':
-                paratext = paratext + '\t'
+    for para in document.iter('{'+nsprefixes['w']+'}p'):
+        paratext = getparagraphtext(para)
         # Add our completed paragraph text to the list of paragraph text
         if not len(paratext) == 0:
             paratextlist.append(paratext)
     return paratextlist
 
 
+def getdocumenttables(document):
+    '''Return the raw text of every table in a document, as a list of
+    tables. Each table is a list of rows, and each row a list of cell texts,
+    with the paragraphs of a cell joined by newlines. Nested tables are
+    listed separately after the table that contains them.'''
+    tables = []
+    for tbl in document.iter('{'+nsprefixes['w']+'}tbl'):
+        rows = []
+        for tr in tbl.iterchildren('{'+nsprefixes['w']+'}tr'):
+            cells = []
+            for tc in tr.iterchildren('{'+nsprefixes['w']+'}tc'):
+                paras = tc.iterchildren('{'+nsprefixes['w']+'}p')
+                cells.append(u'\n'.join(getparagraphtext(p) for p in paras))
+            rows.append(cells)
+        tables.append(rows)
+    return tables
+
+
+def iterdocumenttext(file):
+    '''Return an iterator over the raw text of a docx file, one paragraph
+    at a time.
+
+    Gives the same paragraphs as getdocumenttext(opendocx(file)), but
+    word/document.xml is parsed incrementally straight from the zip file, so
+    memory use stays flat however large the document is.'''
+    mydoc = zipfile.ZipFile(file)
+    xmlfile = mydoc.open('word/document.xml')
+    mydoc.close()
+    return iterparagraphtext(xmlfile)
+
+
+def iterparagraphtext(xmlfile):
+    '''Parse an XML file object incrementally and yield the raw text of each
+    non-empty paragraph. Every paragraph is discarded once its text has been
+    yielded, along with everything before it. The file is closed when the
+    iteration finishes.'''
+    ptag = '{'+nsprefixes['w']+'}p'
+    depth = 0
+    try:
+        for event, element in etree.iterparse(xmlfile, events=('start', 'end'), tag=ptag):
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            if depth:
+                # Paragraphs nested in text boxes are handled with the
+                # outermost paragraph, to keep document order
+                continue
+            for para in element.iter(ptag):
+                paratext = getparagraphtext(para)
+                if not len(paratext) == 0:
+                    yield paratext
+            element.clear()
+            for node in [element] + list(element.iterancestors()):
+                while node.getprevious() is not None:
+                    del node.getparent()[0]
+    finally:
+        xmlfile.close()
+
+
 def coreproperties(**kwargs):
     '''Create core properties (common document properties referred to in the 'Dublin Core' specification).
+    The created and modified times are taken from the 'timestamp' argument
+    (seconds since the epoch) if given, otherwise from the current time.
     See appproperties() for other stuff.'''
     coreprops = makeelement('coreProperties', nsprefix='cp')
     for s in ['title', 'subject', 'creator']:
@@ -1095,7 +1864,10 @@ def coreproperties(**kwargs):
     coreprops.append(makeelement('revision', tagtext='1', nsprefix='cp'))
     coreprops.append(makeelement('category', tagtext='Examples', nsprefix='cp'))
     coreprops.append(makeelement('description', tagtext='Examples', nsprefix='dc'))
-    currenttime = time.strftime('%Y-%m-%dT%H:%M:%SZ')
+    if kwargs.get('timestamp') is not None:
+        currenttime = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(kwargs['timestamp']))
+    else:
+        currenttime = time.strftime('%Y-%m-%dT%H:%M:%SZ')
     # Document creation and modify times
     # Prob here: we have an attribute who name uses one namespace, and that
     # attribute's value uses another namespace.
@@ -1134,7 +1906,7 @@ def appproperties():
          'SharedDoc':            'false',
          'HyperlinksChanged':    'false',
          'AppVersion':           '12.0000'}
-    for prop in props:
+    for prop in sorted(props):
         appprops.append(makeelement(prop, tagtext=props[prop], nsprefix=None))
     return appprops
 
@@ -1202,7 +1974,7 @@ def savedocx(document, coreprops, appprops, contenttypes, websettings, wordrelat
                      websettings:  'word/webSettings.xml',
                      wordrelationships: 'word/_rels/document.xml.rels'}
     for tree in treesandfiles:
-        log.info('Saving: %s' % treesandfiles[tree])
+        log.info('Saving: %s', treesandfiles[tree])
         treestring = etree.tostring(tree, pretty_print=True)
         docxfile.writestr(treesandfiles[tree], treestring)
 
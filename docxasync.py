@@ -0,0 +1,213 @@
+"""
+Render documents with DocXReplace without blocking the caller.
+
+AsyncRenderer.render() returns at once with a RenderResult. The template,
+the JSON payload (if it is a file) and the replacement images are read by
+a pool of I/O threads, so reads for different requests overlap. The
+replacements and saving run in a pool of worker processes, so they don't
+hold the caller's interpreter lock. The output file is written by the I/O
+threads again. At most max_renders documents are being read or rendered at
+once; further requests wait in the I/O threads' queue, so a burst of
+requests never blocks the caller. If validation is asked for and the
+template has been compiled (see compile_template.py), the payload is
+checked against its manifest first, and one that doesn't fit fails with a
+PayloadError without being rendered.
+
+The result can be waited for with RenderResult.get(), or a callback can be
+given, which is called with the RenderResult once it is ready. Callbacks
+run in one of the renderer's threads, so an event loop should hand the
+result over to its own thread, e.g. with Tornado's IOLoop.add_callback()
+or Twisted's reactor.callFromThread().
+
+Part of Python's docx module - http://github.com/mikemaccana/python-docx
+See LICENSE for licensing information.
+"""
+
+import cPickle as pickle
+import json
+import logging
+import os
+import threading
+from multiprocessing import Pool, TimeoutError, cpu_count
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+
+from docx import NullHandler
+from docxreplace import DocXReplace, PayloadError, load_manifest, validate_payload
+
+log = logging.getLogger(__name__)
+log.addHandler(NullHandler())
+
+
+def readfile(path):
+    f = open(path, 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def renderbytes(template, payload, images):
+    '''Fill a template given as bytes with a payload dict, using images (a
+    dict of image path to bytes) instead of reading the image files. Runs
+    in a worker process; returns (docx bytes, None), or (None, exception) if
+    rendering failed. An exception that doesn't survive pickling, such as
+    lxml's parse errors, is returned as a plain Exception with the same
+    message, since the pool couldn't send it back.'''
+    try:
+        dx = DocXReplace(StringIO(template), dic = payload)
+        dx.image_data = images
+        output = StringIO()
+        dx.render(output)
+        return output.getvalue(), None
+    except Exception as e:
+        try:
+            pickle.loads(pickle.dumps(e, 2))
+        except Exception:
+            e = Exception('%s: %s' % (type(e).__name__, e))
+        return None, e
+
+
+class RenderResult(object):
+    ''' The outcome of AsyncRenderer.render(): the .docx bytes, or for a
+    render to a file, the file name '''
+    def __init__(self, callback = None):
+        self.callback = callback
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+    def ready(self):
+        return self.event.is_set()
+
+    def successful(self):
+        assert self.ready()
+        return self.error is None
+
+    def wait(self, timeout = None):
+        self.event.wait(timeout)
+
+    def get(self, timeout = None):
+        ''' Waits for the render to finish and returns its value, or raises
+        the exception it failed with '''
+        self.wait(timeout)
+        if not self.ready():
+            raise TimeoutError()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def finish(self, value = None, error = None):
+        self.value = value
+        self.error = error
+        self.event.set()
+        if self.callback is not None:
+            try:
+                self.callback(self)
+            except Exception:
+                log.exception('Render callback failed')
+
+
+class AsyncRenderer(object):
+    ''' Renders documents in the background. See the module documentation. '''
+    def __init__(self, processes = None, threads = 8, max_renders = None):
+        processes = processes or cpu_count()
+        self.pool = Pool(processes)
+        self.io = ThreadPool(threads)
+        self.slots = threading.BoundedSemaphore(max_renders or 2 * processes)
+        self.pending = 0
+        self.idle = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def render(self, template, payload, output = None, callback = None, validate = False):
+        ''' Starts filling the template file with payload, which is either a
+        dict like DocXReplace takes or the name of a JSON file holding one.
+        The document is written to the file output, or if that is None,
+        becomes the value of the RenderResult returned. With validate set,
+        the payload is checked against the template's manifest first. '''
+        def finished(result):
+            with self.idle:
+                self.pending -= 1
+                self.idle.notify_all()
+            if callback is not None:
+                callback(result)
+        with self.idle:
+            self.pending += 1
+        result = RenderResult(finished)
+        self.io.apply_async(self.load, (template, payload, output, result, validate))
+        return result
+
+    def load(self, template, payload, output, result, validate):
+        # runs in an I/O thread
+        self.slots.acquire()
+        try:
+            data = readfile(template)
+            if isinstance(payload, basestring):
+                payload = json.loads(readfile(payload))
+            images = {}
+            for path in payload.get('images', {}).values():
+                try:
+                    images[path] = readfile(path)
+                except IOError:
+                    pass  # the render logs it, as DocXReplace always has
+            # a payload that doesn't fit a compiled template fails here,
+            # before it takes up a worker process
+            manifest = load_manifest(template) if validate else None
+            if manifest is not None:
+                problems = validate_payload(manifest, payload, images)
+                if problems:
+                    raise PayloadError(problems)
+        except Exception as e:
+            self.slots.release()
+            result.finish(error = e)
+            return
+
+        def rendered(outcome):
+            # runs in the process pool's result thread, which must not block
+            # or raise, or no later render would finish either
+            try:
+                docx, error = outcome
+                if error is not None:
+                    result.finish(error = error)
+                elif output is None:
+                    result.finish(docx)
+                else:
+                    self.io.apply_async(self.store, (docx, output, result))
+            except Exception:
+                log.exception('Handling a render failed')
+            finally:
+                self.slots.release()
+        self.pool.apply_async(renderbytes, (data, payload, images), callback = rendered)
+
+    def store(self, docx, output, result):
+        # runs in an I/O thread
+        try:
+            f = open(output + '.tmp', 'wb')
+            try:
+                f.write(docx)
+            finally:
+                f.close()
+            os.rename(output + '.tmp', output)
+        except Exception as e:
+            result.finish(error = e)
+            return
+        result.finish(output)
+
+    def close(self):
+        ''' Waits for every render started to finish and stops the pools '''
+        with self.idle:
+            while self.pending:
+                self.idle.wait()
+        self.io.close()
+        self.io.join()
+        self.pool.close()
+        self.pool.join()
+
+    ###########################
+    # end class AsyncRenderer #
+    ###########################
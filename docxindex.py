@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+"""
+An on-disk inverted index over the paragraph text of many docx files.
+
+search() and AdvSearch() in the docx module answer questions about one
+parsed document; this module answers "which paragraphs of which documents
+mention this" across a whole corpus without reparsing it. Terms map to
+postings of (document, paragraph index) pairs, where paragraph indexes count
+the non-empty paragraphs returned by getdocumenttext().
+
+The index is a directory holding a document table and a series of immutable
+segment files. Each batch of added documents is written as a new segment;
+documents that change are simply indexed again under a new id and their old
+postings are ignored until optimize() merges the segments. A segment holds a
+zlib compressed, delta encoded postings list per term followed by a term
+dictionary, so a lookup reads only the postings of the terms it needs.
+
+Usage:
+  docxindex.py build INDEX [directory|file ...]
+  docxindex.py import INDEX corpus.jsonl
+  docxindex.py search INDEX [-r REGEX] [-p] term ...
+  docxindex.py optimize INDEX
+
+Part of Python's docx module - http://github.com/mikemaccana/python-docx
+See LICENSE for licensing information.
+"""
+
+import cPickle as pickle
+import json
+import logging
+import marshal
+import os
+import re
+import struct
+import sys
+import zlib
+from array import array
+from os.path import join
+
+from docx import iterdocumenttext
+
+log = logging.getLogger(__name__)
+
+SEGMENT_MAGIC = 'DOCXIDX1'
+
+wordre = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    '''Split text into the lower case terms that are indexed'''
+    return [word.lower().encode('utf-8') for word in wordre.findall(text)]
+
+
+def encodepostings(postings):
+    '''Compress a flat array of (doc id, paragraph) pairs, sorted by doc id'''
+    deltas = array('I', postings)
+    for i in range(len(deltas) - 2, 0, -2):
+        deltas[i] -= deltas[i - 2]
+    if sys.byteorder == 'big':
+        deltas.byteswap()
+    return zlib.compress(deltas.tostring())
+
+
+def decodepostings(data):
+    '''Undo encodepostings()'''
+    postings = array('I')
+    postings.fromstring(zlib.decompress(data))
+    if sys.byteorder == 'big':
+        postings.byteswap()
+    for i in range(2, len(postings), 2):
+        postings[i] += postings[i - 2]
+    return postings
+
+
+def writesegment(filename, terms):
+    '''Write a segment file from an iterable of (term, encoded postings) in
+    term order'''
+    termdict = {}
+    f = open(filename + '.tmp', 'wb')
+    f.write(SEGMENT_MAGIC)
+    offset = len(SEGMENT_MAGIC)
+    for term, data in terms:
+        termdict[term] = (offset, len(data))
+        f.write(data)
+        offset += len(data)
+    f.write(marshal.dumps(termdict))
+    f.write(struct.pack('<Q', offset))
+    f.close()
+    os.rename(filename + '.tmp', filename)
+
+
+class DocIndex(object):
+    ''' Inverted index of the documents in a corpus, stored in directory '''
+    def __init__(self, directory, flush_postings = 2000000):
+        self.directory = directory
+        # Postings are written out as a new segment once this many are pending
+        self.flush_postings = flush_postings
+        self.docs = {}      # doc id -> (path, mtime, size)
+        self.ids = {}       # path -> doc id
+        self.next_id = 1
+        self.segments = []  # segment file names, oldest first
+        self.pending = {}   # term -> array of (doc id, paragraph) pairs
+        self.npending = 0
+        self.termdicts = {}
+        if os.path.exists(join(directory, 'docs')):
+            f = open(join(directory, 'docs'), 'rb')
+            self.docs, self.next_id, self.segments = pickle.load(f)
+            f.close()
+            for docid in self.docs:
+                self.ids[self.docs[docid][0]] = docid
+        elif not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __len__(self):
+        return len(self.docs)
+
+    def save(self):
+        ''' Writes pending postings and the document table to disk '''
+        self.flush()
+        f = open(join(self.directory, 'docs.tmp'), 'wb')
+        pickle.dump((self.docs, self.next_id, self.segments), f, 2)
+        f.close()
+        os.rename(join(self.directory, 'docs.tmp'), join(self.directory, 'docs'))
+
+    def flush(self):
+        ''' Writes pending postings to a new segment '''
+        if not self.pending:
+            return
+        name = self.newsegment()
+        pending = self.pending
+        writesegment(join(self.directory, name),
+                     ((term, encodepostings(pending[term])) for term in sorted(pending)))
+        self.segments.append(name)
+        self.pending = {}
+        self.npending = 0
+
+    def newsegment(self):
+        ''' Returns the file name for the next segment '''
+        if self.segments:
+            return 'seg%06d' % (int(self.segments[-1][3:]) + 1)
+        return 'seg000001'
+
+    def add_document(self, path, paragraphs, mtime = None, size = None):
+        ''' Indexes the paragraphs of a document, replacing any earlier version '''
+        path = os.path.abspath(path)
+        self.remove_document(path)
+        docid = self.next_id
+        self.next_id += 1
+        pending = self.pending
+        for i, paratext in enumerate(paragraphs):
+            for term in set(tokenize(paratext)):
+                if term not in pending:
+                    pending[term] = array('I')
+                pending[term].extend((docid, i))
+                self.npending += 1
+        self.docs[docid] = (path, mtime, size)
+        self.ids[path] = docid
+        if self.npending >= self.flush_postings:
+            self.flush()
+        return docid
+
+    def remove_document(self, path):
+        ''' Drops a document from the index. Its postings stay on disk, but
+        are ignored, until the next optimize() '''
+        docid = self.ids.pop(os.path.abspath(path), None)
+        if docid is not None:
+            del self.docs[docid]
+
+    def update(self, paths):
+        ''' Indexes the documents in paths that are new or have changed since
+        they were indexed, and drops those that no longer exist. Returns the
+        number of documents indexed. '''
+        count = 0
+        for path in paths:
+            path = os.path.abspath(path)
+            try:
+                st = os.stat(path)
+            except OSError as e:
+                log.warning("Couldn't index %s: %s", path, e)
+                self.remove_document(path)
+                continue
+            docid = self.ids.get(path)
+            if docid is not None and self.docs[docid][1:] == (st.st_mtime, st.st_size):
+                continue
+            try:
+                paragraphs = list(iterdocumenttext(path))
+            except Exception as e:
+                log.warning("Couldn't index %s: %s", path, e)
+                continue
+            self.add_document(path, paragraphs, st.st_mtime, st.st_size)
+            count += 1
+        return count
+
+    def update_from_corpus(self, jsonl):
+        ''' Indexes the records of a file written by extract_corpus.py.
+        Returns the number of documents indexed. '''
+        count = 0
+        f = open(jsonl)
+        for line in f:
+            record = json.loads(line)
+            if 'error' in record:
+                continue
+            path = record['path']
+            try:
+                st = os.stat(path)
+                mtime, size = st.st_mtime, st.st_size
+            except OSError:
+                mtime = size = None
+            self.add_document(path, record['paragraphs'], mtime, size)
+            count += 1
+        f.close()
+        return count
+
+    def prune(self):
+        ''' Drops documents whose files no longer exist. Returns how many. '''
+        gone = [path for path in self.ids if not os.path.exists(path)]
+        for path in gone:
+            self.remove_document(path)
+        return len(gone)
+
+    def termdict(self, segment):
+        if segment not in self.termdicts:
+            f = open(join(self.directory, segment), 'rb')
+            f.seek(-8, 2)
+            offset = struct.unpack('<Q', f.read(8))[0]
+            f.seek(offset)
+            self.termdicts[segment] = marshal.loads(f.read()[:-8])
+            f.close()
+        return self.termdicts[segment]
+
+    def segment_postings(self, segment, term):
+        entry = self.termdict(segment).get(term)
+        if entry is None:
+            return None
+        f = open(join(self.directory, segment), 'rb')
+        f.seek(entry[0])
+        data = f.read(entry[1])
+        f.close()
+        return data
+
+    def postings(self, term):
+        ''' Returns the set of (doc id, paragraph) pairs of the live documents
+        containing term '''
+        result = set()
+        chunks = [decodepostings(data) for data in
+                  (self.segment_postings(segment, term) for segment in self.segments)
+                  if data is not None]
+        if term in self.pending:
+            chunks.append(self.pending[term])
+        docs = self.docs
+        for postings in chunks:
+            for i in range(0, len(postings), 2):
+                if postings[i] in docs:
+                    result.add((postings[i], postings[i + 1]))
+        return result
+
+    def candidates(self, terms):
+        ''' Returns the (doc id, paragraph) pairs containing all of terms '''
+        result = None
+        for term in terms:
+            postings = self.postings(term)
+            result = postings if result is None else result & postings
+            if not result:
+                break
+        return result or set()
+
+    def lookup(self, term):
+        ''' Returns a sorted list of (path, paragraph index) for a term '''
+        terms = tokenize(term)
+        if len(terms) != 1:
+            raise ValueError("'%s' is not a single term" % term)
+        return sorted((self.docs[d][0], p) for d, p in self.postings(terms[0]))
+
+    def search(self, regex, terms, flags = re.UNICODE):
+        ''' Returns a sorted list of (path, paragraph index, paragraph text)
+        for paragraphs that contain all of terms and match regex. Only the
+        documents with candidate paragraphs are read to check the regex. '''
+        searchre = re.compile(regex, flags)
+        bydoc = {}
+        for docid, para in self.candidates(tokenize(u' '.join(terms))):
+            bydoc.setdefault(docid, set()).add(para)
+        results = []
+        for docid in bydoc:
+            path = self.docs[docid][0]
+            wanted = bydoc[docid]
+            last = max(wanted)
+            for i, paratext in enumerate(iterdocumenttext(path)):
+                if i in wanted and searchre.search(paratext):
+                    results.append((path, i, paratext))
+                if i >= last:
+                    break
+        results.sort()
+        return results
+
+    def phrase(self, text):
+        ''' Returns the paragraphs containing text as a phrase, ignoring case
+        and punctuation between words, in the same form as search() '''
+        words = wordre.findall(text)
+        if not words:
+            return []
+        regex = r'(?<!\w)' + r'\W+'.join(re.escape(w) for w in words) + r'(?!\w)'
+        return self.search(regex, words, re.IGNORECASE | re.UNICODE)
+
+    def optimize(self):
+        ''' Merges all segments into one, dropping the postings of removed
+        and reindexed documents '''
+        self.flush()
+        if not self.segments:
+            return
+        old = self.segments
+        terms = set()
+        for segment in old:
+            terms.update(self.termdict(segment))
+
+        def merged():
+            for term in sorted(terms):
+                postings = array('I')
+                for docid, para in sorted(self.postings(term)):
+                    postings.extend((docid, para))
+                if postings:
+                    yield term, encodepostings(postings)
+        name = self.newsegment()
+        writesegment(join(self.directory, name), merged())
+        self.segments = [name]
+        self.termdicts = {}
+        self.save()
+        for segment in old:
+            os.remove(join(self.directory, segment))
+
+    ######################
+    # end class DocIndex #
+    ######################
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    from extract_corpus import find_documents
+    parser = OptionParser(usage=__doc__.split('Usage:')[1].split('Part of')[0].rstrip())
+    parser.add_option('-r', '--regex', default=None,
+                      help='only show paragraphs that also match this regex')
+    parser.add_option('-p', '--phrase', action='store_true', default=False,
+                      help='search for the terms as a phrase')
+    options, args = parser.parse_args()
+    if len(args) < 2:
+        parser.error('Please supply a command and an index directory')
+    command, index = args[0], DocIndex(args[1])
+    if command == 'build':
+        count = index.update(find_documents(args[2:]))
+        pruned = index.prune()
+        index.save()
+        print "Indexed %d documents, dropped %d" % (count, pruned)
+    elif command == 'import':
+        count = index.update_from_corpus(args[2])
+        index.save()
+        print "Indexed %d documents" % count
+    elif command == 'search':
+        terms = [arg.decode('utf-8') for arg in args[2:]]
+        if options.phrase:
+            results = index.phrase(u' '.join(terms))
+        elif options.regex is not None:
+            results = index.search(options.regex.decode('utf-8'), terms)
+        else:
+            results = index.search(u'', terms)
+        for path, para, paratext in results:
+            print "%s:%d: %s" % (path, para, paratext.encode('utf-8'))
+    elif command == 'optimize':
+        index.optimize()
+    else:
+        parser.error('Unknown command %s' % command)
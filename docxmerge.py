@@ -0,0 +1,549 @@
+#!/usr/bin/env python
+"""
+Concatenate many docx files, such as the output of a mail merge, into one.
+
+The first document is the base of the result: its styles, settings, theme,
+headers, footers and properties are kept. The body of every other document
+is appended after a section break, so each document keeps its own page
+setup, and its sections use the headers and footers of the first document.
+What the appended content refers to is carried over:
+
+  relationships  images and other media are copied under new relationship
+                 ids, and media whose bytes are already in the result is
+                 shared instead; external links are added once each
+  styles         styles the result lacks are copied; a style whose id is
+                 taken by a different definition is copied under a new id
+  numbering      list definitions are shared when they are the same, but
+                 every document's lists get their own numbering instances,
+                 so they restart in each document
+  ids            drawing and bookmark ids are renumbered to stay unique
+
+Parts are compared by their CRC and size first, so a part is only read to
+compare its bytes when it might be a duplicate. Styles and numbering are
+looked up once for each distinct styles.xml and numbering.xml, which all
+the documents of a mail merge share. Documents are opened one at a time;
+once its references are mapped, each appended body is serialized to a
+temporary file and dropped, and its media stays on disk until the result
+is saved. The result's document.xml is compressed from that file while
+saving, so memory stays flat however many documents are merged.
+
+Headers, footers, footnotes, endnotes and comments of the appended
+documents are not carried over.
+
+Usage:
+  docxmerge.py [-l FILELIST] output.docx [input.docx ...]
+
+Part of Python's docx module - http://github.com/mikemaccana/python-docx
+See LICENSE for licensing information.
+"""
+
+import hashlib
+import logging
+import posixpath
+import sys
+import tempfile
+import zipfile
+import zlib
+from copy import deepcopy
+from optparse import OptionParser
+
+from lxml import etree
+
+from docx import (DocX, NullHandler, ZipPart, makeelement, nsprefixes, readchunks,
+                  writeentry)
+
+log = logging.getLogger(__name__)
+log.addHandler(NullHandler())
+
+W = '{%s}' % nsprefixes['w']
+R = '{%s}' % nsprefixes['r']
+PR = '{%s}' % nsprefixes['pr']
+CT = '{%s}' % nsprefixes['ct']
+DOCPR = '{%s}docPr' % nsprefixes['wp']
+
+NUMBERING_TYPE = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/numbering'
+NUMBERING_CONTENT_TYPE = ('application/vnd.openxmlformats-officedocument.'
+                          'wordprocessingml.numbering+xml')
+
+
+def digest(data):
+    return hashlib.sha1(data).digest()
+
+
+def partbytes(data):
+    '''Return the bytes of a part held as a string, ZipPart or FilePart'''
+    if isinstance(data, basestring):
+        return data
+    return data.read()
+
+
+def partkey(data):
+    '''Return (CRC, size) of a part, reading it only if it is in memory'''
+    if isinstance(data, ZipPart):
+        return data.info.CRC, data.info.file_size
+    data = partbytes(data)
+    return zlib.crc32(data) & 0xffffffff, len(data)
+
+
+def canonical(elem, strip = ()):
+    '''Return the canonical XML of elem without the attributes and children
+    named in strip, for comparing definitions from different documents'''
+    if strip:
+        elem = deepcopy(elem)
+        for name in strip:
+            if name in elem.attrib:
+                del elem.attrib[name]
+            for child in elem.findall(name):
+                elem.remove(child)
+    return etree.tostring(elem, method='c14n', exclusive=True)
+
+
+def partname(target):
+    '''Return the part name a relationship target of the main document
+    points at'''
+    if target.startswith('/'):
+        return posixpath.normpath(target[1:])
+    return posixpath.normpath(posixpath.join('word', target))
+
+
+# Every attribute in the relationships namespace, which all hold rIds
+relattributes = etree.XPath(".//@*[namespace-uri() = '%s']" % nsprefixes['r'])
+
+
+def rawpart(dx, name):
+    '''Return the bytes of the XML part name of dx, or None'''
+    if name in dx.raw:
+        return dx.raw[name]
+    if dx.trees.get(name) is not None:
+        return etree.tostring(dx.trees[name])
+    return None
+
+
+class SpooledPart(object):
+    '''A part to store in a package, made of strings and of the contents of
+    files, which is only read while saving'''
+    def __init__(self, pieces):
+        self.pieces = pieces
+
+    def chunks(self):
+        for piece in self.pieces:
+            if isinstance(piece, basestring):
+                yield piece
+            else:
+                piece.seek(0, 2)
+                size = piece.tell()
+                piece.seek(0)
+                for chunk in readchunks(piece, size):
+                    yield chunk
+
+    def write(self, docxfile, zinfo):
+        '''Store the part in the ZipFile docxfile, as zinfo. It is deflated
+        into a temporary file first, since the sizes and CRC have to be
+        written before the data.'''
+        compressed = tempfile.TemporaryFile()
+        try:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+            crc = size = 0
+            for chunk in self.chunks():
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                compressed.write(compressor.compress(chunk))
+            compressed.write(compressor.flush())
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            zinfo.CRC = crc & 0xffffffff
+            zinfo.file_size = size
+            zinfo.compress_size = compressed.tell()
+            compressed.seek(0)
+            writeentry(docxfile, zinfo, readchunks(compressed, zinfo.compress_size))
+        finally:
+            compressed.close()
+
+
+class DocXMerger(object):
+    ''' Appends the bodies of documents to the first one. See the module
+    documentation. '''
+    def __init__(self, first):
+        self.dx = DocX(first)
+        self.body = self.dx.body[0]
+        # the section the result ends with; appended bodies are spooled
+        self.sectpr = None
+        if len(self.body) and self.body[-1].tag == W + 'sectPr':
+            self.sectpr = self.body[-1]
+            self.body.remove(self.sectpr)
+        self.spool = tempfile.TemporaryFile()
+        self.nsmap = self.dx.get_document().nsmap
+        self.rels = self.dx.trees['word/_rels/document.xml.rels']
+        self.types = self.dx.trees['[Content_Types].xml']
+        self.relids = set(rel.get('Id') for rel in self.rels)
+        self.nextrel = 1
+        self.external = {}  # (type, target) -> rId
+        self.parts = {}     # (type, CRC, size) -> [[sha1 or None, data, rId], ...]
+        self.partnames = set(self.dx.trees.keys() + self.dx.raw.keys() +
+                             self.dx.images.keys() + self.dx.other.keys())
+        for rel in self.rels:
+            if rel.get('TargetMode') == 'External':
+                self.external[(rel.get('Type'), rel.get('Target'))] = rel.get('Id')
+                continue
+            name = partname(rel.get('Target'))
+            data = self.dx.images.get(name, self.dx.other.get(name))
+            if data is not None:
+                key = (rel.get('Type'),) + partkey(data)
+                self.parts.setdefault(key, []).append([None, data, rel.get('Id')])
+        self.docprid = max([int(e.get('id', 0)) for e in self.body.iter(DOCPR)] + [0])
+        self.bookmarkid = max([int(e.get(W + 'id', 0)) for e in self.body.iter(W + 'bookmarkStart')]
+                              + [0])
+        self.styles = None    # styleId -> canonical XML, of the result's styles
+        self.stylemaps = {}   # styles.xml sha1 -> {input styleId: result styleId}
+        self.numbering = None
+        self.abstracts = {}   # canonical XML -> result abstractNumId
+        self.nummaps = {}     # numbering.xml sha1 -> {input numId: (abstractNumId, num)}
+        self.nextnum = 1
+        self.count = 1
+
+    def newrelid(self):
+        while 'rId%d' % self.nextrel in self.relids:
+            self.nextrel += 1
+        relid = 'rId%d' % self.nextrel
+        self.relids.add(relid)
+        return relid
+
+    def addrel(self, reltype, target, external = False):
+        relid = self.newrelid()
+        rel = etree.SubElement(self.rels, PR + 'Relationship')
+        rel.set('Id', relid)
+        rel.set('Type', reltype)
+        rel.set('Target', target)
+        if external:
+            rel.set('TargetMode', 'External')
+        return relid
+
+    def contenttype(self, dx, name):
+        ''' Returns the content type dx gives the part name '''
+        ext = posixpath.splitext(name)[1][1:].lower()
+        default = None
+        for elem in dx.trees['[Content_Types].xml']:
+            if elem.tag == CT + 'Override' and elem.get('PartName') == '/' + name:
+                return elem.get('ContentType')
+            if elem.tag == CT + 'Default' and elem.get('Extension', '').lower() == ext:
+                default = elem.get('ContentType')
+        return default
+
+    def addcontenttype(self, name, contenttype):
+        ''' Makes sure the result gives the part name contenttype '''
+        ext = posixpath.splitext(name)[1][1:].lower()
+        for elem in self.types:
+            if elem.tag == CT + 'Default' and elem.get('Extension', '').lower() == ext:
+                if elem.get('ContentType') == contenttype:
+                    return
+        override = etree.SubElement(self.types, CT + 'Override')
+        override.set('PartName', '/' + name)
+        override.set('ContentType', contenttype)
+
+    def maprel(self, dx, rels, relid, relmap):
+        ''' Returns the id of the relationship in the result that stands for
+        the relationship relid of dx, adding it if need be '''
+        if relid in relmap:
+            return relmap[relid]
+        rel = rels.get(relid)
+        if rel is None:
+            raise Exception('Relationship %s not found in %s' % (relid, dx.filename))
+        reltype, target = rel.get('Type'), rel.get('Target')
+        if rel.get('TargetMode') == 'External':
+            key = (reltype, target)
+            if key not in self.external:
+                self.external[key] = self.addrel(reltype, target, True)
+            relmap[relid] = self.external[key]
+            return relmap[relid]
+        name = partname(target)
+        data = dx.images.get(name, dx.other.get(name))
+        if data is None:
+            raise Exception("Can't merge %s in %s, which isn't a media part"
+                            % (target, dx.filename))
+        directory, basename = posixpath.split(name)
+        if posixpath.join(directory, '_rels', basename + '.rels') in dx.raw:
+            raise Exception("Can't merge %s in %s, which has relationships of its own"
+                            % (target, dx.filename))
+        key = (reltype,) + partkey(data)
+        candidates = self.parts.setdefault(key, [])
+        if candidates:
+            sha1 = digest(partbytes(data))
+            for entry in candidates:
+                if entry[0] is None:
+                    entry[0] = digest(partbytes(entry[1]))
+                if entry[0] == sha1:
+                    self.dx.stats.count('parts_shared')
+                    relmap[relid] = entry[2]
+                    return entry[2]
+        newname = posixpath.join(directory, 'doc%d-%s' % (self.count, basename))
+        while newname in self.partnames:
+            newname = posixpath.join(directory, 'doc%d-%d-%s' % (self.count, len(self.partnames),
+                                                                 basename))
+        self.partnames.add(newname)
+        if name in dx.images:
+            self.dx.images[newname] = data
+        else:
+            self.dx.other[newname] = data
+        contenttype = self.contenttype(dx, name)
+        if contenttype is not None:
+            self.addcontenttype(newname, contenttype)
+        relmap[relid] = self.addrel(reltype, posixpath.relpath(newname, 'word'))
+        candidates.append([None, data, relmap[relid]])
+        return relmap[relid]
+
+    def stylemap(self, dx):
+        ''' Returns the mapping of style ids of dx to those of the result,
+        filled in by mapstyle(), shared by documents with the same styles '''
+        data = rawpart(dx, 'word/styles.xml')
+        if data is None:
+            return None, None
+        sha1 = digest(data)
+        if sha1 not in self.stylemaps:
+            self.stylemaps[sha1] = {}
+        return self.stylemaps[sha1], data
+
+    def resultstyles(self):
+        if self.styles is None:
+            self.styles = {}
+            if rawpart(self.dx, 'word/styles.xml') is not None:
+                for style in self.dx.get_tree('word/styles.xml').iter(W + 'style'):
+                    self.styles[style.get(W + 'styleId')] = canonical(style, [W + 'styleId'])
+        return self.styles
+
+    def mapstyle(self, instyles, styleid, stylemap):
+        ''' Returns the id in the result of the style styleid of the parsed
+        styles.xml instyles, copying the style (and the styles it is based
+        on) if the result doesn't have it '''
+        if styleid in stylemap:
+            return stylemap[styleid]
+        styles = self.resultstyles()
+        style = None
+        for elem in instyles.iter(W + 'style'):
+            if elem.get(W + 'styleId') == styleid:
+                style = elem
+                break
+        if style is None or self.dx.trees.get('word/styles.xml') is None:
+            stylemap[styleid] = styleid
+            return styleid
+        style = deepcopy(style)
+        based = style.find(W + 'basedOn')
+        if based is not None:
+            based.set(W + 'val', self.mapstyle(instyles, based.get(W + 'val'), stylemap))
+        for tag in ('next', 'link'):
+            elem = style.find(W + tag)
+            if elem is not None and elem.get(W + 'val') not in styles:
+                style.remove(elem)
+        key = canonical(style, [W + 'styleId'])
+        newid = None
+        if styles.get(styleid) == key:
+            newid = styleid
+        else:
+            for existing, existingkey in styles.items():
+                if existingkey == key:
+                    newid = existing
+                    break
+        if newid is None:
+            newid = styleid
+            n = 1
+            while newid in styles:
+                n += 1
+                newid = '%s%d' % (styleid, n)
+            style.set(W + 'styleId', newid)
+            self.dx.get_tree('word/styles.xml').append(style)
+            styles[newid] = key
+            self.dx.stats.count('styles_copied')
+        stylemap[styleid] = newid
+        return newid
+
+    def resultnumbering(self):
+        ''' Returns the result's numbering part, adding one if it has none '''
+        if self.numbering is None:
+            if rawpart(self.dx, 'word/numbering.xml') is None:
+                self.dx.trees['word/numbering.xml'] = makeelement('numbering')
+                self.addrel(NUMBERING_TYPE, 'numbering.xml')
+                self.addcontenttype('word/numbering.xml', NUMBERING_CONTENT_TYPE)
+            self.numbering = self.dx.get_tree('word/numbering.xml')
+            for abstract in self.numbering.iter(W + 'abstractNum'):
+                key = canonical(abstract, [W + 'abstractNumId', W + 'nsid', W + 'tmpl'])
+                self.abstracts.setdefault(key, abstract.get(W + 'abstractNumId'))
+            for num in self.numbering.iter(W + 'num'):
+                self.nextnum = max(self.nextnum, int(num.get(W + 'numId')) + 1)
+        return self.numbering
+
+    def nummap(self, dx):
+        ''' Returns the mapping of numIds of dx to (result abstractNumId,
+        num element), shared by documents with the same numbering '''
+        data = rawpart(dx, 'word/numbering.xml')
+        if data is None:
+            return {}
+        sha1 = digest(data)
+        if sha1 in self.nummaps:
+            return self.nummaps[sha1]
+        numbering = self.resultnumbering()
+        innumbering = etree.fromstring(data)
+        inabstracts = dict((abstract.get(W + 'abstractNumId'), abstract)
+                           for abstract in innumbering.iter(W + 'abstractNum'))
+        abstractids = [int(a.get(W + 'abstractNumId')) for a in numbering.iter(W + 'abstractNum')]
+        nums = numbering.findall(W + 'num')
+        mapping = {}
+        for num in innumbering.iter(W + 'num'):
+            abstract = inabstracts.get(num.find(W + 'abstractNumId').get(W + 'val'))
+            if abstract is None:
+                continue
+            key = canonical(abstract, [W + 'abstractNumId', W + 'nsid', W + 'tmpl'])
+            if key not in self.abstracts:
+                newid = str(max(abstractids + [-1]) + 1)
+                abstractids.append(int(newid))
+                abstract = deepcopy(abstract)
+                abstract.set(W + 'abstractNumId', newid)
+                # abstract definitions have to come before the numbering instances
+                if nums:
+                    nums[0].addprevious(abstract)
+                else:
+                    numbering.append(abstract)
+                self.abstracts[key] = newid
+            mapping[num.get(W + 'numId')] = (self.abstracts[key], num)
+        self.nummaps[sha1] = mapping
+        return mapping
+
+    def mapnum(self, numid, nummap, nums):
+        ''' Returns the numId in the result for the numId numid of the
+        document being appended, adding a numbering instance for it '''
+        if numid in nums:
+            return nums[numid]
+        if numid == '0' or numid not in nummap:
+            nums[numid] = numid
+            return numid
+        abstractid, num = nummap[numid]
+        num = deepcopy(num)
+        num.set(W + 'numId', str(self.nextnum))
+        num.find(W + 'abstractNumId').set(W + 'val', abstractid)
+        self.resultnumbering().append(num)
+        nums[numid] = str(self.nextnum)
+        self.nextnum += 1
+        return nums[numid]
+
+    def append(self, filename):
+        ''' Appends the body of the document filename after a section break '''
+        with self.dx.stats.timer('append', report = False):
+            dx = DocX(filename)
+            self.count += 1
+            rels = dict((rel.get('Id'), rel) for rel in dx.trees['word/_rels/document.xml.rels'])
+            body = dx.body[0]
+            sectpr = None
+            if len(body) and body[-1].tag == W + 'sectPr':
+                # left in the body until its references have been mapped too
+                sectpr = body[-1]
+            stylemap, stylesdata = self.stylemap(dx)
+            instyles = None
+            nummap = None
+            relmap = {}
+            nums = {}
+            # sections keep the first document's headers and footers
+            for elem in list(body.iter(W + 'headerReference', W + 'footerReference')):
+                elem.getparent().remove(elem)
+            for value in relattributes(body):
+                elem = value.getparent()
+                elem.set(value.attrname, self.maprel(dx, rels, value, relmap))
+            if stylemap is not None:
+                for elem in body.iter(W + 'pStyle', W + 'rStyle', W + 'tblStyle'):
+                    styleid = elem.get(W + 'val')
+                    if styleid not in stylemap:
+                        if instyles is None:
+                            instyles = etree.fromstring(stylesdata)
+                        self.mapstyle(instyles, styleid, stylemap)
+                    elem.set(W + 'val', stylemap[styleid])
+            for elem in body.iter(W + 'numId'):
+                if nummap is None:
+                    nummap = self.nummap(dx)
+                elem.set(W + 'val', self.mapnum(elem.get(W + 'val'), nummap, nums))
+            for elem in body.iter(DOCPR):
+                self.docprid += 1
+                elem.set('id', str(self.docprid))
+            bookmarks = 0
+            for elem in body.iter(W + 'bookmarkStart', W + 'bookmarkEnd'):
+                bookmarkid = int(elem.get(W + 'id')) + self.bookmarkid + 1
+                bookmarks = max(bookmarks, bookmarkid)
+                elem.set(W + 'id', str(bookmarkid))
+            for elem in body.iter(W + 'footnoteReference', W + 'endnoteReference',
+                                  W + 'commentReference'):
+                log.warning("Notes and comments of %s aren't merged", filename)
+                break
+            self.bookmarkid = max(self.bookmarkid, bookmarks)
+            if sectpr is not None:
+                body.remove(sectpr)
+            with self.dx.stats.timer('spool', report = False):
+                # the section the result ends with so far ends here now
+                if self.sectpr is not None:
+                    para = makeelement('p')
+                    pPr = makeelement('pPr')
+                    para.append(pPr)
+                    pPr.append(self.sectpr)
+                    self.spool.write(etree.tostring(para))
+                self.sectpr = sectpr
+                self.spool.write(self.serialize(dx, body))
+            self.dx.stats.count('documents_merged')
+
+    def serialize(self, dx, body):
+        ''' Returns the XML of the children of body, the body of dx '''
+        if not len(body):
+            return ''
+        nsmap = dx.get_document().nsmap
+        if any(self.nsmap.get(prefix) != uri for prefix, uri in nsmap.items()):
+            # the result's root doesn't declare every namespace, so each
+            # element declares its own
+            return ''.join(etree.tostring(elem) for elem in body)
+        # the namespaces are declared by the body's start tag
+        xml = etree.tostring(body)
+        return xml[xml.index('>') + 1:xml.rindex('</')]
+
+    def save(self, output, **kwargs):
+        ''' Saves the result to output, passing any other arguments on to
+        DocX.save() '''
+        document = self.dx.trees['word/document.xml']
+        marker = etree.Comment('docxmerge')
+        self.body.append(marker)
+        try:
+            xml = etree.tostring(document, pretty_print = True)
+        finally:
+            self.body.remove(marker)
+        head, tail = xml.split(etree.tostring(marker), 1)
+        if self.sectpr is not None:
+            tail = etree.tostring(self.sectpr) + tail
+        version_tag = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\r\n'
+        del self.dx.trees['word/document.xml']
+        self.dx.other['word/document.xml'] = SpooledPart([version_tag + head, self.spool, tail])
+        try:
+            self.dx.save(output, **kwargs)
+        finally:
+            del self.dx.other['word/document.xml']
+            self.dx.trees['word/document.xml'] = document
+
+    ########################
+    # end class DocXMerger #
+    ########################
+
+
+def concatenate(inputs, output, **kwargs):
+    '''Append the documents named in inputs, in order, into one and save it
+    to output. Returns the render stats of the result.'''
+    inputs = iter(inputs)
+    merger = DocXMerger(next(inputs))
+    merger.dx.stats.count('documents_merged')
+    with merger.dx.stats.timer('merge'):
+        for filename in inputs:
+            merger.append(filename)
+    merger.save(output, **kwargs)
+    return merger.dx.stats
+
+
+if __name__ == '__main__':
+    from extract_corpus import find_documents
+    parser = OptionParser(usage='%prog [-l FILELIST] output.docx [input.docx ...]')
+    parser.add_option('-l', '--list', dest='listfile', default=None,
+                      help="file listing one docx path per line, or '-' for stdin")
+    options, args = parser.parse_args()
+    inputs = find_documents(args[1:], options.listfile)
+    if not args or not inputs:
+        parser.error('Please supply an output file and some documents')
+    stats = concatenate(inputs, args[0])
+    sys.stderr.write('Merged %d documents\n' % stats.counters['documents_merged'])
@@ -1,67 +1,471 @@
-from docx import DocX, make_row
-import re, random, string
-import json
+from docx import (DocX, NullHandler, make_rows, makeelement, mappedfile, nsprefixes,
+                  profiled)
+from copy import deepcopy
+from itertools import izip
+from lxml import etree
+import re
+import struct
+import logging
+import os
+
+log = logging.getLogger(__name__)
+log.addHandler(NullHandler())
+
+# A placeholder: a key between two @s. The key doesn't start or end with
+# a space, and neither @ touches a letter or digit, so text that merely
+# has @s in it, like two email addresses, isn't taken for one. Keys can't
+# hold < or >, so the same pattern finds them in the raw XML of a part.
+keyre = re.compile(r'(?<!\w)@([^@\s<>](?:[^@<>\n]*[^@\s<>])?)@(?!\w)')
+
+entities = {'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'apos': "'"}
+entityre = re.compile(r'&(amp|lt|gt|quot|apos);')
+
+def maycontainkeys(data, replacements, specific_words = None):
+    ''' Returns whether the raw bytes of an XML part might hold a placeholder
+    for one of the keys of replacements, without parsing it '''
+    if '@' not in data:
+        return False
+    for candidate in keyre.findall(data):
+        key = entityre.sub(lambda m: entities[m.group(1)], candidate)
+        key = key.decode('utf-8', 'replace')
+        if key in replacements and (not specific_words or key in specific_words):
+            return True
+    return False
+
+# A paragraph holding nothing but @#name@ starts a repeat block, and one
+# holding @/name@ ends it
+markerre = re.compile(r'^@([#/])([^@]+)@$')
+
+def findrepeats(body):
+    ''' Returns (name, start marker, elements, end marker) for each repeat
+    block among the children of body, where elements are those between the
+    markers. Blocks can't be nested. '''
+    para = '{%s}p' % nsprefixes['w']
+    text = '{%s}t' % nsprefixes['w']
+    blocks = []
+    start = None
+    elements = []
+    for elem in body:
+        if elem.tag == para:
+            m = markerre.match(''.join(t.text or '' for t in elem.iter(text)).strip())
+            if m is not None:
+                kind, name = m.groups()
+                if kind == '#':
+                    if start is not None:
+                        raise Exception("Repeat block %s starts inside block %s" % (name, start[0]))
+                    start = (name, elem)
+                    elements = []
+                elif start is None or start[0] != name:
+                    raise Exception("Repeat block %s ends without starting" % name)
+                else:
+                    blocks.append((name, start[1], elements, elem))
+                    start = None
+                continue
+        if start is not None:
+            elements.append(elem)
+    if start is not None:
+        raise Exception("Repeat block %s isn't ended" % start[0])
+    return blocks
+
+def placeholdersites(elements):
+    ''' Returns (element index, child index path, text) for each piece of
+    text in elements that may hold a placeholder '''
+    sites = []
+    for i, root in enumerate(elements):
+        for elem in root.iter():
+            if elem.text and '@' in elem.text:
+                path = []
+                node = elem
+                while node is not root:
+                    parent = node.getparent()
+                    path.append(parent.index(node))
+                    node = parent
+                path.reverse()
+                sites.append((i, path, elem.text))
+    return sites
+
+def manifestpath(template):
+    ''' Returns the name of the manifest written next to a template by
+    compile_template.py: foo.docx has foo.manifest.json '''
+    return os.path.splitext(template)[0] + '.manifest.json'
+
+def load_manifest(template):
+    ''' Returns the manifest of a template as a dict, or None if it hasn't
+    been compiled or has changed since '''
+    try:
+        f = open(manifestpath(template))
+    except IOError:
+        return None
+    import json
+    try:
+        manifest = json.load(f)
+    finally:
+        f.close()
+    st = os.stat(template)
+    if manifest.get('stamp') != [st.st_mtime, st.st_size]:
+        log.info("Manifest of %s is out of date, ignoring it", template)
+        return None
+    return manifest
+
+# struct codes for the kinds and sizes of numbers .npy files hold
+npycodes = {'f': {4: 'f', 8: 'd'}, 'i': {1: 'b', 2: 'h', 4: 'i', 8: 'q'},
+            'u': {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}, 'b': {1: '?'}}
+npyorders = {'<': '<', '>': '>', '|': '<', '=': '='}
+
+class NpyColumn(object):
+    ''' A column of numbers in a memory mapped .npy file, read a value at a
+    time '''
+    def __init__(self, mapping, offset, stride, unpack, length):
+        self.mapping = mapping
+        self.offset = offset
+        self.stride = stride
+        self.unpack = unpack
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.length:
+            raise IndexError(i)
+        return self.unpack(self.mapping, self.offset + i * self.stride)[0]
+
+    def __iter__(self):
+        mapping, unpack = self.mapping, self.unpack
+        for offset in xrange(self.offset, self.offset + self.length * self.stride, self.stride):
+            yield unpack(mapping, offset)[0]
+
+def load_npy(path):
+    ''' Returns the columns of the array of numbers in the .npy file path:
+    one for a 1-D array, one for each column of a 2-D array. The file is
+    memory mapped with mappedfile(), so it is never read in as a whole and
+    numpy isn't needed. '''
+    mapping = mappedfile(path).mapping
+    if mapping[:6] != '\x93NUMPY':
+        raise Exception("%s isn't a .npy file" % path)
+    if ord(mapping[6]) == 1:
+        start = 10
+        size, = struct.unpack_from('<H', mapping, 8)
+    else:
+        start = 12
+        size, = struct.unpack_from('<I', mapping, 8)
+    import ast
+    header = ast.literal_eval(mapping[start:start + size])
+    offset = start + size
+    descr, shape = header['descr'], header['shape']
+    code = None
+    if isinstance(descr, basestring) and descr[:1] in npyorders:
+        itemsize = int(descr[2:] or 0)
+        code = npycodes.get(descr[1], {}).get(itemsize)
+    if code is None:
+        raise Exception("%s holds %s, not numbers" % (path, descr))
+    unpack = struct.Struct(npyorders[descr[0]] + code).unpack_from
+    if len(shape) == 1:
+        return [NpyColumn(mapping, offset, itemsize, unpack, shape[0])]
+    if len(shape) != 2:
+        raise Exception("%s holds a %d-D array, not a table" % (path, len(shape)))
+    rows, columns = shape
+    if header['fortran_order']:
+        return [NpyColumn(mapping, offset + c * rows * itemsize, itemsize, unpack, rows)
+                for c in range(columns)]
+    return [NpyColumn(mapping, offset + c * itemsize, columns * itemsize, unpack, rows)
+            for c in range(columns)]
+
+class TableColumns(object):
+    ''' The rows of a table given by its columns, as a dict with:
+
+      columns  a list of columns: lists, arrays from the array module, or
+               names of .npy files (a 2-D array gives several columns)
+      npy      or else the name of a .npy file holding a 2-D array
+      formats  optionally, a % format string for each column, or None for
+               str()
+
+    Each row is formatted as it is iterated over, so the table is never
+    held as Python strings. '''
+    def __init__(self, spec):
+        columns = []
+        if 'npy' in spec:
+            columns.extend(load_npy(spec['npy']))
+        for column in spec.get('columns', []):
+            if isinstance(column, basestring):
+                columns.extend(load_npy(column))
+            else:
+                columns.append(column)
+        lengths = sorted(set(len(column) for column in columns))
+        if len(lengths) > 1:
+            raise Exception("columns have different lengths: %s" % lengths)
+        self.columns = columns
+        self.width = len(columns)
+        self.length = lengths[0] if lengths else 0
+        self.formats = spec.get('formats') or [None] * self.width
+        if len(self.formats) != self.width:
+            raise Exception("%d formats for %d columns" % (len(self.formats), self.width))
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        formats = [fmt or '%s' for fmt in self.formats]
+        for values in izip(*self.columns):
+            yield [fmt % value for fmt, value in izip(formats, values)]
+
+def tablerows(content):
+    ''' Returns the number of columns and the rows of the content of a
+    table replacement, which is a list of rows or a TableColumns dict '''
+    if isinstance(content, dict):
+        rows = TableColumns(content)
+        return rows.width, rows
+    return len(content[0]), content
+
+class PayloadError(ValueError):
+    ''' A payload doesn't fit its template. problems lists everything wrong
+    with it. It pickles with its problems, so it can come back from a
+    worker process. '''
+    def __init__(self, problems):
+        ValueError.__init__(self, '; '.join(problems))
+        self.problems = problems
+
+    def __reduce__(self):
+        return PayloadError, (self.problems,)
+
+def validate_payload(manifest, payload, image_data = None):
+    ''' Checks a payload dict against the manifest of its template (see
+    compile_template.py) without touching the template. Returns a list of
+    every problem found, which is empty if the payload fits: missing text
+    keys and tables, tables whose rows have the wrong number of columns or
+    whose columns (see TableColumns) can't be read,
+    images the template doesn't have or whose files can't be read (unless
+    their bytes are already in image_data), and missing repeat blocks or
+    records missing keys that the text replacements don't supply either. '''
+    problems = []
+    text = payload.get('text', {})
+    for key in sorted(manifest['text']):
+        if key not in text:
+            problems.append("missing text key '%s'" % key)
+    tables = payload.get('tables', {})
+    for tag in sorted(manifest['tables']):
+        if tag not in tables:
+            problems.append("missing table '%s'" % tag)
+            continue
+        table = tables[tag]
+        if (not isinstance(table, (list, tuple)) or len(table) != 2
+            or not isinstance(table[0], dict) or not isinstance(table[1], (list, tuple, dict))):
+            problems.append("table '%s' isn't a [settings, rows] pair" % tag)
+            continue
+        columns = manifest['tables'][tag]['columns']
+        if isinstance(table[1], dict):
+            try:
+                rows = TableColumns(table[1])
+            except Exception as e:
+                problems.append("can't read the columns of table '%s': %s" % (tag, e))
+                continue
+            if not len(rows):
+                problems.append("table '%s' has no rows" % tag)
+            if rows.width != columns:
+                problems.append("table '%s' should have %d columns, not %d"
+                                % (tag, columns, rows.width))
+            continue
+        if not table[1]:
+            problems.append("table '%s' has no rows" % tag)
+        for i, row in enumerate(table[1]):
+            if not isinstance(row, (list, tuple)) or len(row) != columns:
+                problems.append("row %d of table '%s' should have %d columns"
+                                % (i, tag, columns))
+    for tag in sorted(tables):
+        if tag not in manifest['tables']:
+            problems.append("template has no table '%s'" % tag)
+    images = payload.get('images', {})
+    for picname in sorted(images):
+        if picname not in manifest['images']:
+            problems.append("template has no image '%s'" % picname)
+        elif not (image_data and images[picname] in image_data
+                  or os.access(images[picname], os.R_OK)):
+            problems.append("can't read image '%s' for '%s'" % (images[picname], picname))
+    repeats = payload.get('repeats', {})
+    for name in sorted(manifest.get('repeats', {})):
+        if name not in repeats:
+            problems.append("missing repeat '%s'" % name)
+            continue
+        if not isinstance(repeats[name], (list, tuple)):
+            problems.append("repeat '%s' isn't a list of records" % name)
+            continue
+        for i, record in enumerate(repeats[name]):
+            if not isinstance(record, dict):
+                problems.append("record %d of repeat '%s' isn't a dict" % (i, name))
+                continue
+            missing = [key for key in manifest['repeats'][name]['keys']
+                       if key not in record and key not in text]
+            if missing:
+                problems.append("record %d of repeat '%s' is missing %s"
+                                % (i, name, ', '.join("'%s'" % key for key in missing)))
+    return problems
+
+# The payload of the chunks a worker process fills, set by setchunkpayload()
+chunkpayload = None
+
+def setchunkpayload(text_reps, table_reps, clean, coalesce):
+    global chunkpayload
+    chunkpayload = (text_reps, table_reps, clean, coalesce)
+
+def replacechunk(xml):
+    ''' Fills a chunk of a body, serialized as a w:body element, in a worker
+    process. Returns the filled chunk, serialized the same way, and the
+    render stats as a dict. '''
+    text_reps, table_reps, clean, coalesce = chunkpayload
+    dx = DocXReplace(None, dic = {'text': text_reps, 'tables': table_reps})
+    chunk = etree.fromstring(xml)
+    dx.get_document().replace(dx.body[0], chunk)
+    dx.body = [chunk]
+    if clean:
+        dx.clean(coalesce)
+    dx.replace_text()
+    dx.replace_tables()
+    return etree.tostring(chunk), dx.stats.as_dict()
 
 class DocXReplace(DocX):
+    # What compile_template.py found in the template, if it has been compiled
+    manifest = None
+
     def __init__(self, input_filename, json_file = None, 
-                       jsonstr = None, dic = None):
-        super(DocXReplace, self).__init__(input_filename)
-        if json_file is not None:
-            f = open(json_file)
-            self.replacements = json.loads(f.read())
-            f.close()
-        elif jsonstr is not None:
-            self.replacements = json.loads(jsonstr)
-        elif dic is not None:
-            self.replacements = dic
-        else:
-            raise Exception("No data supplied to load_replacements")
+                       jsonstr = None, dic = None, metrics = None, verbose = False):
+        super(DocXReplace, self).__init__(input_filename, metrics = metrics,
+                                          verbose = verbose)
+        if isinstance(input_filename, basestring):
+            self.manifest = load_manifest(input_filename)
+        self.load_replacements(json_file, jsonstr, dic)
+
+    def load_replacements(self, json_file = None, jsonstr = None, dic = None):
+        ''' Sets the replacements from a JSON file, a JSON string or a dict,
+        whichever is given first '''
+        with self.stats.timer('payload'):
+            if json_file is not None:
+                import json
+                f = open(json_file)
+                self.replacements = json.loads(f.read())
+                f.close()
+            elif jsonstr is not None:
+                import json
+                self.replacements = json.loads(jsonstr)
+            elif dic is not None:
+                self.replacements = dic
+            else:
+                raise Exception("No data supplied to load_replacements")
 
         self.text_reps = self.replacements.get("text", {})
         self.table_reps = self.replacements.get("tables", {})
         self.image_reps = self.replacements.get("images", {})
+        self.repeat_reps = self.replacements.get("repeats", {})
+        # Image file contents already read, by path, used instead of reading
+        # the files again
+        self.image_data = {}
 
     def replace_tags(self, line, replacements, specific_words = None):
-        subs = re.split(r'(@[^@]*@)', line)
-        res = ""
-        count = 0
-        for sub in subs:
-            if self.is_key(sub):
-                # if we've given a specific word list, and this isn't in it:
-                if specific_words and sub[1:-1] not in specific_words:
-                    res += sub # just append as-is and continue
-                    continue
-                try:
-                    key = sub[1:-1]
-                    self.log("replacing '%s' with '%s'" % (key, replacements[key]))
-                    res += replacements[key].__str__()
-                    count += 1
-                except KeyError:
-                    #if it's not in our lookup table, append as-is
-                    if self.verbose:
-                        print "Key '%s' not found in replacements!" % sub
-                    res += sub
-            else:
-                res += sub
-        return res, count
+        count = [0]
+        def replace(match):
+            key = match.group(1)
+            # if we've given a specific word list, and this isn't in it:
+            if specific_words and key not in specific_words:
+                return match.group(0) # just leave it as-is
+            try:
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("replacing '%s' with '%s'", key, replacements[key])
+                value = replacements[key].__str__()
+            except KeyError:
+                #if it's not in our lookup table, leave it as-is
+                self.stats.count('keys_missing')
+                log.info("Key '%s' not found in replacements!", match.group(0))
+                return match.group(0)
+            count[0] += 1
+            return value
+        if '@' not in line:
+            return line, 0
+        return keyre.sub(replace, line), count[0]
 
     def is_key(self, string):
-        return len(string) > 2 and string[0] == string[-1] == '@'
+        match = keyre.match(string)
+        return match is not None and match.end() == len(string)
 
-    def replace_text(self, replacements = None, specific_words = None):
-        ''' Finds and makes all of the replacements. '''
+    def replace_text(self, replacements = None, specific_words = None, parts = None):
+        ''' Finds and makes all of the replacements, in the main document and
+        in its headers, footers, footnotes and endnotes (or just in the parts
+        named in parts). Parts that haven't been parsed yet are only parsed
+        if their bytes hold a placeholder for one of the keys. If the template
+        has a manifest, parts it lists no keys for aren't looked at. '''
         if replacements is None:
             if self.text_reps is not None:
                 replacements = self.text_reps
             else:
                 raise Exception("No text replacements defined")
-        document = self.get_document()
+        if parts is None:
+            parts = self.get_content_parts()
+            if self.manifest is not None:
+                keyed = self.manifest['parts']
+                self.stats.count('parts_skipped', len([name for name in parts
+                                                       if name not in keyed]))
+                parts = [name for name in parts if name in keyed]
+        count = 0
+        visited = 0
+        with self.stats.timer('replace_text'):
+            for name in parts:
+                if name in self.raw and not maycontainkeys(self.raw[name], replacements,
+                                                           specific_words):
+                    self.stats.count('parts_skipped')
+                    continue
+                for elem in self.get_tree(name).iter():
+                    visited += 1
+                    if elem.text:
+                        elem.text, c = self.replace_tags(elem.text, replacements, specific_words)
+                        count += c
+        self.stats.count('elements_visited', visited)
+        self.stats.count('keys_replaced', count)
+        log.info("Made %d replacements", count)
+
+    def replace_repeats(self, repeats = None):
+        ''' Fills the repeat blocks of the body. The elements between the
+        paragraphs @#name@ and @/name@ are copied once for each record (a
+        dict of keys to text) in the list repeats[name], and the markers and
+        the original elements are dropped. Each copy's placeholders are
+        filled from its record, falling back to the text replacements. The
+        places that may hold placeholders are found once per block, so only
+        those are visited in the copies. Blocks without records are left
+        alone. Returns the copies, which are children of the body. '''
+        if repeats is None:
+            repeats = self.repeat_reps
+        text_reps = self.text_reps or {}
+        body = self.body[0]
         count = 0
-        for elem in document.iter():
-            if elem.text:
-                elem.text, c = self.replace_tags(elem.text, replacements, specific_words)
-                count += c
-        self.log("Made %d replacements" % count)
+        made = []
+        with self.stats.timer('replace_repeats'):
+            for name, start, elements, end in findrepeats(body):
+                if name not in repeats:
+                    log.info("No records for repeat block %s", name)
+                    continue
+                sites = placeholdersites(elements)
+                keys = set()
+                for i, path, text in sites:
+                    keys.update(keyre.findall(text))
+                for record in repeats[name]:
+                    values = {}
+                    for key in keys:
+                        if key in record:
+                            values[key] = record[key]
+                        elif key in text_reps:
+                            values[key] = text_reps[key]
+                    copies = [deepcopy(elem) for elem in elements]
+                    for i, path, text in sites:
+                        node = copies[i]
+                        for j in path:
+                            node = node[j]
+                        node.text, c = self.replace_tags(text, values)
+                        count += c
+                    for elem in copies:
+                        end.addprevious(elem)
+                    made.extend(copies)
+                    self.stats.count('records_repeated')
+                for elem in [start] + elements + [end]:
+                    body.remove(elem)
+        self.stats.count('keys_replaced', count)
+        return made
 
     def replace_image(self, imagename, new_image):
         for elem in self.get_document().iter():
@@ -79,91 +483,236 @@ class DocXReplace(DocX):
                 replacements = self.image_reps
             else:
                 raise Exception("No image replacements defined")
-        for elem in self.get_document().iter():
-            if elem.tag.split("}")[-1] == "graphic":
-                picname = self.get_pic_name(elem)
-                if picname and picname in replacements:
-                    rid = self.get_id(elem)
-                    if rid is not None:
-                        self.log("Replacing %s with %s" % (picname, replacements[picname]))
-                        self.set_image_relation(rid, replacements[picname])
-                    else:
-                        if self.verbose:
-                            print "Relation id for image %s not present; can't replace" % picname
+        visited = 0
+        with self.stats.timer('replace_images'):
+            for elem in self.get_document().iter():
+                visited += 1
+                if elem.tag.split("}")[-1] == "graphic":
+                    picname = self.get_pic_name(elem)
+                    if picname and picname in replacements:
+                        rid = self.get_id(elem)
+                        if rid is not None:
+                            path = replacements[picname]
+                            log.debug("Replacing %s with %s", picname, path)
+                            if path in self.image_data:
+                                self.set_image_data(rid, path, self.image_data[path])
+                            else:
+                                self.set_image_relation(rid, path)
+                            self.stats.count('images_replaced')
+                        else:
+                            log.info("Relation id for image %s not present; can't replace", picname)
+        self.stats.count('elements_visited', visited)
 
     def replace_tables(self, table_replacements = None):
+        ''' Fills each table with a row holding @@tag@@ from the [settings,
+        content] pair for tag, where content is a list of rows or a dict of
+        columns (see TableColumns) '''
         if table_replacements is None:
             if self.table_reps is not None:
                 table_replacements = self.table_reps
             else:
                 raise Exception("no table replacements dict defined")
 
-        for elem in self.get_document().iter():
-            if elem.tag.split("}")[-1] == "tbl":
-                try:
-                    nrows = self.get_num_rows(elem)
-                    ncols = self.get_num_columns(elem)
-                    for i in range(len(elem)):
-                        if elem[i].tag.split("}")[-1] == "tr":
-                            rowelem = elem[i]
-                            col = self.find_subelem_list(rowelem, ["tc", "p", "r", "t"])
-
-                            if col is None:
-                                raise Exception("Could not find column")
-
-                            tags = re.findall(r'@@([^@]+)@@', col.text)
-
-                            if not tags:
-                                # print "No @@ tag found to describe source in row %d" % i
-                                continue
-                            source = tags[0]
-                            self.log("Found table tag %s, querying dictionary" % source)
-                            if source not in table_replacements:
-                                raise Exception("Error: couldn't find %s in replacements dict" % source)
-                            settings = table_replacements[source][0]
-                            font_size = settings.get("font_size", None)
-                            # hack because fonts appear half-size for some reason
-                            if font_size is not None:
-                                font_size *= 2
-                            font_face = settings.get("font_face", None)
-                            # get the border settings
-                            borders = settings.get("borders", [])
-
-                            under_border = settings.get("under_border", False)
-                            content = table_replacements[source][1]
-                            
-                            tbl_ncols = len(content[0])
-                            if tbl_ncols != ncols:
-                                raise Exception("Error: should have %d columns, but "
-                                                "source has %d columns" % (ncols, tbl_ncols))
-                            first = True
-                            j = 0
-                            for row in content:
-                                if first:
-                                    # if it's the first row we're appending, we want to
-                                    # overwrite the row that was at i, a.k.a. the row
-                                    # containing the @@tag@@.
-                                    elem[i] = make_row(row, font_face=font_face, 
-                                                            font_size=font_size.__str__(),
-                                                            borders = borders)
-                                    first = False
-                                else:
-                                    # otherwise we can just add to the end of the table
-                                    elem.append(make_row(row, font_face=font_face,
-                                                              font_size=font_size.__str__(),
-                                                              borders = borders))
-                                j += 1
-                            self.log("Inserted %d rows into table %s" % (j, source))
-                            break # only do it once for each table
-                except Exception as e:
-                    self.log(e + "\n" + "Error reading or constructing table element, no rows added")
-                    return
+        visited = 0
+        with self.stats.timer('replace_tables'):
+            # only tables are looked at, so the rows put in aren't walked
+            # through one element at a time
+            for elem in self.get_document().iter('{%s}tbl' % nsprefixes['w']):
+                visited += 1
+                if elem.tag.split("}")[-1] == "tbl":
+                    try:
+                        nrows = self.get_num_rows(elem)
+                        ncols = self.get_num_columns(elem)
+                        for i in range(len(elem)):
+                            if elem[i].tag.split("}")[-1] == "tr":
+                                rowelem = elem[i]
+                                col = self.find_subelem_list(rowelem, ["tc", "p", "r", "t"])
+
+                                if col is None:
+                                    raise Exception("Could not find column")
+
+                                tags = re.findall(r'@@([^@]+)@@', col.text)
 
-    def replace_all(self, text_reps = None, table_reps = None, image_reps = None):
-        self.log("replacing text...")
-        self.replace_text(text_reps)
-        self.log("replacing tables...")
-        self.replace_tables(table_reps)
-        self.log("replacing images...")
+                                if not tags:
+                                    # print "No @@ tag found to describe source in row %d" % i
+                                    continue
+                                source = tags[0]
+                                log.debug("Found table tag %s, querying dictionary", source)
+                                if source not in table_replacements:
+                                    raise Exception("Error: couldn't find %s in replacements dict" % source)
+                                settings = table_replacements[source][0]
+                                font_size = settings.get("font_size", None)
+                                # hack because fonts appear half-size for some reason
+                                if font_size is not None:
+                                    font_size *= 2
+                                font_face = settings.get("font_face", None)
+                                # get the border settings
+                                borders = settings.get("borders", [])
+
+                                under_border = settings.get("under_border", False)
+                                tbl_ncols, content = tablerows(table_replacements[source][1])
+                                if tbl_ncols != ncols:
+                                    raise Exception("Error: should have %d columns, but "
+                                                    "source has %d columns" % (ncols, tbl_ncols))
+                                first = True
+                                j = 0
+                                for row in make_rows(content, font_face=font_face,
+                                                     font_size=font_size.__str__(),
+                                                     borders = borders):
+                                    if first:
+                                        # if it's the first row we're appending, we want to
+                                        # overwrite the row that was at i, a.k.a. the row
+                                        # containing the @@tag@@.
+                                        elem[i] = row
+                                        first = False
+                                    else:
+                                        # otherwise we can just add to the end of the table
+                                        elem.append(row)
+                                    j += 1
+                                self.stats.count('rows_inserted', j)
+                                log.debug("Inserted %d rows into table %s", j, source)
+                                break # only do it once for each table
+                    except Exception as e:
+                        log.error("%s\nError reading or constructing table element, no rows added", e)
+                        self.stats.count('elements_visited', visited)
+                        return
+        self.stats.count('elements_visited', visited)
+
+    def replace_all(self, text_reps = None, table_reps = None, image_reps = None,
+                    processes = 1):
+        ''' Makes all of the replacements, starting with the repeat blocks.
+        With processes other than 1, a body with at least parallel_threshold
+        elements is filled by that many worker processes (None for one per
+        CPU); see replace_parallel(). '''
+        body = self.body[0]
+        held = []
+        if self.repeat_reps:
+            log.info("repeating blocks...")
+            # The copies are filled from their records already, so they sit
+            # out the text pass, or a value holding @key@ would be replaced
+            # again. Markers hold their places, found by their text, since
+            # the parallel pass puts new elements in the body.
+            for elem in self.replace_repeats():
+                body.replace(elem, etree.Comment('docxreplace repeat %d' % len(held)))
+                held.append(elem)
+        parallel = processes != 1 and len(body) >= self.parallel_threshold
+        try:
+            if parallel:
+                log.info("replacing text and tables in parallel...")
+                self.replace_parallel(text_reps, table_reps, processes)
+            else:
+                log.info("replacing text...")
+                self.replace_text(text_reps)
+        finally:
+            if held:
+                for elem in list(body):
+                    if elem.tag is etree.Comment and elem.text.startswith('docxreplace repeat '):
+                        body.replace(elem, held[int(elem.text.split()[-1])])
+        if not parallel or held:
+            # after the parallel pass, just the copies' tables are left
+            log.info("replacing tables...")
+            self.replace_tables(table_reps)
+        log.info("replacing images...")
         self.replace_images(image_reps)
-        self.log("done")
\ No newline at end of file
+        log.info("done")
+        return self.stats
+
+    # Bodies with fewer elements than this aren't worth splitting up
+    parallel_threshold = 2000
+
+    def replace_parallel(self, text_reps = None, table_reps = None, processes = None,
+                         clean = False, coalesce = False):
+        ''' Replaces text and fills tables in the body with a pool of worker
+        processes (by default one per CPU), cleaning it first if clean is set
+        (see clean()). The body is cut into chunks of whole paragraphs and
+        tables, which are sent to the workers serialized and put back in
+        order. Text and tables don't add relationships, so relationship ids
+        need no fixing; images, which do, are left to replace_images(). Text
+        in headers, footers and notes is replaced here, in this process. '''
+        from multiprocessing import Pool, cpu_count
+        if text_reps is None:
+            text_reps = self.text_reps
+        if table_reps is None:
+            table_reps = self.table_reps
+        processes = processes or cpu_count()
+        body = self.body[0]
+        children = list(body)
+        # the section properties have to stay the last element of the body
+        sectpr = None
+        if children and children[-1].tag == '{%s}sectPr' % nsprefixes['w']:
+            sectpr = children.pop()
+        # several chunks per process, so that one slow chunk doesn't hold
+        # up the rest
+        size = max(1, -(-len(children) // (processes * 4)))
+        chunks = []
+        with self.stats.timer('split'):
+            for i in range(0, len(children), size):
+                chunk = makeelement('body')
+                chunk.extend(children[i:i + size])
+                chunks.append(etree.tostring(chunk))
+        self.stats.count('chunks', len(chunks))
+        pool = Pool(processes, setchunkpayload, (text_reps, table_reps, clean, coalesce))
+        try:
+            with self.stats.timer('replace_parallel'):
+                results = pool.map(replacechunk, chunks, 1)
+        except Exception:
+            # leave the body as it was
+            for elem in children:
+                if sectpr is None:
+                    body.append(elem)
+                else:
+                    sectpr.addprevious(elem)
+            raise
+        finally:
+            pool.terminate()
+        with self.stats.timer('join'):
+            for xml, stats in results:
+                for elem in etree.fromstring(xml):
+                    if sectpr is None:
+                        body.append(elem)
+                    else:
+                        sectpr.addprevious(elem)
+                self.stats.merge(stats)
+        self.replace_text(text_reps, parts = self.get_content_parts()[1:])
+
+    def validate(self):
+        ''' Raises PayloadError listing every problem with the replacements
+        if they don't fit the template's manifest. Does nothing if the
+        template hasn't been compiled. '''
+        if self.manifest is None:
+            return
+        with self.stats.timer('validate'):
+            problems = validate_payload(self.manifest, self.replacements, self.image_data)
+        if problems:
+            raise PayloadError(problems)
+
+    def render(self, output = None, profile = None, processes = 1, validate = False,
+               **kwargs):
+        ''' Makes all of the replacements and saves the document to output,
+        passing any other arguments on to save(). Returns the render stats.
+        processes is passed on to replace_all(). With validate set, the
+        replacements are first checked against the template's manifest, if
+        it has one; see validate().
+
+        With profile set, or the DOCX_PROFILE environment variable set to
+        anything but 0 when profile is None, the render is profiled and the
+        reports are written next to output, named after it and the template
+        (e.g. out.docx.template.prof and out.docx.template.txt). '''
+        if profile is None:
+            profile = os.environ.get('DOCX_PROFILE', '0') not in ('', '0')
+        if validate:
+            self.validate()
+        if not profile:
+            self.replace_all(processes = processes)
+            self.save(output, **kwargs)
+            return self.stats
+        target = output if output is not None else self.filename
+        if not isinstance(target, basestring):
+            target = getattr(target, 'name', 'render')
+        template = 'new'
+        if isinstance(getattr(self, 'filename', None), basestring):
+            template = os.path.splitext(os.path.basename(self.filename))[0]
+        with profiled('%s.%s' % (target, template)):
+            self.replace_all(processes = processes)
+            self.save(output, **kwargs)
+        return self.stats
\ No newline at end of file
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+"""
+A local HTTP server that fills templates with DocXReplace.
+
+The server binds its socket once and forks a number of worker processes
+which all accept requests on it. Workers import lxml and the docx module
+once, and keep every template they have loaded parsed in memory, so a
+request only pays for copying the template, making the replacements and
+saving the result.
+
+To render, POST the JSON payload DocXReplace takes (text, tables and
+images) to /render?template=NAME, where NAME is the path of a template
+relative to the templates directory. The response is the .docx file. A
+payload that doesn't fit a compiled template (see compile_template.py) is
+rejected with 400 and a list of its problems before anything is rendered.
+GET /health answers 'ok' once a worker is up.
+
+With --preload, every template in the directory is parsed by the parent
+process before it forks, so the workers share the memory holding them
+(copy-on-write) instead of each parsing their own copies; renders work on
+copies of the templates, which leaves the shared pages alone. GET /memory
+returns a worker's resident memory split into shared and private bytes,
+and sending the parent SIGUSR1 logs the same for every worker.
+
+Each render must finish within the timeout or the request fails with 504
+and the worker is replaced. Workers are also replaced after serving a
+number of requests, or once their private memory (or where that can't be
+measured, their peak memory) passes a limit, so a leak or one huge
+document can't keep a worker bloated.
+
+Usage:
+  docxserver.py [-b HOST:PORT | -u SOCKET] [-w WORKERS] [-j JOBS] [-m MB] [-t SECONDS]
+                [-p] TEMPLATES
+
+Part of Python's docx module - http://github.com/mikemaccana/python-docx
+See LICENSE for licensing information.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import errno
+import gc
+import json
+import logging
+import os
+import resource
+import signal
+import sys
+from StringIO import StringIO
+from urlparse import urlparse, parse_qs
+
+from docx import DocX, NullHandler
+from docxreplace import DocXReplace, PayloadError, load_manifest
+
+log = logging.getLogger(__name__)
+log.addHandler(NullHandler())
+
+DOCX_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+
+
+class RenderTimeout(Exception):
+    pass
+
+
+def alarm(signum, frame):
+    raise RenderTimeout()
+
+
+def maxrss():
+    '''Return the peak memory use of this process in bytes'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak *= 1024  # kilobytes everywhere but OS X
+    return peak
+
+
+# /proc/PID/smaps fields, and what memoryusage() adds them to
+smapsfields = {'Rss': 'rss', 'Pss': 'pss',
+               'Shared_Clean': 'shared', 'Shared_Dirty': 'shared',
+               'Private_Clean': 'private', 'Private_Dirty': 'private'}
+
+
+def memoryusage(pid = 'self'):
+    '''Return the resident memory of a process in bytes, as a dict with the
+    total (rss), the proportional share (pss), and the parts shared with
+    other processes and private to this one. Returns None where there is no
+    /proc/PID/smaps to read this from.'''
+    for name in ('smaps_rollup', 'smaps'):
+        try:
+            f = open('/proc/%s/%s' % (pid, name))
+        except IOError:
+            continue
+        usage = {'rss': 0, 'pss': 0, 'shared': 0, 'private': 0}
+        for line in f:
+            field, sep, value = line.partition(':')
+            if field in smapsfields:
+                usage[smapsfields[field]] += int(value.split()[0]) * 1024
+        f.close()
+        return usage
+    return None
+
+
+def workermemory():
+    '''Return the memory of this process that counts against its limit'''
+    usage = memoryusage()
+    if usage is None:
+        return maxrss()
+    return usage['private']
+
+
+class TemplateCache(object):
+    ''' Parsed templates from a directory, reloaded when their files change.
+    Their media is read from memory mappings shared between workers. '''
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.templates = {}  # path -> (mtime, size, DocX)
+
+    def path(self, name):
+        ''' Returns the path of the template called name, which must be inside
+        the templates directory '''
+        path = os.path.normpath(os.path.join(self.directory, name))
+        if not path.startswith(self.directory + os.sep):
+            raise KeyError(name)
+        return path
+
+    def get(self, name):
+        ''' Returns the DocX for a template, loading it if it isn't loaded yet
+        or has changed, along with its manifest if it has been compiled.
+        Raises KeyError if there is no such template. '''
+        path = self.path(name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            raise KeyError(name)
+        cached = self.templates.get(path)
+        if cached is None or cached[:2] != (st.st_mtime, st.st_size):
+            log.info('Loading template %s', path)
+            doc = DocX(path, mapped = True)
+            doc.manifest = load_manifest(path)
+            cached = (st.st_mtime, st.st_size, doc)
+            self.templates[path] = cached
+        return cached[2]
+
+    def preload(self):
+        ''' Loads every template in the directory. Returns how many. '''
+        count = 0
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith('.docx') and not filename.startswith('~$'):
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        self.get(os.path.relpath(path, self.directory))
+                        count += 1
+                    except Exception as e:
+                        log.warning("Couldn't load template %s: %s", path, e)
+        return count
+
+    def render(self, name, payload):
+        ''' Fills a copy of a template with a payload dict and returns the
+        bytes of the resulting .docx file. Raises PayloadError if the
+        template has been compiled and the payload doesn't fit it. '''
+        dx = self.get(name).copy(DocXReplace)
+        dx.load_replacements(dic = payload)
+        output = StringIO()
+        dx.render(output, validate = True)
+        return output.getvalue()
+
+
+class RenderHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # seconds a client may take to send its request
+    timeout = 30
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/health':
+            self.reply(200, 'ok\n', 'text/plain')
+        elif path == '/memory':
+            self.reply(200, json.dumps(memoryusage()) + '\n', 'application/json')
+        else:
+            self.reply(404, 'Not found\n', 'text/plain')
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/render':
+            return self.reply(404, 'Not found\n', 'text/plain')
+        names = parse_qs(url.query).get('template')
+        if not names:
+            return self.reply(400, 'No template given\n', 'text/plain')
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        if length > server.max_payload:
+            return self.reply(413, 'Payload too large\n', 'text/plain')
+        try:
+            payload = json.loads(self.rfile.read(length))
+        except ValueError as e:
+            return self.reply(400, 'Bad payload: %s\n' % e, 'text/plain')
+        if not isinstance(payload, dict):
+            return self.reply(400, 'Bad payload: not a JSON object\n', 'text/plain')
+        signal.alarm(server.render_timeout)
+        try:
+            # only a missing template is a 404; errors from rendering it,
+            # whatever their type, are the server's fault
+            try:
+                server.cache.get(names[0])
+            except KeyError:
+                return self.reply(404, 'No such template: %s\n' % names[0], 'text/plain')
+            data = server.cache.render(names[0], payload)
+        except RenderTimeout:
+            log.error('Rendering %s took more than %d seconds', names[0], server.render_timeout)
+            server.retire = True
+            return self.reply(504, 'Render timed out\n', 'text/plain')
+        except PayloadError as e:
+            return self.reply(400, 'Bad payload: %s\n' % e, 'text/plain')
+        except Exception as e:
+            log.exception('Rendering %s failed', names[0])
+            return self.reply(500, 'Render failed: %s\n' % e, 'text/plain')
+        finally:
+            signal.alarm(0)
+        self.reply(200, data, DOCX_TYPE)
+
+    def reply(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix sockets have no client address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'local'
+
+    def log_message(self, format, *args):
+        log.info('%s %s', self.address_string(), format % args)
+
+
+class RenderServer(BaseHTTPServer.HTTPServer):
+    ''' HTTP render server on a TCP socket '''
+    def __init__(self, address, templates, render_timeout = 30,
+                 max_payload = 64 << 20):
+        BaseHTTPServer.HTTPServer.__init__(self, address, RenderHandler)
+        self.cache = TemplateCache(templates)
+        self.render_timeout = render_timeout
+        self.max_payload = max_payload
+        self.retire = False
+
+
+class UnixRenderServer(SocketServer.UnixStreamServer):
+    ''' HTTP render server on a Unix socket '''
+    def __init__(self, path, templates, render_timeout = 30,
+                 max_payload = 64 << 20):
+        if os.path.exists(path):
+            os.remove(path)
+        SocketServer.UnixStreamServer.__init__(self, path, RenderHandler)
+        self.cache = TemplateCache(templates)
+        self.render_timeout = render_timeout
+        self.max_payload = max_payload
+        self.retire = False
+
+
+def work(server, max_jobs, max_memory):
+    ''' Serves requests in a worker until it has served max_jobs, its
+    private memory passes max_memory bytes, or a render times out '''
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    signal.signal(signal.SIGALRM, alarm)
+    jobs = 0
+    while jobs < max_jobs and not server.retire:
+        server.handle_request()
+        jobs += 1
+        if max_memory and workermemory() > max_memory:
+            log.info('Worker %d reached %d bytes, recycling', os.getpid(), workermemory())
+            break
+
+
+def spawn(server, max_jobs, max_memory):
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            work(server, max_jobs, max_memory)
+        except Exception:
+            log.exception('Worker %d failed', os.getpid())
+            status = 1
+        finally:
+            os._exit(status)
+    return pid
+
+
+def logmemory(pids):
+    ''' Logs the memory use of each of the processes in pids '''
+    total = {'rss': 0, 'pss': 0, 'shared': 0, 'private': 0}
+    for pid in sorted(pids):
+        usage = memoryusage(pid)
+        if usage is None:
+            continue
+        log.info('Worker %d: rss %dMB, shared %dMB, private %dMB', pid,
+                 usage['rss'] >> 20, usage['shared'] >> 20, usage['private'] >> 20)
+        for key in total:
+            total[key] += usage[key]
+    log.info('All workers: rss %dMB, pss %dMB, private %dMB', total['rss'] >> 20,
+             total['pss'] >> 20, total['private'] >> 20)
+
+
+def serve(server, workers = 4, max_jobs = 1000, max_memory = 512 << 20,
+          preload = False):
+    ''' Forks workers that serve requests on server's socket, replacing
+    each one that exits, until this process gets SIGTERM or SIGINT. With
+    preload set, all templates are loaded first so the workers share them. '''
+    pids = set()
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: logmemory(pids))
+    if preload:
+        log.info('Preloaded %d templates', server.cache.preload())
+        # Collect now rather than in each worker, where freeing garbage
+        # would write to (and so unshare) the pages it lives on
+        gc.collect()
+    try:
+        while not stopping:
+            while len(pids) < workers:
+                pids.add(spawn(server, max_jobs, max_memory))
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+                continue
+            pids.discard(pid)
+            log.info('Worker %d exited with status %d', pid, status)
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        server.server_close()
+
+
+if __name__ == '__main__':
+    from multiprocessing import cpu_count
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [options] TEMPLATES')
+    parser.add_option('-b', '--bind', default='127.0.0.1:8080',
+                      help='address to listen on (default 127.0.0.1:8080)')
+    parser.add_option('-u', '--socket', default=None,
+                      help='listen on this Unix socket instead')
+    parser.add_option('-w', '--workers', type='int', default=cpu_count(),
+                      help='number of worker processes (default: one per CPU)')
+    parser.add_option('-j', '--jobs', type='int', default=1000,
+                      help='requests a worker serves before it is replaced (default 1000)')
+    parser.add_option('-m', '--memory', type='int', default=512,
+                      help='private megabytes a worker may use before it is replaced (default 512)')
+    parser.add_option('-t', '--timeout', type='int', default=30,
+                      help='seconds a render may take (default 30)')
+    parser.add_option('-p', '--preload', action='store_true', default=False,
+                      help='load every template before starting the workers')
+    options, args = parser.parse_args()
+    if len(args) != 1 or not os.path.isdir(args[0]):
+        parser.error('Please supply a directory of templates')
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(process)d %(message)s')
+    if options.socket:
+        server = UnixRenderServer(options.socket, args[0], options.timeout)
+    else:
+        host, port = options.bind.rsplit(':', 1)
+        server = RenderServer((host, int(port)), args[0], options.timeout)
+    serve(server, options.workers, options.jobs, options.memory << 20, options.preload)
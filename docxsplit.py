@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+"""
+Split a docx file into one package per chapter or section.
+
+The body is walked once. It is cut before every heading of a chosen level
+(a paragraph whose style is named "heading N", or which has that outline
+level), or else after every section break. Each piece is written as soon
+as the section break it ends in has been seen, and keeps the page setup,
+headers and footers of that section.
+
+Every piece keeps the relationships and parts that aren't referenced from
+the body (styles, numbering, settings, the theme and so on), but only the
+media, hyperlinks, headers and footers that its own part of the body
+refers to; parts that nothing kept refers to any more are left out. Parts
+that go into every piece are compressed once and copied into each package,
+and media is copied compressed straight from the original.
+
+Fields and bookmarks that point across pieces, such as a table of
+contents, are left as they are.
+
+Usage:
+  docxsplit.py [-l LEVEL] [-o PATTERN] input.docx
+
+Part of Python's docx module - http://github.com/mikemaccana/python-docx
+See LICENSE for licensing information.
+"""
+
+import logging
+import os
+import posixpath
+import re
+import sys
+import zipfile
+import zlib
+from copy import deepcopy
+from optparse import OptionParser
+
+from lxml import etree
+
+from docx import (DocX, NullHandler, ZIP_EPOCH, makezipinfo, nsprefixes, partorder,
+                  writeentry)
+from docxmerge import CT, rawpart, relattributes
+
+log = logging.getLogger(__name__)
+log.addHandler(NullHandler())
+
+W = '{%s}' % nsprefixes['w']
+
+version_tag = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\r\n'
+
+declarationre = re.compile(r' xmlns(?::([^=]+))?="([^"]*)"')
+
+
+def resolve(source, target):
+    '''Return the part name a relationship target of the part source (or of
+    the package, if source is '') points at'''
+    if target.startswith('/'):
+        return posixpath.normpath(target[1:])
+    return posixpath.normpath(posixpath.join(posixpath.dirname(source), target))
+
+
+def relspath(name):
+    '''Return the name of the relationships part of the part name'''
+    directory, basename = posixpath.split(name)
+    return posixpath.join(directory, '_rels', basename + '.rels')
+
+
+class DeflatedPart(object):
+    '''Bytes to store as a part of any number of packages, compressed the
+    first time they are written'''
+    def __init__(self, data):
+        self.data = data
+        self.compressed = None
+
+    def write(self, docxfile, zinfo):
+        if self.compressed is None:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+            self.compressed = compressor.compress(self.data) + compressor.flush()
+            self.crc = zlib.crc32(self.data) & 0xffffffff
+            self.size = len(self.data)
+            self.data = None
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.CRC = self.crc
+        zinfo.file_size = self.size
+        zinfo.compress_size = len(self.compressed)
+        writeentry(docxfile, zinfo, [self.compressed])
+
+
+class DocXSplitter(object):
+    ''' Splits a document into pieces. See the module documentation. '''
+    def __init__(self, filename):
+        self.dx = DocX(filename)
+        self.document = self.dx.get_document()
+        self.body = self.dx.body[0]
+        # the internal parts each part refers to, from its relationships
+        self.links = {}
+        for name in self.dx.trees.keys() + self.dx.raw.keys():
+            if not name.endswith('.rels'):
+                continue
+            directory, basename = posixpath.split(name)
+            source = posixpath.join(posixpath.dirname(directory), basename[:-len('.rels')])
+            rels = etree.fromstring(rawpart(self.dx, name))
+            self.links[source] = [resolve(source, rel.get('Target')) for rel in rels
+                                  if rel.get('TargetMode') != 'External']
+        self.relroot = etree.fromstring(rawpart(self.dx, 'word/_rels/document.xml.rels'))
+        self.bodyrels = set(relattributes(self.body))
+        self.shared = {}    # part name -> DeflatedPart or ZipPart
+        # the document without its body, which the pieces are put into
+        root = etree.Element(self.document.tag, self.document.attrib, nsmap = self.document.nsmap)
+        for child in self.document:
+            if child is self.body:
+                marker = etree.Comment('docxsplit')
+                etree.SubElement(root, self.body.tag, self.body.attrib).append(marker)
+            else:
+                root.append(deepcopy(child))
+        self.head, self.tail = etree.tostring(root).split(etree.tostring(marker), 1)
+        self.nsmap = self.document.nsmap
+
+    def headingstyles(self, level):
+        ''' Returns the ids of the paragraph styles for headings of level '''
+        styles = set(['Heading%d' % level])  # as heading() makes them
+        data = rawpart(self.dx, 'word/styles.xml')
+        if data is None:
+            return styles
+        for style in etree.fromstring(data).iter(W + 'style'):
+            if style.get(W + 'type') != 'paragraph':
+                continue
+            name = style.find(W + 'name')
+            outline = style.find(W + 'pPr/' + W + 'outlineLvl')
+            if (name is not None and name.get(W + 'val', '').lower() == 'heading %d' % level
+                    or outline is not None and outline.get(W + 'val') == str(level - 1)):
+                styles.add(style.get(W + 'styleId'))
+        return styles
+
+    def pieces(self, level = None):
+        ''' Yields (elements, sectPr) for each piece of the body, cutting
+        before headings of level, or after section breaks if level is None.
+        The elements are left in the body. '''
+        styles = self.headingstyles(level) if level is not None else set()
+        waiting = []    # pieces that end before the next section break
+        piece = []
+        for elem in list(self.body):
+            sectpr = None
+            if elem.tag == W + 'sectPr':
+                sectpr = elem
+            elif elem.tag == W + 'p':
+                if level is not None and piece:
+                    pPr = elem.find(W + 'pPr')
+                    style = pPr.find(W + 'pStyle') if pPr is not None else None
+                    outline = pPr.find(W + 'outlineLvl') if pPr is not None else None
+                    if (style is not None and style.get(W + 'val') in styles
+                            or outline is not None and outline.get(W + 'val') == str(level - 1)):
+                        waiting.append(piece)
+                        piece = []
+                sectpr = elem.find(W + 'pPr/' + W + 'sectPr')
+            if elem.tag != W + 'sectPr':
+                piece.append(elem)
+            if sectpr is None:
+                continue
+            for done in waiting:
+                yield done, deepcopy(sectpr)
+            waiting = []
+            if level is None or elem.tag == W + 'sectPr':
+                if sectpr is not elem:
+                    sectpr.getparent().remove(sectpr)
+                if piece:
+                    yield piece, sectpr
+                piece = []
+        # a body without a final sectPr uses the default page setup
+        for done in waiting + [piece]:
+            if done:
+                yield done, None
+
+    def serialize(self, elem):
+        ''' Returns the XML of elem, without the namespace declarations the
+        root of the document already makes '''
+        xml = etree.tostring(elem)
+        end = xml.index('>')
+        def declaration(match):
+            if self.nsmap.get(match.group(1)) == match.group(2):
+                return ''
+            return match.group(0)
+        return declarationre.sub(declaration, xml[:end]) + xml[end:]
+
+    def package(self, elements, sectpr):
+        ''' Returns {part name: data} for the package of a piece. Its
+        document is put together from the XML of its elements, which is
+        much quicker than moving them into a tree of its own. '''
+        if sectpr is not None:
+            elements = elements + [sectpr]
+        xml = [self.serialize(elem) for elem in elements]
+        used = set()
+        for elem in elements:
+            used.update(relattributes(elem))
+        rels = deepcopy(self.relroot)
+        for rel in list(rels):
+            if rel.get('Id') in self.bodyrels and rel.get('Id') not in used:
+                rels.remove(rel)
+        # the parts still reachable from the package relationships
+        links = dict(self.links)
+        links['word/document.xml'] = [resolve('word/document.xml', rel.get('Target'))
+                                      for rel in rels if rel.get('TargetMode') != 'External']
+        kept = set()
+        pending = ['']
+        while pending:
+            name = pending.pop()
+            for target in links.get(name, ()):
+                if target not in kept:
+                    kept.add(target)
+                    pending.append(target)
+        types = deepcopy(self.dx.trees['[Content_Types].xml'])
+        for override in types.findall(CT + 'Override'):
+            if override.get('PartName')[1:] not in kept:
+                types.remove(override)
+        parts = {'[Content_Types].xml': version_tag + etree.tostring(types),
+                 'word/document.xml': version_tag + self.head + ''.join(xml) + self.tail,
+                 'word/_rels/document.xml.rels': version_tag + etree.tostring(rels)}
+        for name in kept | set(relspath(name) for name in kept) | set(['_rels/.rels']):
+            if name not in parts:
+                part = self.sharedpart(name)
+                if part is not None:
+                    parts[name] = part
+        return parts
+
+    def sharedpart(self, name):
+        ''' Returns the part name of the document, in a form that can be
+        written to any number of packages, or None if there is no such part '''
+        if name not in self.shared:
+            dx = self.dx
+            if dx.trees.get(name) is not None:
+                part = DeflatedPart(version_tag + etree.tostring(dx.trees[name], pretty_print = True))
+            elif name in dx.raw:
+                part = DeflatedPart(dx.raw[name])
+            else:
+                part = dx.images.get(name, dx.other.get(name))
+                if isinstance(part, basestring):
+                    part = DeflatedPart(part)
+            self.shared[name] = part
+        return self.shared[name]
+
+    def split(self, pattern, level = None, deterministic = False, timestamp = None):
+        ''' Writes each piece to a file named by pattern % n, counting from 1,
+        and returns the file names. Splitting takes the body of the document
+        apart, so it can only be done once. '''
+        if deterministic and timestamp is None:
+            timestamp = int(os.environ.get('SOURCE_DATE_EPOCH', ZIP_EPOCH))
+        outputs = []
+        with self.dx.stats.timer('split'):
+            for elements, sectpr in self.pieces(level):
+                output = pattern % (len(outputs) + 1)
+                parts = self.package(elements, sectpr)
+                docxfile = zipfile.ZipFile(output, mode='w', compression=zipfile.ZIP_DEFLATED)
+                try:
+                    for name in partorder(parts.keys()):
+                        data = parts[name]
+                        if isinstance(data, basestring):
+                            docxfile.writestr(makezipinfo(name, timestamp), data)
+                        else:
+                            data.write(docxfile, makezipinfo(name, timestamp))
+                finally:
+                    docxfile.close()
+                log.info('Saved to: %r', output)
+                outputs.append(output)
+                self.dx.stats.count('pieces_written')
+        self.dx.stats.report()
+        return outputs
+
+    ##########################
+    # end class DocXSplitter #
+    ##########################
+
+
+def split(filename, pattern, level = None, **kwargs):
+    '''Split the document filename at headings of level, or at section
+    breaks if level is None, writing the pieces to pattern % 1, pattern % 2
+    and so on. Returns the file names.'''
+    return DocXSplitter(filename).split(pattern, level, **kwargs)
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [-l LEVEL] [-o PATTERN] input.docx')
+    parser.add_option('-l', '--level', dest='level', type='int', default=None,
+                      help='split before headings of this level instead of at section breaks')
+    parser.add_option('-o', '--output', dest='pattern', default=None,
+                      help="output file names, with %d for the piece number "
+                           "(default: input-%02d.docx)")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Please supply one document to split')
+    pattern = options.pattern or os.path.splitext(args[0])[0] + '-%02d.docx'
+    outputs = split(args[0], pattern, options.level)
+    sys.stderr.write('Wrote %d pieces\n' % len(outputs))
@@ -11,11 +11,11 @@ See LICENSE for licensing information.
 
 import sys
 
-from docx import opendocx, getdocumenttext
+from docx import iterdocumenttext
 
 if __name__ == '__main__':
     try:
-        document = opendocx(sys.argv[1])
+        paragraphs = iterdocumenttext(sys.argv[1])
         newfile = open(sys.argv[2], 'w')
     except:
         print(
@@ -25,13 +25,10 @@ if __name__ == '__main__':
         )
         exit()
 
-    # Fetch all the text out of the document we just created
-    paratextlist = getdocumenttext(document)
-
-    # Make explicit unicode version
-    newparatextlist = []
-    for paratext in paratextlist:
-        newparatextlist.append(paratext.encode("utf-8"))
-
-    # Print out text of document with two newlines under each paragraph
-    newfile.write('\n\n'.join(newparatextlist))
+    # Stream the text out of the document with two newlines under each
+    # paragraph, as an explicit utf-8 encoded string
+    for i, paratext in enumerate(paragraphs):
+        if i:
+            newfile.write('\n\n')
+        newfile.write(paratext.encode("utf-8"))
+    newfile.close()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+Extract the text of a whole corpus of docx files into a JSONL file.
+
+Each document becomes one JSON record on its own line, holding its path,
+its paragraphs, the cell text of its tables and the names and descriptions
+of its images. Documents are processed in parallel by a pool of worker
+processes. A document that cannot be read gets a record with an 'error'
+instead, and does not stop the run. Documents that already have a record
+in the output file, whether extracted or failed, are skipped, so an
+interrupted run can simply be restarted; to retry failed documents, delete
+their error records first.
+
+Usage:
+  extract_corpus.py [-j JOBS] [-l FILELIST] output.jsonl [directory|file ...]
+
+Part of Python's docx module - http://github.com/mikemaccana/python-docx
+See LICENSE for licensing information.
+"""
+
+import json
+import os
+import sys
+from itertools import imap
+from multiprocessing import Pool, cpu_count
+from optparse import OptionParser
+
+from docx import DocX, getdocumenttables, getdocumenttext, nsprefixes
+
+
+def find_documents(sources, listfile=None):
+    '''Return the docx files named by a list of files and directories (which
+    are searched recursively) and, optionally, a file listing one path per
+    line ('-' for standard input).'''
+    paths = []
+    if listfile is not None:
+        f = sys.stdin if listfile == '-' else open(listfile)
+        paths.extend(line.strip() for line in f if line.strip())
+        if f is not sys.stdin:
+            f.close()
+    for source in sources:
+        if not os.path.isdir(source):
+            paths.append(source)
+            continue
+        for dirpath, dirnames, filenames in os.walk(source):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                # skip the lock files Word leaves next to open documents
+                if filename.endswith('.docx') and not filename.startswith('~$'):
+                    paths.append(os.path.join(dirpath, filename))
+    return paths
+
+
+def processed_paths(output):
+    '''Return the set of (absolute) paths that already have a record, of
+    either an extracted or a failed document, in an output file. A partly
+    written last line, left by an interrupted run, is cut off so that new
+    records can be appended.'''
+    done = set()
+    if not os.path.exists(output):
+        return done
+    f = open(output, 'r+b')
+    end = 0
+    for line in f:
+        if not line.endswith('\n'):
+            break
+        end += len(line)
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        done.add(os.path.abspath(record['path']))
+    f.truncate(end)
+    f.close()
+    return done
+
+
+def extract_document(path):
+    '''Extract one document into a JSON-serializable record. Never raises:
+    any failure is reported in the record's 'error' field instead.'''
+    try:
+        dx = DocX(path)
+        document = dx.get_document()
+        images = []
+        for elem in document.iter('{%s}graphic' % nsprefixes['a']):
+            name = dx.get_pic_name(elem)
+            description = dx.get_description(elem)
+            if name is not None or description is not None:
+                images.append({'name': name, 'description': description})
+        return {'path': path,
+                'paragraphs': getdocumenttext(document),
+                'tables': getdocumenttables(document),
+                'images': images}
+    except Exception as e:
+        return {'path': path, 'error': '%s: %s' % (e.__class__.__name__, e)}
+
+
+def extract_corpus(paths, output, jobs=None):
+    '''Extract every document in paths that isn't in output yet, appending
+    one record per document to output. Returns the number of documents
+    extracted and the number that failed.'''
+    done = processed_paths(output)
+    todo = [path for path in paths if os.path.abspath(path) not in done]
+    extracted = failed = 0
+    if not todo:
+        return extracted, failed
+    pool = None
+    if jobs == 1:
+        records = imap(extract_document, todo)
+    else:
+        pool = Pool(jobs or cpu_count(), maxtasksperchild=500)
+        records = pool.imap_unordered(extract_document, todo, chunksize=8)
+    out = open(output, 'ab')
+    try:
+        for record in records:
+            out.write(json.dumps(record) + '\n')
+            out.flush()
+            if 'error' in record:
+                failed += 1
+            else:
+                extracted += 1
+    finally:
+        out.close()
+        if pool is not None:
+            pool.terminate()
+    return extracted, failed
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] output.jsonl [directory|file ...]')
+    parser.add_option('-j', '--jobs', type='int', default=None,
+                      help='number of worker processes (default: one per CPU)')
+    parser.add_option('-l', '--list', dest='listfile', default=None,
+                      help="file listing one docx path per line, or '-' for stdin")
+    options, args = parser.parse_args()
+    if not args or (len(args) == 1 and options.listfile is None):
+        parser.error('Please supply an output file and some documents')
+    paths = find_documents(args[1:], options.listfile)
+    extracted, failed = extract_corpus(paths, args[0], options.jobs)
+    sys.stderr.write('Extracted %d documents, %d failed\n' % (extracted, failed))
+    if failed:
+        sys.exit(1)
@@ -11,7 +11,6 @@ if __name__ == '__main__':
         print "Input file: %s\nOutput file: %s\n JSON file: %s" %\
                  (input_docx, output_docx, json_filename)
         dx = DocXReplace(input_docx, json_file = json_filename)
-        dx.replace_all()
-        dx.save(output_docx)                
+        dx.render(output_docx)                
     else:
         print "Error, not enough arguments. Should be: <input docx> <output docx> <json file>"
\ No newline at end of file
@@ -0,0 +1,51 @@
+'''
+Test the synthetic templates used for benchmarking
+'''
+import shutil
+import tempfile
+from benchmark import compare, make_template, median
+from docxreplace import DocXReplace
+
+
+def testsynthetictemplate():
+    '''Ensure a synthetic template is completely filled by its payload'''
+    directory = tempfile.mkdtemp()
+    try:
+        params = {'paragraphs': 10, 'keys': 2, 'runs': 1,
+                  'tables': 2, 'rows': 3, 'cols': 4, 'images': 2}
+        template, payload = make_template(directory, params)
+        dx = DocXReplace(template, dic=payload)
+        dx.verbose = False
+        counters = dx.replace_all().counters
+        assert counters['keys_replaced'] == 20
+        assert counters['rows_inserted'] == 6
+        assert counters['images_replaced'] == 2
+    finally:
+        shutil.rmtree(directory)
+
+
+def testmedian():
+    assert median([3, 1, 2]) == 2
+    assert median([4, 1, 2, 3]) == 2.5
+
+
+def results(times, peak=1000000):
+    return {'scenarios': {'small': {'peak_memory': peak, 'phases': {
+        'save': {'times': times, 'median': median(times)}}}}}
+
+
+def testcompare():
+    '''Ensure only clear slowdowns beyond the tolerance are regressions'''
+    baseline = results([0.100, 0.101, 0.099])
+    status = lambda new: compare(baseline, new)[0][-1]
+    assert status(results([0.105, 0.104, 0.106])) == 'ok'
+    assert status(results([0.150, 0.151, 0.149])) == 'REGRESSION'
+    assert status(results([0.050, 0.051, 0.049])) == 'faster'
+    # a single fast run is not enough to tell
+    assert status(results([0.150, 0.050, 0.300])) == 'ok'
+    # noisy new runs still show a large slowdown
+    assert status(results([0.174, 0.120, 0.400])) == 'REGRESSION'
+    assert status(results([0.268, 0.200, 0.900])) == 'REGRESSION'
+    assert status(results([0.115, 0.114, 0.116])) == 'ok'
+    assert status(results([0.075, 0.074, 0.076])) == 'faster'
+    assert compare(baseline, results([0.1], peak=2000000))[1][-1] == 'REGRESSION'
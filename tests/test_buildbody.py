@@ -0,0 +1,20 @@
+'''
+Test building document bodies
+'''
+from lxml import etree
+from docx import buildbody, getdocumenttext, makeelement, paragraph
+
+
+def testbuildbody():
+    '''Ensure buildbody makes the same paragraphs as paragraph, and tables'''
+    body = makeelement('body')
+    assert buildbody(body, [('BodyText', 'Paragraph 1'),
+                            ('ListNumber', 'List Item 1', 'center'),
+                            {'contents': [['A1', 'A2'], ['B1', 'B2']]},
+                            paragraph('Paragraph 2')]) == 4
+    assert etree.tostring(body[0]) == etree.tostring(paragraph('Paragraph 1'))
+    assert etree.tostring(body[1]) == etree.tostring(
+        paragraph('List Item 1', style='ListNumber', jc='center'))
+    assert body[2].tag.endswith('}tbl')
+    assert getdocumenttext(body) == ['Paragraph 1', 'List Item 1', 'A1', 'A2', 'B1', 'B2',
+                                     'Paragraph 2']
@@ -0,0 +1,155 @@
+'''
+Test template manifests
+'''
+import json
+import os
+import shutil
+import tempfile
+from at_replace import generate_random
+from compile_template import compile_template
+from docx import getdocumenttext, paragraph
+from docxreplace import DocXReplace, PayloadError, load_manifest, manifestpath, validate_payload
+
+EXAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.path.pardir, 'example')
+EXAMPLE_FILE = os.path.join(EXAMPLE_DIR, 'moodys_example.docx')
+
+
+def testcompiletemplate():
+    '''Ensure the manifest lists keys, tables and images and is written next
+    to the template'''
+    directory = tempfile.mkdtemp()
+    try:
+        template = os.path.join(directory, 'template.docx')
+        shutil.copy(EXAMPLE_FILE, template)
+        manifest = compile_template(template)
+        assert manifestpath(template) == os.path.join(directory, 'template.manifest.json')
+        assert json.load(open(manifestpath(template))) == json.loads(json.dumps(manifest))
+        assert manifest['text']['title'][0][0] == 'word/document.xml'
+        assert 'table_1' not in manifest['text']
+        assert manifest['tables']['table_1']['columns'] == 7
+        assert manifest['images']['graph1-1.png'][0]['rId'].startswith('rId')
+        assert manifest['parts'] == ['word/document.xml']
+        assert sorted(generate_random(None, manifest['text'])) == sorted(manifest['text'])
+    finally:
+        shutil.rmtree(directory)
+
+
+def testmanifestused():
+    '''Ensure DocXReplace loads a current manifest and ignores it once the
+    template changes'''
+    directory = tempfile.mkdtemp()
+    try:
+        template = os.path.join(directory, 'template.docx')
+        shutil.copy(EXAMPLE_FILE, template)
+        compile_template(template)
+        dx = DocXReplace(template, dic={'text': {'title': 'Report'}})
+        assert dx.manifest is not None
+        dx.replace_text()
+        assert [p for p in getdocumenttext(dx.get_document()) if 'Report' in p]
+        os.utime(template, (0, 0))
+        assert load_manifest(template) is None
+    finally:
+        shutil.rmtree(directory)
+    assert load_manifest(EXAMPLE_FILE) is None
+
+
+def testvalidatepayload():
+    '''Ensure every problem with a payload is reported, and a render with a
+    bad payload fails before writing anything'''
+    directory = tempfile.mkdtemp()
+    try:
+        template = os.path.join(directory, 'template.docx')
+        shutil.copy(EXAMPLE_FILE, template)
+        manifest = compile_template(template)
+        payload = {'text': dict((key, 'x') for key in manifest['text']),
+                   'tables': dict((tag, [{}, [['x'] * table['columns']]])
+                                  for tag, table in manifest['tables'].items()),
+                   'images': {'graph1-1.png': os.path.join(EXAMPLE_DIR, 'figure1.png')}}
+        assert validate_payload(manifest, payload) == []
+        del payload['text']['title']
+        payload['tables']['table_1'][1].append(['x'])
+        payload['images']['nosuch.png'] = os.path.join(EXAMPLE_DIR, 'figure1.png')
+        problems = validate_payload(manifest, payload)
+        assert problems == ["missing text key 'title'",
+                            "row 1 of table 'table_1' should have 7 columns",
+                            "template has no image 'nosuch.png'"]
+        output = os.path.join(directory, 'output.docx')
+        dx = DocXReplace(template, dic=payload)
+        try:
+            dx.render(output, validate=True)
+            assert False, 'render should have failed'
+        except PayloadError as e:
+            assert e.problems == problems
+        assert not os.path.exists(output)
+    finally:
+        shutil.rmtree(directory)
+
+
+def testrepeatsinmanifest():
+    '''Ensure repeat blocks are listed with their keys, which aren't text
+    keys, and records are validated'''
+    directory = tempfile.mkdtemp()
+    try:
+        template = os.path.join(directory, 'repeats.docx')
+        dx = DocXReplace(None, dic={})
+        for text in ['@title@', '@#companies@', '@name@ in @title@', '@/companies@']:
+            dx.body[0].append(paragraph(text))
+        dx.save(template)
+        manifest = compile_template(template)
+        assert sorted(manifest['text']) == ['title']
+        assert manifest['repeats']['companies']['keys'] == ['name', 'title']
+        assert manifest['repeats']['companies']['offset'] > 0
+        payload = {'text': {'title': 'Europe'},
+                   'repeats': {'companies': [{'name': 'Acme'}, {'title': 'x'}]}}
+        assert validate_payload(manifest, payload) == [
+            "record 1 of repeat 'companies' is missing 'name'"]
+        del payload['repeats']
+        assert validate_payload(manifest, payload) == ["missing repeat 'companies'"]
+    finally:
+        shutil.rmtree(directory)
+
+
+def testkeys():
+    '''Ensure any key between two @s is found, but not the text between two
+    email addresses, and a compiled template still replaces every key'''
+    directory = tempfile.mkdtemp()
+    try:
+        template = os.path.join(directory, 'mail.docx')
+        dx = DocXReplace(None, dic={})
+        for text in ['Write to a@example.com or b@example.com', '@ 5 @ and @',
+                     'Ask @contact.name@ or @contact-2@', 'Revenue @2019@ for @first name@']:
+            dx.body[0].append(paragraph(text))
+        dx.save(template)
+        manifest = compile_template(template)
+        assert sorted(manifest['text']) == ['2019', 'contact-2', 'contact.name', 'first name']
+        output = os.path.join(directory, 'output.docx')
+        dx = DocXReplace(template, dic={'text': {'2019': '$5M', 'first name': 'Bob'}})
+        assert dx.manifest is not None
+        dx.render(output)
+        text = getdocumenttext(DocXReplace(output, dic={}).get_document())
+        assert 'Revenue $5M for Bob' in text
+        assert 'Write to a@example.com or b@example.com' in text
+    finally:
+        shutil.rmtree(directory)
+
+
+def testexamplevalidates():
+    '''Ensure the example payload fits the example template, and renders
+    only validate when asked to'''
+    directory = tempfile.mkdtemp()
+    try:
+        template = os.path.join(directory, 'template.docx')
+        shutil.copy(EXAMPLE_FILE, template)
+        manifest = compile_template(template)
+        payload = json.load(open(os.path.join(EXAMPLE_DIR, 'replace.json')))
+        for name, path in payload['images'].items():
+            payload['images'][name] = os.path.join(EXAMPLE_DIR, path)
+        assert validate_payload(manifest, payload) == []
+        output = os.path.join(directory, 'output.docx')
+        dx = DocXReplace(template, dic={'text': {'title': 'Report'}})
+        assert dx.manifest is not None
+        dx.render(output)
+        assert os.path.exists(output)
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,70 @@
+'''
+Test rendering in the background with AsyncRenderer
+'''
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+from StringIO import StringIO
+from docx import DocX, getdocumenttext
+from docxasync import AsyncRenderer
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir)
+EXAMPLE_FILE = os.path.join(ROOT_DIR, 'example', 'moodys_example.docx')
+EXAMPLE_JSON = os.path.join(ROOT_DIR, 'example', 'replace.json')
+
+
+def testrender():
+    '''Ensure concurrent renders all complete, to bytes and to files'''
+    payload = json.load(open(EXAMPLE_JSON))
+    payload['images'] = {'graph1-1.png': os.path.join(ROOT_DIR, 'image1.png')}
+    directory = tempfile.mkdtemp()
+    done = []
+    try:
+        renderer = AsyncRenderer(processes=2, threads=2, max_renders=2)
+        results = [renderer.render(EXAMPLE_FILE, payload, callback=done.append)
+                   for i in range(3)]
+        output = os.path.join(directory, 'out.docx')
+        tofile = renderer.render(EXAMPLE_FILE, EXAMPLE_JSON, output)
+        missing = renderer.render(os.path.join(directory, 'missing.docx'), payload)
+        renderer.close()
+        assert len(done) == 3
+        for result in results:
+            data = result.get()
+            assert result.successful()
+        assert tofile.get() == output
+        assert zipfile.ZipFile(output).testzip() is None
+        assert not missing.successful()
+        dx = DocX(StringIO(data))
+        assert 'word/media/image1.png' in dx.images
+        assert '@title@' not in u'\n'.join(getdocumenttext(dx.get_document()))
+    finally:
+        shutil.rmtree(directory)
+
+
+def testrenderbroken():
+    '''Ensure a template that can't be parsed fails its render without
+    keeping its slot, so later renders and close() still finish'''
+    directory = tempfile.mkdtemp()
+    try:
+        broken = os.path.join(directory, 'broken.docx')
+        source = zipfile.ZipFile(EXAMPLE_FILE)
+        target = zipfile.ZipFile(broken, 'w')
+        for name in source.namelist():
+            data = source.read(name)
+            if name == 'word/document.xml':
+                data = '<broken'
+            target.writestr(name, data)
+        target.close()
+        renderer = AsyncRenderer(processes=1, threads=2, max_renders=1)
+        failed = renderer.render(broken, EXAMPLE_JSON)
+        failed.wait(60)
+        assert not failed.successful()
+        assert 'XMLSyntaxError' in str(failed.error)
+        after = renderer.render(EXAMPLE_FILE, EXAMPLE_JSON)
+        after.wait(60)
+        assert after.successful()
+        renderer.close()
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,71 @@
+'''
+Test the inverted index over many documents
+'''
+import os
+import shutil
+import tempfile
+from docx import DocX, paragraph
+from docxindex import DocIndex, tokenize
+
+tmpdir = None
+
+
+def setup_module():
+    global tmpdir
+    tmpdir = tempfile.mkdtemp()
+
+
+def teardown_module():
+    shutil.rmtree(tmpdir)
+
+
+def makedoc(name, paragraphs):
+    '''Save a docx with the given paragraphs into the temporary directory'''
+    dx = DocX()
+    dx.verbose = False
+    for paratext in paragraphs:
+        dx.body[0].append(paragraph(paratext))
+    path = os.path.join(tmpdir, name)
+    dx.save(path)
+    return path
+
+
+def testtokenize():
+    '''Ensure terms are lower case words'''
+    assert tokenize(u'GTN rose, gray-tv.') == ['gtn', 'rose', 'gray', 'tv']
+
+
+def testindexandsearch():
+    '''Ensure terms and phrases are found and can be updated'''
+    a = makedoc('a.docx', ['Gray Television (GTN) rose', 'Nothing here'])
+    b = makedoc('b.docx', ['Moody rates GTN', 'Television, gray and old'])
+    index = DocIndex(os.path.join(tmpdir, 'index'))
+    assert index.update([a, b]) == 2
+    index.save()
+    index = DocIndex(os.path.join(tmpdir, 'index'))
+    assert index.lookup('gtn') == [(a, 0), (b, 0)]
+    assert [r[:2] for r in index.phrase(u'gray television')] == [(a, 0)]
+    assert [r[:2] for r in index.search(r'\(GTN\)', [u'gtn'])] == [(a, 0)]
+    # unchanged documents are skipped, changed ones reindexed
+    assert index.update([a, b]) == 0
+    os.remove(b)
+    b = makedoc('b.docx', ['Rates changed for gray television holdings'])
+    assert index.update([a, b]) == 1
+    assert index.lookup('gtn') == [(a, 0)]
+    assert [r[:2] for r in index.phrase(u'Gray Television')] == [(a, 0), (b, 0)]
+    index.optimize()
+    assert len(index.segments) == 1
+    assert DocIndex(os.path.join(tmpdir, 'index')).lookup('television') == [(a, 0), (b, 0)]
+
+
+def testupdatedeleted():
+    '''Ensure a deleted document is dropped without stopping the update'''
+    a = makedoc('c.docx', ['Gone tomorrow'])
+    b = makedoc('d.docx', ['Still here'])
+    index = DocIndex(os.path.join(tmpdir, 'deleted'))
+    assert index.update([a, b]) == 2
+    os.remove(a)
+    c = makedoc('e.docx', ['Gone is not this one'])
+    assert index.update([a, b, c]) == 1
+    assert len(index) == 2
+    assert index.lookup('gone') == [(c, 0)]
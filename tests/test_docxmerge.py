@@ -0,0 +1,110 @@
+'''
+Test concatenating documents
+'''
+import os
+import shutil
+import tempfile
+import zipfile
+from lxml import etree
+from docx import DocX, getdocumenttext, nsprefixes
+from docxmerge import concatenate
+
+EXAMPLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.path.pardir, 'example', 'moodys_example.docx')
+
+W = '{%s}' % nsprefixes['w']
+R = '{%s}' % nsprefixes['r']
+
+
+def testconcatenate():
+    '''Ensure bodies are appended after section breaks, media is shared and
+    ids stay unique and resolvable'''
+    directory = tempfile.mkdtemp()
+    try:
+        output = os.path.join(directory, 'merged.docx')
+        stats = concatenate([EXAMPLE_FILE] * 3, output)
+        assert stats.counters['documents_merged'] == 3
+        assert stats.counters['parts_shared'] > 0
+        media = lambda path: [n for n in zipfile.ZipFile(path).namelist() if '/media/' in n]
+        assert len(media(output)) == len(media(EXAMPLE_FILE))
+        example = DocX(EXAMPLE_FILE)
+        merged = DocX(output)
+        assert getdocumenttext(merged.get_document()) == getdocumenttext(example.get_document()) * 3
+        body = merged.body[0]
+        assert body[-1].tag == W + 'sectPr'
+        sections = lambda dx: len(dx.body[0].findall(W + 'p/' + W + 'pPr/' + W + 'sectPr'))
+        assert sections(merged) == sections(example) * 3 + 2
+        docprs = [e.get('id') for e in body.iter('{%s}docPr' % nsprefixes['wp'])]
+        assert len(docprs) == len(set(docprs))
+        bookmarks = [e.get(W + 'id') for e in body.iter(W + 'bookmarkStart')]
+        assert len(bookmarks) == len(set(bookmarks))
+        relids = set(rel.get('Id') for rel in merged.trees['word/_rels/document.xml.rels'])
+        for elem in body.iter():
+            for name, value in elem.attrib.items():
+                if name.startswith(R):
+                    assert value in relids
+        numids = set(num.get(W + 'numId') for num in
+                     merged.get_tree('word/numbering.xml').iter(W + 'num'))
+        used = set(e.get(W + 'val') for e in body.iter(W + 'numId'))
+        assert used <= numids | set(['0'])
+    finally:
+        shutil.rmtree(directory)
+
+
+def testconflictingstyles():
+    '''Ensure a style defined differently in an appended document is copied
+    under a new id'''
+    directory = tempfile.mkdtemp()
+    try:
+        changed = os.path.join(directory, 'changed.docx')
+        source = zipfile.ZipFile(EXAMPLE_FILE)
+        target = zipfile.ZipFile(changed, 'w', zipfile.ZIP_DEFLATED)
+        for info in source.infolist():
+            data = source.read(info.filename)
+            if info.filename == 'word/styles.xml':
+                data = data.replace('w:styleId="TableContents">',
+                                    'w:styleId="TableContents"><w:uiPriority w:val="7"/>', 1)
+                assert 'w:uiPriority w:val="7"' in data
+            target.writestr(info, data)
+        target.close()
+        output = os.path.join(directory, 'merged.docx')
+        stats = concatenate([EXAMPLE_FILE, changed], output)
+        assert stats.counters['styles_copied'] == 1
+        merged = DocX(output)
+        styleids = [s.get(W + 'styleId') for s in merged.get_tree('word/styles.xml').iter(W + 'style')]
+        assert 'TableContents' in styleids and 'TableContents2' in styleids
+        used = [e.get(W + 'val') for e in merged.body[0].iter(W + 'pStyle')]
+        assert used.count('TableContents2') == used.count('TableContents')
+    finally:
+        shutil.rmtree(directory)
+
+
+def testsectionheaders():
+    '''Ensure the final section of an appended document loses its header
+    references along with the rest of its body'''
+    directory = tempfile.mkdtemp()
+    try:
+        headed = os.path.join(directory, 'headed.docx')
+        source = zipfile.ZipFile(EXAMPLE_FILE)
+        target = zipfile.ZipFile(headed, 'w', zipfile.ZIP_DEFLATED)
+        for info in source.infolist():
+            data = source.read(info.filename)
+            if info.filename == 'word/document.xml':
+                document = etree.fromstring(data)
+                sectpr = document.find(W + 'body')[-1]
+                assert sectpr.tag == W + 'sectPr'
+                reference = etree.Element(W + 'headerReference')
+                reference.set(W + 'type', 'default')
+                reference.set(R + 'id', 'rId999')
+                sectpr.insert(0, reference)
+                data = etree.tostring(document)
+            target.writestr(info, data)
+        target.close()
+        output = os.path.join(directory, 'merged.docx')
+        concatenate([EXAMPLE_FILE, headed], output)
+        body = DocX(output).body[0]
+        assert body[-1].tag == W + 'sectPr'
+        assert not list(body.iter(W + 'headerReference'))
+        assert 'rId999' not in zipfile.ZipFile(output).read('word/document.xml')
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,264 @@
+'''
+Test template filling with DocXReplace
+'''
+import json
+import os
+import shutil
+import struct
+import tempfile
+from array import array
+import zipfile
+from StringIO import StringIO
+from lxml import etree
+from docx import makeelement, make_row, make_rows, paragraph, getdocumenttext, clean
+from docxreplace import DocXReplace, validate_payload
+
+EXAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.path.pardir, 'example')
+EXAMPLE_FILE = os.path.join(EXAMPLE_DIR, 'moodys_example.docx')
+EXAMPLE_JSON = os.path.join(EXAMPLE_DIR, 'replace.json')
+
+
+def newreplace(elements, replacements):
+    '''Make a DocXReplace over a new document holding elements'''
+    dx = DocXReplace(None, dic=replacements)
+    dx.verbose = False
+    for element in elements:
+        dx.body[0].append(element)
+    return dx
+
+
+def splitparagraph(pieces):
+    '''Make a paragraph with one plain run per piece, and proofing marks in
+    between, like Word does'''
+    para = paragraph(pieces)
+    for run in para.findall(makeelement('r').tag)[1:]:
+        run.addprevious(makeelement('proofErr', attributes={'type': 'spellStart'}))
+    return para
+
+
+def testcleancoalesce():
+    '''Ensure adjacent runs with the same formatting are merged'''
+    para = splitparagraph(['@na', 'me', '', '@ and ', ('bold', 'b'), ' ok'])
+    clean(para, coalesce=True)
+    runs = para.findall(makeelement('r').tag)
+    assert [r.findtext(makeelement('t').tag) for r in runs] == ['@name@ and ', 'bold', ' ok']
+    # the marks before the runs that weren't merged are kept
+    assert len(para.findall(makeelement('proofErr').tag)) == 2
+
+
+def testcleankeepsotherproofmarks():
+    '''Ensure coalescing only drops the proofing marks between the runs it
+    merges'''
+    para = splitparagraph(['@na', 'me@', ('bold', 'b')])
+    para.append(makeelement('proofErr', attributes={'type': 'gramEnd'}))
+    clean(para, coalesce=True)
+    assert [r.findtext(makeelement('t').tag) for r in para.findall(makeelement('r').tag)] == [
+        '@name@', 'bold']
+    marks = para.findall(makeelement('proofErr').tag)
+    assert [mark.getprevious() is not None and mark.getprevious().tag for mark in marks] == [
+        makeelement('r').tag, makeelement('r').tag]
+
+
+def testcleanwithoutcoalesce():
+    '''Ensure plain cleaning only drops empty elements'''
+    para = splitparagraph(['@na', 'me@', ''])
+    para.append(makeelement('r'))
+    clean(para)
+    assert len(para.findall(makeelement('r').tag)) == 3
+    assert len(para.findall('.//' + makeelement('t').tag)) == 2
+    assert len(para.findall(makeelement('proofErr').tag)) == 2
+
+
+def testcoalescedplaceholders():
+    '''Ensure placeholders split over runs are replaced after cleaning'''
+    dx = newreplace([splitparagraph(['Dear @na', 'me@,'])], {'text': {'name': 'Bob'}})
+    dx.clean(coalesce=True)
+    dx.replace_text()
+    assert getdocumenttext(dx.get_document()) == ['Dear Bob,']
+
+
+def testrenderstats():
+    '''Ensure phases are timed and work is counted'''
+    payload = json.load(open(EXAMPLE_JSON))
+    metrics = []
+    dx = DocXReplace(EXAMPLE_FILE, dic=payload,
+                     metrics=lambda name, value: metrics.append(name))
+    dx.verbose = False
+    stats = dx.replace_all()
+    dx.save(StringIO())
+    for phase in ['load', 'payload', 'replace_text', 'replace_tables', 'replace_images',
+                  'serialize', 'compress']:
+        # one sample per render, however many parts the phase covers
+        assert metrics.count(phase + '.wall') == 1
+        assert len(stats.timings[phase]) == 2
+    assert len(stats.timings['parse/word/document.xml']) == 2
+    assert not [name for name in metrics if name.startswith('parse/')]
+    counters = stats.as_dict()['counters']
+    assert counters['keys_replaced'] > 0
+    assert counters['rows_inserted'] == 62
+    assert counters['elements_visited'] > 0
+    assert counters['bytes_written'] > 0
+    assert 'bytes_written' in metrics
+
+
+def testrenderprofile():
+    '''Ensure a profiled render writes its reports next to the output'''
+    directory = tempfile.mkdtemp()
+    try:
+        output = os.path.join(directory, 'out.docx')
+        dx = DocXReplace(EXAMPLE_FILE, json_file=EXAMPLE_JSON)
+        dx.render(output, profile=True)
+        assert os.path.exists(output)
+        assert os.path.exists(output + '.moodys_example.prof')
+        report = open(output + '.moodys_example.txt').read()
+        assert 'replace_all' in report
+        dx = DocXReplace(EXAMPLE_FILE, json_file=EXAMPLE_JSON)
+        dx.render(output, profile=False)
+        assert sorted(os.listdir(directory)) == ['out.docx', 'out.docx.moodys_example.prof',
+                                                 'out.docx.moodys_example.txt']
+    finally:
+        shutil.rmtree(directory)
+
+
+def testreplaceincontentparts():
+    '''Ensure headers and footers are filled and parts without placeholders
+    are left unparsed'''
+    part = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\r\n'
+            '<w:%s xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+            '<w:p><w:r><w:t>%s</w:t></w:r></w:p></w:%s>')
+    parts = {'word/header1.xml': part % ('hdr', 'Prepared for @name@', 'hdr'),
+             'word/footer1.xml': part % ('ftr', 'Mail user@example.com', 'ftr'),
+             'word/footnotes.xml': part % ('footnotes', 'Plain text', 'footnotes')}
+    directory = tempfile.mkdtemp()
+    try:
+        template = os.path.join(directory, 'template.docx')
+        shutil.copy(EXAMPLE_FILE, template)
+        archive = zipfile.ZipFile(template, 'a')
+        for name in parts:
+            archive.writestr(name, parts[name])
+        archive.close()
+        dx = DocXReplace(template, dic={'text': {'name': 'Bob'}})
+        dx.replace_text()
+        assert getdocumenttext(dx.get_tree('word/header1.xml')) == ['Prepared for Bob']
+        assert 'word/footer1.xml' in dx.raw
+        assert 'word/footnotes.xml' in dx.raw
+        assert dx.get_stats().counters['parts_skipped'] == 2
+        output = StringIO()
+        dx.save(output)
+        saved = zipfile.ZipFile(output)
+        assert saved.read('word/footer1.xml') == parts['word/footer1.xml']
+        assert 'Prepared for Bob' in saved.read('word/header1.xml')
+    finally:
+        shutil.rmtree(directory)
+
+
+def testreplaceparallel():
+    '''Ensure filling the body in worker processes gives the same document
+    as filling it in this process'''
+    payload = json.load(open(EXAMPLE_JSON))
+    serial = DocXReplace(EXAMPLE_FILE, dic=payload)
+    serial.replace_all()
+    parallel = DocXReplace(EXAMPLE_FILE, dic=payload)
+    parallel.parallel_threshold = 0
+    parallel.replace_all(processes=2)
+    assert parallel.get_stats().counters['chunks'] > 1
+    assert getdocumenttext(parallel.get_document()) == getdocumenttext(serial.get_document())
+    assert parallel.get_stats().counters['rows_inserted'] == serial.get_stats().counters['rows_inserted']
+    assert parallel.body[0][-1].tag.endswith('}sectPr')
+
+
+def testreplacerepeats():
+    '''Ensure a repeat block is copied once per record, in order, with each
+    copy filled from its record or else the text replacements'''
+    dx = newreplace([paragraph('Companies of @title@'),
+                     paragraph('@#companies@'),
+                     splitparagraph(['@name@', ' in @title@']),
+                     paragraph('Rating @rating@'),
+                     paragraph('@/companies@'),
+                     paragraph('The end')],
+                    {'text': {'title': 'Europe', 'rating': 'none'},
+                     'repeats': {'companies': [{'name': 'Acme', 'rating': 'AA'},
+                                               {'name': 'Initech'},
+                                               {'name': 'Globex', 'rating': 'B'}]}})
+    dx.replace_all()
+    assert getdocumenttext(dx.get_document()) == [
+        'Companies of Europe',
+        'Acme in Europe', 'Rating AA',
+        'Initech in Europe', 'Rating none',
+        'Globex in Europe', 'Rating B',
+        'The end']
+    assert dx.get_stats().counters['records_repeated'] == 3
+
+
+def testrepeatvalueswithtags():
+    '''Ensure a record value holding a placeholder is put in as it is, in
+    serial and parallel renders'''
+    for processes in (1, 2):
+        dx = newreplace([paragraph('Companies of @title@'),
+                         paragraph('@#companies@'),
+                         paragraph('@name@ in @title@'),
+                         paragraph('@/companies@')],
+                        {'text': {'title': 'Europe'},
+                         'repeats': {'companies': [{'name': '@title@ Inc'}]}})
+        dx.parallel_threshold = 1
+        dx.replace_all(processes=processes)
+        assert getdocumenttext(dx.get_document()) == [
+            'Companies of Europe', '@title@ Inc in Europe']
+        assert not [elem for elem in dx.body[0] if elem.tag is etree.Comment]
+
+
+def writenpy(path, descr, shape, values):
+    '''Write values to path as a .npy file holding an array of descr'''
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': %r, }" % (descr, shape)
+    header += ' ' * (-(len(header) + 11) % 16) + '\n'
+    f = open(path, 'wb')
+    f.write('\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header)
+    f.write(struct.pack(descr[0] + {'f8': 'd', 'i4': 'i'}[descr[1:]] * len(values), *values))
+    f.close()
+
+
+def testreplacetablecolumns():
+    '''Ensure a table given as columns from lists, arrays and .npy files
+    is filled like the same table given as rows'''
+    directory = tempfile.mkdtemp()
+    try:
+        labels = ['Scale', 'Margin', 'Debt']
+        values = [391.9, 336.6, 16.5, 34.78, 28.57, 21.7, 2.5, 3.25, -1.0]
+        writenpy(os.path.join(directory, 'values.npy'), '<f8', (3, 3), values)
+        writenpy(os.path.join(directory, 'ranks.npy'), '>i4', (3,), [3, 1, 2])
+        spec = {'columns': [labels, os.path.join(directory, 'values.npy'),
+                            os.path.join(directory, 'ranks.npy'),
+                            array('d', [0.5, 0.25, 0.125]), array('l', [7, 8, 9])],
+                'formats': [None, '$%.1fM', '%.2f', '%.1f%%', '#%d', '%.3f', None]}
+        rows = [[labels[i], '$%.1fM' % values[3 * i], '%.2f' % values[3 * i + 1],
+                 '%.1f%%' % values[3 * i + 2], '#%d' % [3, 1, 2][i],
+                 '%.3f' % [0.5, 0.25, 0.125][i], str(7 + i)] for i in range(3)]
+        payload = json.load(open(EXAMPLE_JSON))
+        settings = payload['tables']['table_1'][0]
+        manifest = {'text': {}, 'tables': {'table_1': {'columns': 7}}, 'images': {}}
+        assert validate_payload(manifest, {'tables': {'table_1': [settings, spec]}}) == []
+        narrow = dict(spec, columns=spec['columns'][1:], formats=None)
+        assert validate_payload(manifest, {'tables': {'table_1': [settings, narrow]}}) == [
+            "table 'table_1' should have 7 columns, not 6"]
+        payload['tables']['table_1'] = [settings, rows]
+        expected = DocXReplace(EXAMPLE_FILE, dic=payload)
+        expected.replace_all()
+        payload['tables']['table_1'] = [settings, spec]
+        dx = DocXReplace(EXAMPLE_FILE, dic=payload)
+        dx.replace_all()
+        assert getdocumenttext(dx.get_document()) == getdocumenttext(expected.get_document())
+        assert '$391.9M' in getdocumenttext(dx.get_document())
+        assert dx.get_stats().counters['rows_inserted'] == expected.get_stats().counters['rows_inserted']
+    finally:
+        shutil.rmtree(directory)
+
+
+def testmakerows():
+    '''Ensure make_rows makes the same rows as make_row'''
+    rows = [['A1', 'A2'], ['', 'B 2'], [['C1', 'C1b'], 'C2'], ['D1', 'D2'], [u'E\xe91', 'E2']]
+    kwargs = {'font_face': 'Helvetica', 'font_size': '16', 'borders': ['top']}
+    made = list(make_rows(rows, **kwargs))
+    assert len(made) == len(rows)
+    for row, contentrow in zip(made, rows):
+        assert etree.tostring(row) == etree.tostring(make_row(contentrow, **kwargs))
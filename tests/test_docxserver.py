@@ -0,0 +1,121 @@
+'''
+Test the prefork render server
+'''
+import json
+import os
+import shutil
+import tempfile
+import threading
+import urllib2
+from multiprocessing import Process
+from StringIO import StringIO
+from compile_template import compile_template
+from docx import DocX, getdocumenttext
+from docxserver import RenderServer, serve
+
+EXAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.path.pardir, 'example')
+
+server = None
+process = None
+directory = None
+
+
+def setup_module():
+    global server, process, directory
+    # the example template, compiled so that payloads are validated
+    directory = tempfile.mkdtemp()
+    template = os.path.join(directory, 'moodys_example.docx')
+    shutil.copy(os.path.join(EXAMPLE_DIR, 'moodys_example.docx'), template)
+    compile_template(template)
+    server = RenderServer(('127.0.0.1', 0), directory)
+    process = Process(target=serve, args=(server, 2, 3, 512 << 20, True))
+    process.start()
+
+
+def teardown_module():
+    process.terminate()
+    process.join()
+    server.server_close()
+    shutil.rmtree(directory)
+
+
+def request(path, data=None):
+    '''Make a request to the server, returning the status and body'''
+    url = 'http://127.0.0.1:%d%s' % (server.server_address[1], path)
+    try:
+        response = urllib2.urlopen(url, data)
+        return response.getcode(), response.read()
+    except urllib2.HTTPError as e:
+        return e.code, e.read()
+
+
+def testrender():
+    '''Ensure a rendered document comes back filled in, across recycled
+    workers'''
+    payload = json.load(open(os.path.join(EXAMPLE_DIR, 'replace.json')))
+    payload['images'] = {}
+    for i in range(8):
+        status, data = request('/render?template=moodys_example.docx', json.dumps(payload))
+        assert status == 200
+    dx = DocX(StringIO(data))
+    text = u'\n'.join(getdocumenttext(dx.get_document()))
+    assert '@title@' not in text
+    assert payload['text']['title'] in text
+
+
+def testerrors():
+    '''Ensure bad requests get error statuses instead of documents'''
+    assert request('/health')[0] == 200
+    assert request('/render?template=missing.docx', '{}')[0] == 404
+    assert request('/render?template=../setup.py', '{}')[0] == 404
+    assert request('/render?template=moodys_example.docx', '{not json')[0] == 400
+    assert request('/render', '{}')[0] == 400
+    assert request('/render?template=moodys_example.docx', '[1]')[0] == 400
+
+
+def testrendererrors():
+    '''Ensure errors from rendering a template that exists are server
+    errors, whatever their type'''
+    local = RenderServer(('127.0.0.1', 0), directory)
+    def broken(name, payload):
+        return {}['bug']
+    local.cache.render = broken
+    url = 'http://127.0.0.1:%d/render?template=moodys_example.docx' % local.server_address[1]
+    statuses = []
+    def post():
+        try:
+            statuses.append(urllib2.urlopen(url, '{}').getcode())
+        except urllib2.HTTPError as e:
+            statuses.append(e.code)
+    client = threading.Thread(target=post)
+    client.start()
+    try:
+        local.handle_request()
+    finally:
+        client.join()
+        local.server_close()
+    assert statuses == [500]
+
+
+def testbadpayload():
+    '''Ensure a payload that doesn't fit the compiled template is rejected
+    with its problems'''
+    payload = json.load(open(os.path.join(EXAMPLE_DIR, 'replace.json')))
+    payload['images'] = {}
+    del payload['text']['title']
+    payload['tables']['table_1'][1].append(['x'])
+    status, data = request('/render?template=moodys_example.docx', json.dumps(payload))
+    assert status == 400
+    assert "missing text key 'title'" in data
+    assert "row 5 of table 'table_1' should have 7 columns" in data
+
+
+def testmemory():
+    '''Ensure workers report their memory, sharing the preloaded template'''
+    status, data = request('/memory')
+    assert status == 200
+    usage = json.loads(data)
+    if usage is not None:
+        assert usage['rss'] == usage['shared'] + usage['private']
+        assert usage['shared'] > 0
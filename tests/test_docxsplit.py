@@ -0,0 +1,88 @@
+'''
+Test splitting documents into pieces
+'''
+import os
+import posixpath
+import shutil
+import tempfile
+import zipfile
+from lxml import etree
+from docx import DocX, getdocumenttext, heading, nsprefixes
+from docxsplit import resolve, split
+
+EXAMPLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.path.pardir, 'example', 'moodys_example.docx')
+
+W = '{%s}' % nsprefixes['w']
+R = '{%s}' % nsprefixes['r']
+
+
+def checkpiece(path):
+    '''Ensure every relationship of the main document resolves and every
+    media part in the package is used by a part in it'''
+    package = zipfile.ZipFile(path)
+    names = set(package.namelist())
+    dx = DocX(path)
+    relids = set(rel.get('Id') for rel in dx.trees['word/_rels/document.xml.rels'])
+    for elem in dx.body[0].iter():
+        for name, value in elem.attrib.items():
+            if name.startswith(R):
+                assert value in relids
+    targets = set()
+    for name in names:
+        if name.endswith('.rels'):
+            directory, basename = posixpath.split(name)
+            source = posixpath.join(posixpath.dirname(directory), basename[:-len('.rels')])
+            for rel in etree.fromstring(package.read(name)):
+                if rel.get('TargetMode') != 'External':
+                    targets.add(resolve(source, rel.get('Target')))
+    assert [n for n in names if '/media/' in n]
+    for name in names:
+        if '/media/' in name:
+            assert name in targets
+    return dx
+
+
+def testsplitsections():
+    '''Ensure a document is cut after each section break'''
+    directory = tempfile.mkdtemp()
+    try:
+        example = DocX(EXAMPLE_FILE)
+        body = example.body[0]
+        breaks = len(body.findall(W + 'p/' + W + 'pPr/' + W + 'sectPr'))
+        outputs = split(EXAMPLE_FILE, os.path.join(directory, 'piece-%d.docx'))
+        assert len(outputs) == breaks + 1
+        text = []
+        for output in outputs:
+            dx = checkpiece(output)
+            assert dx.body[0][-1].tag == W + 'sectPr'
+            assert dx.body[0].find(W + 'p/' + W + 'pPr/' + W + 'sectPr') is None
+            text.extend(getdocumenttext(dx.get_document()))
+        assert text == getdocumenttext(example.get_document())
+    finally:
+        shutil.rmtree(directory)
+
+
+def testsplitheadings():
+    '''Ensure a document is cut before headings of the chosen level only'''
+    directory = tempfile.mkdtemp()
+    try:
+        source = os.path.join(directory, 'chapters.docx')
+        example = DocX(EXAMPLE_FILE)
+        body = example.body[0]
+        body.insert(len(body) - 2, heading('Chapter Two', 1))
+        body.insert(len(body) - 4, heading('Section', 2))
+        body.insert(0, heading('Chapter One', 1))
+        example.save(source)
+        outputs = split(source, os.path.join(directory, 'chapter-%d.docx'), level = 1)
+        assert len(outputs) == 2
+        pieces = [checkpiece(output) for output in outputs]
+        assert getdocumenttext(pieces[0].get_document())[0] == 'Chapter One'
+        assert getdocumenttext(pieces[1].get_document())[0] == 'Chapter Two'
+        assert (getdocumenttext(pieces[0].get_document()) +
+                getdocumenttext(pieces[1].get_document()) ==
+                getdocumenttext(DocX(source).get_document()))
+        for piece in pieces:
+            assert piece.body[0][-1].tag == W + 'sectPr'
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,59 @@
+'''
+Test corpus text extraction
+'''
+import json
+import os
+import shutil
+import tempfile
+from extract_corpus import extract_corpus, extract_document, find_documents
+
+EXAMPLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.path.pardir, 'example', 'moodys_example.docx')
+
+
+def testextractdocument():
+    '''Ensure a record holds paragraphs, tables and images'''
+    record = extract_document(EXAMPLE_FILE)
+    assert 'error' not in record
+    assert record['paragraphs']
+    assert '@@table_1@@' in record['tables'][0][0][0]
+    assert 'graph1-1.png' in [image['name'] for image in record['images']]
+
+
+def testextractbrokendocument():
+    '''Ensure unreadable documents give an error record'''
+    record = extract_document(os.path.abspath(__file__))
+    assert record['error'].startswith('BadZipfile')
+
+
+def testextractcorpusresumes():
+    '''Ensure documents already in the output are skipped'''
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name in ['a.docx', 'b.docx', '~$a.docx']:
+            shutil.copyfile(EXAMPLE_FILE, os.path.join(tmpdir, name))
+        paths = find_documents([tmpdir])
+        assert [os.path.basename(p) for p in paths] == ['a.docx', 'b.docx']
+        output = os.path.join(tmpdir, 'corpus.jsonl')
+        assert extract_corpus(paths[:1], output, jobs=1) == (1, 0)
+        # simulate a record cut off by an interrupted run
+        open(output, 'ab').write('{"path": "b.d')
+        assert extract_corpus(paths, output, jobs=2) == (1, 0)
+        records = [json.loads(line) for line in open(output)]
+        assert sorted(r['path'] for r in records) == paths
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def testextractcorpusskipsfailures():
+    '''Ensure documents that failed are not extracted again on resume'''
+    tmpdir = tempfile.mkdtemp()
+    try:
+        broken = os.path.join(tmpdir, 'broken.docx')
+        open(broken, 'wb').write('not a zip file')
+        output = os.path.join(tmpdir, 'corpus.jsonl')
+        assert extract_corpus([broken], output, jobs=1) == (0, 1)
+        assert extract_corpus([broken], output, jobs=1) == (0, 0)
+        assert len(open(output).readlines()) == 1
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,175 @@
+'''
+Test loading and saving whole packages with the DocX class
+'''
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+from StringIO import StringIO
+from docx import DocX, FilePart, ZipPart, mappedfile, opendocx
+
+EXAMPLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.path.pardir, 'example', 'moodys_example.docx')
+
+
+def opendx(filename=EXAMPLE_FILE):
+    '''Open a quiet DocX'''
+    dx = DocX(filename)
+    dx.verbose = False
+    return dx
+
+
+def savebytes(dx, **kwargs):
+    '''Save a DocX into memory and return the package bytes'''
+    output = StringIO()
+    dx.save(output, **kwargs)
+    return output.getvalue()
+
+
+def testdeterministicsave():
+    '''Ensure identical documents save to identical bytes'''
+    first = savebytes(opendx(), deterministic=True)
+    second = savebytes(opendx(), deterministic=True)
+    assert first == second
+
+
+def testdeterministicnewdocument():
+    '''Ensure generated core properties use the injected timestamp'''
+    data = savebytes(DocX(), timestamp=1382400000)
+    core = zipfile.ZipFile(StringIO(data)).read('docProps/core.xml')
+    assert '2013-10-22T00:00:00Z' in core
+    assert savebytes(DocX(), timestamp=1382400000) == data
+
+
+def testpartorder():
+    '''Ensure content types are written first and the rest sorted'''
+    names = zipfile.ZipFile(StringIO(savebytes(opendx()))).namelist()
+    assert names[0] == '[Content_Types].xml'
+    assert names[1] == '_rels/.rels'
+    assert names[2:] == sorted(names[2:])
+
+
+def testlogfile():
+    '''Ensure logging is quiet by default and set_log_file() enables it'''
+    dx = opendx()
+    logged = StringIO()
+    dx.set_log_file(logged)
+    try:
+        savebytes(dx)
+        opendx()
+    finally:
+        dx.set_log_file(None)
+    assert 'Saved to' in logged.getvalue()
+    assert "Opening file" in logged.getvalue()
+    size = len(logged.getvalue())
+    savebytes(opendx())
+    assert len(logged.getvalue()) == size
+
+
+def testlazyimports():
+    '''Ensure importing docx leaves out modules only some functions need'''
+    code = ('import sys, docx, docxreplace\n'
+            'print " ".join(sorted(set(["PIL", "Image", "json", "subprocess", "random"])'
+            ' & set(sys.modules)))')
+    child = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE,
+                             cwd=os.path.join(os.path.dirname(EXAMPLE_FILE), os.path.pardir))
+    assert child.communicate()[0].strip() == ''
+
+
+def testtemplatedir():
+    '''Ensure the template directory is known as soon as docx is imported'''
+    import docx
+    assert os.path.isdir(os.path.join(docx.template_dir, 'word'))
+
+
+def testcopy():
+    '''Ensure changing a copy leaves the original document alone'''
+    dx = opendx()
+    dup = dx.copy()
+    dup.body[0].clear()
+    assert len(dx.body[0]) > 0
+    assert dup.images == dx.images and dup.images is not dx.images
+    assert savebytes(opendx(), deterministic=True) == savebytes(dx, deterministic=True)
+
+
+def testlazymedia():
+    '''Ensure media is copied from the template and files as they are saved'''
+    dx = opendx()
+    assert isinstance(dx.images['word/media/image1.png'], ZipPart)
+    rel_id = dx.get_relationships()[0].attrib['Id']
+    picture = os.path.join(os.path.dirname(EXAMPLE_FILE), os.path.pardir, 'image1.png')
+    dx.set_image_data(rel_id, 'new.png', FilePart(picture))
+    saved = zipfile.ZipFile(StringIO(savebytes(dx)))
+    assert saved.testzip() is None
+    template = zipfile.ZipFile(EXAMPLE_FILE)
+    for name in template.namelist():
+        if name.startswith('word/media/'):
+            assert saved.read(name) == template.read(name)
+    assert saved.read('word/media/new.png') == open(picture, 'rb').read()
+
+
+def testmapped():
+    '''Ensure mapped packages are shared until they change, and read the
+    same as unmapped ones'''
+    first, second = mappedfile(EXAMPLE_FILE), mappedfile(EXAMPLE_FILE)
+    assert first.mapping is second.mapping
+    assert first.read(4) == 'PK\003\004' and second.tell() == 0
+    dx = DocX(EXAMPLE_FILE, mapped=True)
+    dx.verbose = False
+    assert savebytes(dx, deterministic=True) == savebytes(opendx(), deterministic=True)
+    assert opendocx(EXAMPLE_FILE, mapped=True).tag == opendx().get_document().tag
+    directory = tempfile.mkdtemp()
+    try:
+        template = os.path.join(directory, 'template.docx')
+        shutil.copy(EXAMPLE_FILE, template)
+        mapping = mappedfile(template).mapping
+        os.utime(template, (0, 0))
+        assert mappedfile(template).mapping is not mapping
+    finally:
+        shutil.rmtree(directory)
+
+
+def testlogfileshared():
+    '''Ensure a document that stops logging leaves other verbose documents
+    logging, and the last one puts the logger's level back'''
+    logger = logging.getLogger('docx')
+    level = logger.level
+    a, b = opendx(), opendx()
+    logged = StringIO()
+    a.set_log_file(logged)
+    b.set_log_file(logged)
+    try:
+        b.set_log_file(None)
+        savebytes(a)
+        assert 'Saved to' in logged.getvalue()
+    finally:
+        a.set_log_file(None)
+    assert logger.level == level
+    size = len(logged.getvalue())
+    savebytes(opendx())
+    assert len(logged.getvalue()) == size
+
+
+def testsaveinplace():
+    '''Ensure a document can be saved over the package it was opened from,
+    and saved again after that'''
+    directory = tempfile.mkdtemp()
+    try:
+        template = os.path.join(directory, 'template.docx')
+        for mapped in (False, True):
+            shutil.copy(EXAMPLE_FILE, template)
+            dx = DocX(template, mapped=mapped)
+            dx.verbose = False
+            dx.save()
+            saved = zipfile.ZipFile(template)
+            assert saved.testzip() is None
+            assert (saved.read('word/media/image1.png') ==
+                    zipfile.ZipFile(EXAMPLE_FILE).read('word/media/image1.png'))
+            dx.save()
+            assert zipfile.ZipFile(template).testzip() is None
+            assert os.listdir(directory) == ['template.docx']
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,15 @@
+'''
+Test text extraction
+'''
+import os
+from docx import opendocx, getdocumenttext, iterdocumenttext
+
+EXAMPLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.path.pardir, 'example', 'moodys_example.docx')
+
+
+def teststreamingtextextraction():
+    '''Ensure streamed paragraphs match the fully parsed ones'''
+    paratextlist = getdocumenttext(opendocx(EXAMPLE_FILE))
+    assert len(paratextlist) > 0
+    assert list(iterdocumenttext(EXAMPLE_FILE)) == paratextlist